@@ -0,0 +1,136 @@
+import asyncio
+import time
+from typing import Any, Dict, Optional
+
+from config import (
+    ADMISSION_GLOBAL_LIMIT,
+    ADMISSION_QUEUE_SIZE,
+    ADMISSION_QUEUE_TIMEOUT,
+    ADMISSION_RETRY_AFTER,
+    ADMISSION_USER_LIMITS,
+)
+from metrics import metrics
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionSlot:
+    """一个已准入的上游连接名额，release 可以重复调用"""
+
+    def __init__(self, controller: "AdmissionController", identity: str):
+        self._controller = controller
+        self.identity = identity
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self.identity)
+
+
+class AdmissionController:
+    """
+    上游LLM连接的准入控制：全局上限 + 每个用户/token 的上限（按认证方式 web/api 配置）
+    名额不够时在有界队列中等待，队列已满或等待超时立即拒绝，由调用方返回429
+    名额由上游读取任务持有，上游结束时释放，与客户端是否断开无关
+    """
+
+    def __init__(
+        self,
+        global_limit: int,
+        user_limits: Dict[str, int],
+        queue_size: int,
+        queue_timeout: float,
+        retry_after: int
+    ):
+        self.global_limit = global_limit
+        self.user_limits = user_limits
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        # 只记录当前占用名额的用户，名额全部释放后删除
+        self._per_user: Dict[str, int] = {}
+        self._condition: Optional[asyncio.Condition] = None
+
+    def user_limit(self, principal_type: str) -> int:
+        return self.user_limits.get(principal_type, self.user_limits["api"])
+
+    def _can_admit(self, identity: str, user_limit: int) -> bool:
+        return self.active < self.global_limit and self._per_user.get(identity, 0) < user_limit
+
+    def _admit(self, identity: str) -> AdmissionSlot:
+        self.active += 1
+        self._per_user[identity] = self._per_user.get(identity, 0) + 1
+        metrics.inc("admission.admitted")
+        return AdmissionSlot(self, identity)
+
+    async def acquire(self, identity: str, principal_type: str) -> AdmissionSlot:
+        """principal_type 由认证方式决定（web/api），不能使用客户端提交的字段"""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        user_limit = self.user_limit(principal_type)
+        if self._can_admit(identity, user_limit):
+            metrics.observe("admission.queue_seconds", 0)
+            return self._admit(identity)
+        if self.waiting >= self.queue_size:
+            metrics.inc("admission.rejected.queue_full")
+            raise AdmissionRejected("queue_full", self.retry_after)
+
+        began = time.monotonic()
+        self.waiting += 1
+        try:
+            async with self._condition:
+                await asyncio.wait_for(
+                    self._condition.wait_for(lambda: self._can_admit(identity, user_limit)),
+                    self.queue_timeout
+                )
+                metrics.observe("admission.queue_seconds", time.monotonic() - began)
+                return self._admit(identity)
+        except asyncio.TimeoutError:
+            metrics.observe("admission.queue_seconds", time.monotonic() - began)
+            reason = "user_limit" if self._per_user.get(identity, 0) >= user_limit else "global_limit"
+            metrics.inc(f"admission.rejected.{reason}")
+            raise AdmissionRejected(reason, self.retry_after)
+        finally:
+            self.waiting -= 1
+
+    def _release(self, identity: str):
+        self.active -= 1
+        remaining = self._per_user.get(identity, 0) - 1
+        if remaining > 0:
+            self._per_user[identity] = remaining
+        else:
+            self._per_user.pop(identity, None)
+        if self._condition is not None:
+            asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "global_limit": self.global_limit,
+            "queue_size": self.queue_size,
+            "users": len(self._per_user)
+        }
+
+
+# 创建全局单例实例
+admission = AdmissionController(
+    ADMISSION_GLOBAL_LIMIT,
+    user_limits=ADMISSION_USER_LIMITS,
+    queue_size=ADMISSION_QUEUE_SIZE,
+    queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+    retry_after=ADMISSION_RETRY_AFTER
+)
+metrics.register("admission", admission.stats)
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from cache import TTLCache
+from config import (
+    ANALYTICS_CACHE_MAX_BYTES,
+    ANALYTICS_CACHE_MAX_ITEMS,
+    ANALYTICS_CACHE_OPEN_TTL,
+    ANALYTICS_CACHE_CLOSE_DELAY,
+    ANALYTICS_CACHE_CONCURRENCY,
+    DATE_RANGE_CACHE_MAX_BYTES,
+)
+from metrics import metrics
+
+# 一个桶：(开始时间, 结束时间, 是否包含结束时间)
+Bucket = Tuple[datetime, datetime, bool]
+
+
+def split_days(start: datetime, end: datetime) -> List[Bucket]:
+    """
+    把 [start, end] 按自然日切分，中间的整天为 [当天0点, 次日0点)，
+    首尾不完整的天按实际范围切分，最后一个桶包含 end
+    """
+    buckets = []
+    current = start
+    while True:
+        next_day = datetime.combine(current.date() + timedelta(days=1), datetime.min.time(), tzinfo=current.tzinfo)
+        if next_day > end:
+            buckets.append((current, end, True))
+            return buckets
+        buckets.append((current, next_day, False))
+        current = next_day
+
+
+class DayBucketCache:
+    """
+    统计接口的按天分桶结果缓存
+    请求的时间范围切成按天的桶，每个桶单独查询并缓存，再合并成整个范围的结果；
+    结束时间早于 now - close_delay 的桶数据不会再变，永久缓存（只受容量限制），
+    其它（今天）的桶只缓存 open_ttl 秒，所以只有还没结束的那一天会重新查询ES
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_bytes: int,
+        max_items: int,
+        open_ttl: float,
+        close_delay: float,
+        concurrency: int
+    ):
+        self.open_ttl = open_ttl
+        self.close_delay = close_delay
+        self.cache = TTLCache(name, max_bytes, max_items, open_ttl)
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def is_closed(self, bucket_end: datetime, close_delay: Optional[float] = None) -> bool:
+        delay = self.close_delay if close_delay is None else close_delay
+        return bucket_end <= datetime.now(bucket_end.tzinfo) - timedelta(seconds=delay)
+
+    async def get_bucket(
+        self,
+        name: str,
+        params: Hashable,
+        bucket: Bucket,
+        loader: Callable[[datetime, datetime, bool], Awaitable[Any]],
+        close_delay: Optional[float] = None
+    ) -> Any:
+        start, end, inclusive = bucket
+        ttl = float("inf") if self.is_closed(end, close_delay) else self.open_ttl
+
+        async def load():
+            async with self._semaphore:
+                begin = time.monotonic()
+                value = await loader(start, end, inclusive)
+                metrics.observe(f"{self.cache.name}.load_seconds", time.monotonic() - begin)
+                return value
+
+        return await self.cache.get_or_load(
+            (name, params, start.isoformat(), end.isoformat(), inclusive),
+            load,
+            ttl=ttl
+        )
+
+    async def get_range(
+        self,
+        name: str,
+        params: Hashable,
+        start: datetime,
+        end: datetime,
+        loader: Callable[[datetime, datetime, bool], Awaitable[Any]],
+        close_delay: Optional[float] = None
+    ) -> List[Any]:
+        """
+        按天查询 [start, end]，返回各桶的结果（按时间升序），由调用方合并
+        name 区分不同的统计，params 为影响结果的其它参数，两者一起组成缓存的 key
+        """
+        if end < start:
+            return []
+        return await asyncio.gather(*[
+            self.get_bucket(name, params, bucket, loader, close_delay)
+            for bucket in split_days(start, end)
+        ])
+
+    async def get_open(self, name: str, params: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """不按天切分的统计，整个结果只缓存 open_ttl 秒"""
+        return await self.cache.get_or_load((name, params), loader)
+
+    def invalidate(self, name: str, open_only: bool = False, close_delay: Optional[float] = None) -> int:
+        """
+        数据被修改（如写入、删除会话）后，丢弃某个统计已缓存的结果，返回丢弃的数量
+        open_only 为 True 时只丢弃还没结束的桶（今天），已经永久缓存的桶保留
+        """
+        def matches(key) -> bool:
+            if key[0] != name:
+                return False
+            if not open_only or len(key) < 5:
+                return True
+            return not self.is_closed(datetime.fromisoformat(key[3]), close_delay)
+
+        return self.cache.delete_matching(matches)
+
+    def stats(self) -> Dict[str, Any]:
+        return self.cache.stats()
+
+
+# 创建全局单例实例
+analytics_cache = DayBucketCache(
+    "analytics_cache",
+    max_bytes=ANALYTICS_CACHE_MAX_BYTES,
+    max_items=ANALYTICS_CACHE_MAX_ITEMS,
+    open_ttl=ANALYTICS_CACHE_OPEN_TTL,
+    close_delay=ANALYTICS_CACHE_CLOSE_DELAY,
+    concurrency=ANALYTICS_CACHE_CONCURRENCY
+)
+metrics.register("analytics_cache", analytics_cache.stats)
+
+# 日期范围明细（会话列表）的按天缓存，单独按字节数限制大小
+date_range_cache = DayBucketCache(
+    "date_range_cache",
+    max_bytes=DATE_RANGE_CACHE_MAX_BYTES,
+    max_items=ANALYTICS_CACHE_MAX_ITEMS,
+    open_ttl=ANALYTICS_CACHE_OPEN_TTL,
+    close_delay=ANALYTICS_CACHE_CLOSE_DELAY,
+    concurrency=ANALYTICS_CACHE_CONCURRENCY
+)
+metrics.register("date_range_cache", date_range_cache.stats)
@@ -0,0 +1,96 @@
+import asyncio
+import hashlib
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Optional
+
+from cache import TTLCache
+from config import (
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_TTL,
+    ANSWER_CACHE_BUCKET_SECONDS,
+    ANSWER_CACHE_MAX_BYTES,
+    ANSWER_CACHE_MAX_ITEMS,
+    ANSWER_CACHE_REPLAY_INTERVAL,
+)
+from metrics import metrics
+
+# 上游帧之间的分隔符
+FRAME_SEPARATOR = b"\n\n"
+
+
+class CachedAnswer:
+    def __init__(self, body: bytes, answer: str, documents: Any):
+        # 上游原始输出，重放时原样返回
+        self.body = body
+        self.answer = answer
+        self.documents = documents
+
+
+class AnswerCache:
+    """
+    完全相同的问题的回答缓存
+    key 为 request_key（规范化的问题、索引、engine、历史、system_prompt 版本等）加上时间分桶，
+    只缓存正常结束的回答；重放的字节与上游原始输出相同
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        ttl: float,
+        bucket_seconds: int,
+        max_bytes: int,
+        max_items: int,
+        replay_interval: float
+    ):
+        self.enabled = enabled
+        self.bucket_seconds = bucket_seconds
+        self.replay_interval = replay_interval
+        self.cache = TTLCache("answer_cache", max_bytes, max_items, ttl)
+
+    def key(self, request_key: str) -> str:
+        # 按本地时间分桶，默认每天一个桶
+        bucket = int((datetime.now() - datetime(1970, 1, 1)).total_seconds() // self.bucket_seconds)
+        return hashlib.sha256(f"{request_key}:{bucket}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[CachedAnswer]:
+        found, value = self.cache.get(key)
+        if found:
+            self.cache.hits += 1
+            return value
+        self.cache.misses += 1
+        return None
+
+    def put(self, key: str, body: bytes, answer: str, documents: Any):
+        if not body:
+            return
+        self.cache.set(key, CachedAnswer(body, answer, documents), size=len(body) + len(answer.encode("utf-8")))
+        metrics.inc("answer_cache.stored")
+
+    async def replay(self, body: bytes) -> AsyncIterator[bytes]:
+        """按帧重放，replay_interval 为 0 时一次性输出"""
+        if self.replay_interval <= 0:
+            yield body
+            return
+        start = 0
+        while start < len(body):
+            end = body.find(FRAME_SEPARATOR, start)
+            end = len(body) if end < 0 else end + len(FRAME_SEPARATOR)
+            yield body[start:end]
+            start = end
+            if start < len(body):
+                await asyncio.sleep(self.replay_interval)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, **self.cache.stats()}
+
+
+# 创建全局单例实例
+answer_cache = AnswerCache(
+    ANSWER_CACHE_ENABLED,
+    ttl=ANSWER_CACHE_TTL,
+    bucket_seconds=ANSWER_CACHE_BUCKET_SECONDS,
+    max_bytes=ANSWER_CACHE_MAX_BYTES,
+    max_items=ANSWER_CACHE_MAX_ITEMS,
+    replay_interval=ANSWER_CACHE_REPLAY_INTERVAL
+)
+metrics.register("answer_cache", answer_cache.stats)
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+def estimate_size(value: Any) -> int:
+    """估算缓存值占用的字节数"""
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    try:
+        return len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+    except (TypeError, ValueError):
+        return len(repr(value))
+
+
+class TTLCache:
+    """
+    按字节数和条目数限制大小的 LRU 缓存，每个条目有过期时间
+    get_or_load 会把同一个 key 的并发未命中合并成一次加载（single-flight）
+    只在单个事件循环内使用，不需要加锁
+    """
+
+    def __init__(self, name: str, max_bytes: int, max_items: int, ttl: float):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.ttl = ttl
+        # key -> (过期时间, 字节数, 值)
+        self._data: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """返回 (是否命中, 值)"""
+        item = self._data.get(key)
+        if item is None:
+            return False, None
+        expires_at, _, value = item
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, size: Optional[int] = None):
+        size = estimate_size(value) if size is None else size
+        # 单个值超过总容量时不缓存
+        if size > self.max_bytes:
+            return
+        if key in self._data:
+            self._remove(key)
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, size, value)
+        self.current_bytes += size
+        while self._data and (self.current_bytes > self.max_bytes or len(self._data) > self.max_items):
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def delete(self, key: Hashable):
+        if key in self._data:
+            self._remove(key)
+
+    def delete_matching(self, predicate: Callable[[Hashable], bool]) -> int:
+        """删除所有满足条件的 key，返回删除的数量"""
+        keys = [key for key in self._data if predicate(key)]
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def clear(self):
+        self._data.clear()
+        self.current_bytes = 0
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._data.pop(key)
+        self.current_bytes -= size
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: Optional[float] = None
+    ) -> Any:
+        """
+        命中直接返回；未命中时调用 loader 加载并写入缓存，ttl 为空时使用缓存默认的过期时间
+        加载中的 key 再次请求时等待同一个加载任务，加载失败不缓存，异常原样抛给所有等待者
+        """
+        found, value = self.get(key)
+        if found:
+            self.hits += 1
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(loader())
+            self._inflight[key] = task
+
+            def on_done(done: asyncio.Future):
+                self._inflight.pop(key, None)
+                if not done.cancelled() and done.exception() is None:
+                    self.set(key, done.result(), ttl=ttl)
+
+            task.add_done_callback(on_done)
+
+        # shield: 某个请求方断开时不取消其它请求方也在等待的加载任务
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "items": len(self._data),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "max_items": self.max_items,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "inflight": len(self._inflight),
+            "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0
+        }
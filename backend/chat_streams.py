@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
+
+from config import (
+    CHAT_STREAM_RETAIN_SECONDS,
+    CHAT_STREAM_MEMORY_BYTES,
+    CHAT_STREAM_SPILL_DIR,
+    CHAT_STREAM_READ_SIZE,
+    CHAT_STREAM_FANOUT,
+)
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# 不影响上游回答的字段，不参与请求去重的key
+REQUEST_KEY_IGNORED_FIELDS = ("client_type",)
+
+
+def request_key(payload: Dict[str, Any], prompt_version: int) -> str:
+    """规范化后的请求内容（加上 system_prompt 版本）的hash，相同的请求共用一次上游生成"""
+    normalized = {
+        key: value for key, value in payload.items()
+        if key not in REQUEST_KEY_IGNORED_FIELDS
+    }
+    if isinstance(normalized.get("question"), str):
+        normalized["question"] = " ".join(normalized["question"].split())
+    normalized["prompt_version"] = prompt_version
+    encoded = json.dumps(normalized, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class StreamGone(Exception):
+    """请求的偏移量已经不在缓冲区中（超出内存且没有落盘）"""
+
+
+class StreamFailed(Exception):
+    """上游在输出中途失败（连接错误、超时、被取消），已输出的内容是不完整的"""
+
+
+class ChatStream:
+    """
+    一次上游生成的输出缓冲
+    上游读取任务只往这里追加字节，不关心客户端；客户端按字节偏移读取，
+    断开后可以从已收到的字节数继续读，重放的字节与第一次收到的完全相同
+    内存中只保留最近 memory_limit 字节，更早的按顺序写入落盘文件（文件偏移即流偏移）
+    """
+
+    def __init__(self, stream_id: str, owner: str, memory_limit: int, spill_dir: str, key: Optional[str] = None):
+        self.stream_id = stream_id
+        self.key = key
+        # 可以读取（重连）这个流的用户，相同请求合并后包含所有订阅者
+        self.owners: Set[str] = {owner}
+        # 每个订阅者各自的聊天流日志内容，上游结束后每人记录一条
+        self.log_entries: List[Dict[str, Any]] = []
+        self.memory_limit = memory_limit
+        self.spill_path = os.path.join(spill_dir, f"{stream_id}.bin") if spill_dir else None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        # 正在读取这个流的客户端数
+        self.readers = 0
+        # 已产生的总字节数
+        self.size = 0
+        # 内存中的 (偏移, 数据)
+        self._chunks: Deque[Tuple[int, bytes]] = deque()
+        self._memory_start = 0
+        self._memory_bytes = 0
+        self._event = asyncio.Event()
+        # 上游返回响应头（或失败）后完成，结果为 (状态码, 错误信息)
+        self.started: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    def set_started(self, status: int = 200, detail: str = ""):
+        if not self.started.done():
+            self.started.set_result((status, detail))
+
+    def append(self, data: bytes):
+        if not data or self.finished:
+            return
+        self._chunks.append((self.size, data))
+        self.size += len(data)
+        self._memory_bytes += len(data)
+        # 超出内存上限时，最早的数据移到落盘文件（至少保留最后一块）
+        while self._memory_bytes > self.memory_limit and len(self._chunks) > 1:
+            offset, chunk = self._chunks.popleft()
+            if self.spill_path:
+                self._spill(chunk)
+            self._memory_start = offset + len(chunk)
+            self._memory_bytes -= len(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[str] = None):
+        if self.finished:
+            return
+        self.error = error
+        self.finished_at = time.time()
+        self.set_started()
+        self._notify()
+
+    def _notify(self):
+        event = self._event
+        self._event = asyncio.Event()
+        event.set()
+
+    def _spill(self, chunk: bytes):
+        try:
+            os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+            with open(self.spill_path, "ab") as f:
+                f.write(chunk)
+        except OSError as e:
+            logger.error(f"Error spilling chat stream {self.stream_id}: {str(e)}")
+            self.spill_path = None
+
+    async def read(self, offset: int, limit: int) -> bytes:
+        """读取 offset 开始最多 limit 字节已产生的数据"""
+        if offset < self._memory_start:
+            if not self.spill_path:
+                raise StreamGone(f"offset {offset} is no longer buffered")
+            end = min(self._memory_start, offset + limit)
+            return await asyncio.to_thread(self._read_spill, offset, end - offset)
+        parts = []
+        length = 0
+        for chunk_offset, chunk in self._chunks:
+            chunk_end = chunk_offset + len(chunk)
+            if chunk_end <= offset:
+                continue
+            part = chunk[max(offset - chunk_offset, 0):]
+            parts.append(part)
+            length += len(part)
+            if length >= limit:
+                break
+        return b"".join(parts)[:limit]
+
+    async def read_all(self) -> bytes:
+        """读取目前已产生的全部数据"""
+        body = bytearray()
+        while len(body) < self.size:
+            body += await self.read(len(body), self.size - len(body))
+        return bytes(body)
+
+    def _read_spill(self, offset: int, length: int) -> bytes:
+        with open(self.spill_path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    async def iter_from(self, offset: int = 0, read_size: int = CHAT_STREAM_READ_SIZE) -> AsyncIterator[bytes]:
+        """从 offset 开始输出，追上后等待新数据，直到上游结束；上游中途失败时输出完已有数据后抛出 StreamFailed"""
+        while True:
+            event = self._event
+            if offset < self.size:
+                data = await self.read(offset, read_size)
+                offset += len(data)
+                yield data
+                continue
+            if self.finished:
+                if self.error:
+                    raise StreamFailed(self.error)
+                return
+            await event.wait()
+
+    def discard(self):
+        self._chunks.clear()
+        self._memory_bytes = 0
+        if self.spill_path and os.path.exists(self.spill_path):
+            try:
+                os.remove(self.spill_path)
+            except OSError as e:
+                logger.error(f"Error removing chat stream spill {self.spill_path}: {str(e)}")
+
+
+class ChatStreamRegistry:
+    """
+    进程内的 chat_stream 登记表，流结束 retain_seconds 秒后清理
+    fanout 开启时，相同请求（request_key）在生成期间共用一个上游流
+    """
+
+    def __init__(self, retain_seconds: float, memory_limit: int, spill_dir: str, fanout: bool = True):
+        self.retain_seconds = retain_seconds
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.fanout = fanout
+        self._streams: Dict[str, ChatStream] = {}
+        # 请求key -> 正在生成的流
+        self._running: Dict[str, ChatStream] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def create(self, owner: str, key: Optional[str] = None) -> ChatStream:
+        stream = ChatStream(uuid.uuid4().hex, owner, self.memory_limit, self.spill_dir, key)
+        self._streams[stream.stream_id] = stream
+        if key is not None and self.fanout:
+            self._running[key] = stream
+        metrics.inc("chat_stream.created")
+        return stream
+
+    def get(self, stream_id: str) -> Optional[ChatStream]:
+        return self._streams.get(stream_id)
+
+    def attach(self, key: str, owner: str, log_entry: Dict[str, Any]) -> Optional[ChatStream]:
+        """
+        有相同请求正在生成时加入它：新订阅者从头读取同一个缓冲，
+        各订阅者按自己的偏移读取，互不阻塞，也不会阻塞上游
+        """
+        if not self.fanout:
+            return None
+        stream = self._running.get(key)
+        if stream is None or stream.finished:
+            return None
+        # 上游已经返回错误状态的不再加入
+        if stream.started.done() and stream.started.result()[0] != 200:
+            return None
+        stream.owners.add(owner)
+        stream.log_entries.append(log_entry)
+        metrics.inc("chat_stream.fanout_attached")
+        return stream
+
+    def release(self, stream: ChatStream):
+        """上游结束后不再接受新的订阅者"""
+        if stream.key is not None and self._running.get(stream.key) is stream:
+            del self._running[stream.key]
+
+    async def start(self):
+        self._task = asyncio.create_task(self._cleanup())
+        metrics.register("chat_streams", self.stats)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        tasks = []
+        for stream in self._streams.values():
+            if stream.task is not None and not stream.task.done():
+                stream.task.cancel()
+                tasks.append(stream.task)
+        # 等取消的上游任务执行完 finally（写聊天记录等），再清理流
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for stream in list(self._streams.values()):
+            stream.discard()
+        self._streams.clear()
+        self._running.clear()
+
+    async def _cleanup(self):
+        while True:
+            await asyncio.sleep(max(self.retain_seconds / 4, 1))
+            deadline = time.time() - self.retain_seconds
+            for stream_id, stream in list(self._streams.items()):
+                if stream.finished and stream.finished_at < deadline:
+                    del self._streams[stream_id]
+                    stream.discard()
+
+    def stats(self):
+        streams = list(self._streams.values())
+        return {
+            "streams": len(streams),
+            "running": sum(1 for stream in streams if not stream.finished),
+            "subscribers": sum(len(stream.log_entries) for stream in streams if not stream.finished),
+            "buffered_bytes": sum(stream.memory_bytes for stream in streams)
+        }
+
+
+# 创建全局单例实例
+chat_streams = ChatStreamRegistry(
+    CHAT_STREAM_RETAIN_SECONDS,
+    memory_limit=CHAT_STREAM_MEMORY_BYTES,
+    spill_dir=CHAT_STREAM_SPILL_DIR,
+    fanout=CHAT_STREAM_FANOUT
+)
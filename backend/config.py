@@ -1,5 +1,5 @@
 import os
-from typing import Dict, List
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
 
 # 首先加载环境变量
@@ -12,6 +12,13 @@ BASE_URLS: Dict[str, str] = {
 }
 
 ES_HOST = os.getenv("ES_HOST", "")
+ES_CONNECTIONS_PER_NODE = int(os.getenv("ES_CONNECTIONS_PER_NODE", "25"))   # 每个ES节点的连接池大小
+ES_REQUEST_TIMEOUT = float(os.getenv("ES_REQUEST_TIMEOUT", "30"))          # 秒
+ES_MAX_RETRIES = int(os.getenv("ES_MAX_RETRIES", "3"))
+ES_STARTUP_TIMEOUT = float(os.getenv("ES_STARTUP_TIMEOUT", "0"))          # 秒，启动时等待ES初始化的时间，0 表示不等待，都在后台进行
+ES_BOOTSTRAP_MAX_BACKOFF = float(os.getenv("ES_BOOTSTRAP_MAX_BACKOFF", "60"))  # 秒，后台重试初始化的最大间隔
+READINESS_PING_TIMEOUT = float(os.getenv("READINESS_PING_TIMEOUT", "1"))    # 秒，/readyz 检查ES连通性的超时
+SESSION_PREVIEW_LENGTH = int(os.getenv("SESSION_PREVIEW_LENGTH", "100"))   # 会话列表中最后一条消息预览的字数
 SYS_PASSWORD = os.getenv("SYS_PASSWORD", "2fcx1KPZJuNJ")
 PRIVATE_KEY = os.getenv("PRIVATE_KEY", "")
 
@@ -60,6 +67,122 @@ def get_url(index_name, keywords):
         return API_ENDPOINTS[f"CUSTOM_{keywords}"]
 
 
+# 上游HTTP连接池配置
+UPSTREAM_POOL_LIMIT = int(os.getenv("UPSTREAM_POOL_LIMIT", "200"))                  # 每个上游的总连接数上限
+UPSTREAM_POOL_LIMIT_PER_HOST = int(os.getenv("UPSTREAM_POOL_LIMIT_PER_HOST", "100"))  # 单个host的连接数上限
+UPSTREAM_DNS_CACHE_TTL = int(os.getenv("UPSTREAM_DNS_CACHE_TTL", "300"))            # DNS缓存时间（秒）
+UPSTREAM_KEEPALIVE_TIMEOUT = float(os.getenv("UPSTREAM_KEEPALIVE_TIMEOUT", "60"))   # 空闲连接保活时间（秒）
+
+
+def upstream_timeout(name: str, total: float, connect: float = 0) -> Dict[str, Optional[float]]:
+    """
+    读取一类上游接口的超时配置（秒）：UPSTREAM_{NAME}_TIMEOUT、UPSTREAM_{NAME}_CONNECT_TIMEOUT，0 表示不限制
+    默认值与原来每个接口各自创建 ClientSession 时相同（没有单独设置的为 aiohttp 默认的 300 秒）
+    """
+    total = float(os.getenv(f"UPSTREAM_{name.upper()}_TIMEOUT", str(total)))
+    connect = float(os.getenv(f"UPSTREAM_{name.upper()}_CONNECT_TIMEOUT", str(connect)))
+    return {"total": total or None, "connect": connect or None}
+
+
+# 各类上游接口的超时配置
+UPSTREAM_TIMEOUTS: Dict[str, Dict[str, Optional[float]]] = {
+    "default": upstream_timeout("default", 300),
+    "fragment": upstream_timeout("fragment", 300),   # 段落、页面文本/html等片段信息
+    "index": upstream_timeout("index", 30),          # 表格/图片信息
+    "file": upstream_timeout("file", 300),           # PDF、图片等文件
+    "bigdata": upstream_timeout("bigdata", 300),
+    "chat": upstream_timeout("chat", 600, 60),       # LLM流式对话
+}
+
+# 批量解析引用的配置
+CITATION_BATCH_CONCURRENCY = int(os.getenv("CITATION_BATCH_CONCURRENCY", "8"))   # 同时请求上游的数量
+CITATION_BATCH_MAX_ITEMS = int(os.getenv("CITATION_BATCH_MAX_ITEMS", "200"))     # 单次请求的条目上限
+
+# 段落/表格/图片信息缓存
+FRAGMENT_CACHE_MAX_BYTES = int(os.getenv("FRAGMENT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+FRAGMENT_CACHE_MAX_ITEMS = int(os.getenv("FRAGMENT_CACHE_MAX_ITEMS", "50000"))
+FRAGMENT_CACHE_TTL = float(os.getenv("FRAGMENT_CACHE_TTL", str(24 * 3600)))       # 秒
+
+# PDF单页的磁盘缓存
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", "cache/pdf")
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+# LLM输出退化检测：回答超过 MIN_CHARS 字后，同一行（长度 >= MIN_LINE_LENGTH）出现 MAX_LINE_REPEATS 次即中断
+DEGENERATION_DETECTOR = os.getenv("DEGENERATION_DETECTOR", "repetition")          # repetition / none
+DEGENERATION_MIN_CHARS = int(os.getenv("DEGENERATION_MIN_CHARS", "1000"))
+DEGENERATION_MIN_LINE_LENGTH = int(os.getenv("DEGENERATION_MIN_LINE_LENGTH", "5"))
+DEGENERATION_MAX_LINE_REPEATS = int(os.getenv("DEGENERATION_MAX_LINE_REPEATS", "3"))
+DEGENERATION_NGRAM_SIZE = int(os.getenv("DEGENERATION_NGRAM_SIZE", "0"))          # 0 表示不按字符窗口检测
+DEGENERATION_MAX_NGRAM_REPEATS = int(os.getenv("DEGENERATION_MAX_NGRAM_REPEATS", "0"))
+
+# 聊天流记录的异步批量写入
+CHAT_LOG_QUEUE_SIZE = int(os.getenv("CHAT_LOG_QUEUE_SIZE", "10000"))
+CHAT_LOG_BATCH_SIZE = int(os.getenv("CHAT_LOG_BATCH_SIZE", "200"))
+CHAT_LOG_FLUSH_INTERVAL = float(os.getenv("CHAT_LOG_FLUSH_INTERVAL", "1.0"))     # 秒
+CHAT_LOG_MAX_RETRIES = int(os.getenv("CHAT_LOG_MAX_RETRIES", "5"))
+CHAT_LOG_SPILL_PATH = os.getenv("CHAT_LOG_SPILL_PATH", "cache/chat_log_spill.ndjson")
+
+# 聊天流记录按时间滚动的索引和生命周期（ILM）
+CHAT_LOG_ROLLOVER_MAX_AGE = os.getenv("CHAT_LOG_ROLLOVER_MAX_AGE", "30d")          # 写入索引超过这个时间后滚动
+CHAT_LOG_ROLLOVER_MAX_SIZE = os.getenv("CHAT_LOG_ROLLOVER_MAX_SIZE", "50gb")       # 或主分片超过这个大小后滚动
+CHAT_LOG_WARM_AFTER = os.getenv("CHAT_LOG_WARM_AFTER", "7d")                       # 滚动后多久合并段并设为只读
+CHAT_LOG_DELETE_AFTER = os.getenv("CHAT_LOG_DELETE_AFTER", "365d")                 # 滚动后多久删除
+CHAT_LOG_ROUTING_SLACK = float(os.getenv("CHAT_LOG_ROUTING_SLACK", str(24 * 3600)))  # 秒，落盘补写的记录可能晚于索引创建时间写入
+
+# 用户设置（system_prompt等）缓存的轮询间隔（秒），0 表示不轮询
+SETTINGS_POLL_INTERVAL = float(os.getenv("SETTINGS_POLL_INTERVAL", "30"))
+SETTINGS_CACHE_MAX_ITEMS = int(os.getenv("SETTINGS_CACHE_MAX_ITEMS", "1000"))       # 缓存的设置数上限，超出时淘汰最久没有读取的
+SETTINGS_CACHE_IDLE_SECONDS = float(os.getenv("SETTINGS_CACHE_IDLE_SECONDS", "3600"))  # 超过这个时间没有读取的设置不再轮询并从缓存删除
+
+# 部门使用量日汇总：后台定时重算最近几天的汇总，写入路径实时累加
+USAGE_ROLLUP_INTERVAL = float(os.getenv("USAGE_ROLLUP_INTERVAL", "600"))       # 秒，0 表示不定时重算
+USAGE_ROLLUP_RECENT_DAYS = int(os.getenv("USAGE_ROLLUP_RECENT_DAYS", "2"))      # 每次重算最近几天（含今天）
+
+# 统计接口按天分桶的结果缓存：已结束超过 CLOSE_DELAY 的天永久缓存（受容量限制），其它的只缓存 OPEN_TTL
+ANALYTICS_CACHE_MAX_BYTES = int(os.getenv("ANALYTICS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+ANALYTICS_CACHE_MAX_ITEMS = int(os.getenv("ANALYTICS_CACHE_MAX_ITEMS", "20000"))
+ANALYTICS_CACHE_OPEN_TTL = float(os.getenv("ANALYTICS_CACHE_OPEN_TTL", "30"))          # 秒
+ANALYTICS_CACHE_CLOSE_DELAY = float(os.getenv("ANALYTICS_CACHE_CLOSE_DELAY", "900"))   # 秒，给迟到的写入留出时间
+ANALYTICS_CACHE_CONCURRENCY = int(os.getenv("ANALYTICS_CACHE_CONCURRENCY", "8"))      # 同时查询ES的桶数
+# 日期范围明细接口的按天缓存单独限制字节数，每天最多上万条会话明细，不挤占其它统计的缓存
+DATE_RANGE_CACHE_MAX_BYTES = int(os.getenv("DATE_RANGE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# 研报文档元数据（按 sid 去重存储）的进程内缓存
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv("DOCUMENT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+DOCUMENT_CACHE_MAX_ITEMS = int(os.getenv("DOCUMENT_CACHE_MAX_ITEMS", "100000"))
+DOCUMENT_CACHE_TTL = float(os.getenv("DOCUMENT_CACHE_TTL", str(24 * 3600)))       # 秒
+
+# chat_stream 输出缓冲：客户端断开后可按字节偏移重连续读，流结束后保留 RETAIN_SECONDS 秒
+CHAT_STREAM_RETAIN_SECONDS = float(os.getenv("CHAT_STREAM_RETAIN_SECONDS", "300"))
+CHAT_STREAM_MEMORY_BYTES = int(os.getenv("CHAT_STREAM_MEMORY_BYTES", str(1024 * 1024)))   # 每个流在内存中保留的字节数
+CHAT_STREAM_SPILL_DIR = os.getenv("CHAT_STREAM_SPILL_DIR", "cache/streams")               # 超出内存部分的落盘目录，为空时不落盘
+CHAT_STREAM_READ_SIZE = int(os.getenv("CHAT_STREAM_READ_SIZE", str(64 * 1024)))          # 每次发给客户端的最大字节数
+CHAT_STREAM_FANOUT = os.getenv("CHAT_STREAM_FANOUT", "true").lower() == "true"           # 相同请求并发时共用一个上游流
+# 客户端输出：落后上游超过 HIGH_WATER 字节、或单次发送阻塞超过 SLOW_CLIENT_TIMEOUT 秒视为慢客户端
+CHAT_STREAM_HIGH_WATER = int(os.getenv("CHAT_STREAM_HIGH_WATER", str(256 * 1024)))
+CHAT_STREAM_SLOW_CLIENT_TIMEOUT = float(os.getenv("CHAT_STREAM_SLOW_CLIENT_TIMEOUT", "30"))
+CHAT_STREAM_SLOW_CLIENT_POLICY = os.getenv("CHAT_STREAM_SLOW_CLIENT_POLICY", "disconnect")   # disconnect：断开，客户端可按偏移重连；ignore：只记录
+CHAT_STREAM_ABANDON_SECONDS = float(os.getenv("CHAT_STREAM_ABANDON_SECONDS", "0"))           # 没有客户端读取超过这个时间后取消上游，0 表示总是生成完
+
+# 重复问题的回答缓存（默认关闭），请求中带 no_cache: true 时跳过
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(6 * 3600)))                  # 秒
+ANSWER_CACHE_BUCKET_SECONDS = int(os.getenv("ANSWER_CACHE_BUCKET_SECONDS", str(24 * 3600)))  # 时间分桶，不同桶的相同问题不共用回答
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+ANSWER_CACHE_MAX_ITEMS = int(os.getenv("ANSWER_CACHE_MAX_ITEMS", "2000"))
+ANSWER_CACHE_REPLAY_INTERVAL = float(os.getenv("ANSWER_CACHE_REPLAY_INTERVAL", "0"))    # 秒，重放时每帧之间的间隔，0 表示一次性返回
+
+# chat_stream 准入控制：同时打开的上游连接数上限，超出时短暂排队，队列满或等待超时返回429
+ADMISSION_GLOBAL_LIMIT = int(os.getenv("ADMISSION_GLOBAL_LIMIT", "64"))         # 全局上限
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "32"))             # 最多排队的请求数
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))     # 秒，最长排队时间
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))            # 秒，429响应的 Retry-After
+# 每个用户（或API token）的上限，按认证方式区分：登录用户（JWT）为 web，API token 为 api
+ADMISSION_USER_LIMITS = {
+    "web": int(os.getenv("ADMISSION_WEB_USER_LIMIT", "3")),
+    "api": int(os.getenv("ADMISSION_API_USER_LIMIT", "2")),
+}
+
 # 跨域配置
 CORS_ORIGINS = ['*']
 SALT = os.getenv("PASSWORD_SALT", "yigeshenqideyan")
@@ -1,11 +1,20 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from typing import Optional, List, Dict, Any
 from pydantic import BaseModel, Field
 from datetime import datetime
+import asyncio
+import csv
+import io
+import json
 from auth import verify_token
-from database.elasticsearch import es_client, CHAT_INDEX, CHAT_STREAM_INDEX
+from database.elasticsearch import es_client, CHAT_INDEX
 import uuid
-from config import SYS_PASSWORD
+from config import SYS_PASSWORD, USAGE_ROLLUP_RECENT_DAYS, ANALYTICS_CACHE_CONCURRENCY
+from analytics_cache import analytics_cache, date_range_cache, split_days
+from database.settings_cache import settings_cache
+from database.usage_rollup import usage_rollup
 
 
 router = APIRouter()
@@ -14,6 +23,9 @@ class DateRangeRequest(BaseModel):
     start_date: datetime = Field(..., description="开始日期")
     end_date: datetime = Field(..., description="结束日期")
 
+class ProtectedDateRangeRequest(DateRangeRequest):
+    password: str = Field(..., description="系统密码")
+
 class Document(BaseModel):
     sid: str
     ID: str
@@ -48,6 +60,12 @@ class ChatResponse(BaseModel):
     message: str = Field(..., description="响应消息")
     data: Optional[Any] = Field(default=None, description="响应数据")
 
+def invalidate_session_stats(include_users: bool = True):
+    """会话写入或删除后丢弃受影响的统计缓存：用户列表整体丢弃，部门统计只丢弃还没结束的天"""
+    if include_users:
+        analytics_cache.invalidate("users")
+    analytics_cache.invalidate("department_stats", open_only=True, close_delay=USAGE_ROLLUP_RECENT_DAYS * 24 * 3600)
+
 # 创建/更新聊天会话
 @router.post("/session", response_model=ChatResponse)
 async def create_or_update_session(chat: ChatSession):
@@ -68,9 +86,10 @@ async def create_or_update_session(chat: ChatSession):
         }
         
         # 存储会话
-        success = es_client.store_chat_session(**session_data)
+        success = await es_client.store_chat_session(**session_data)
         
         if success:
+            invalidate_session_stats()
             return {
                 "success": True,
                 "message": "Chat session created successfully",
@@ -95,7 +114,7 @@ async def create_or_update_session(chat: ChatSession):
 @router.post("/session/{session_id}/message")
 async def add_message(session_id: str, message: ChatMessage):
     try:
-        success = es_client.update_chat_session(
+        success = await es_client.update_chat_session(
             session_id=session_id,
             new_message=message.dict()
         )
@@ -120,11 +139,75 @@ async def add_message(session_id: str, message: ChatMessage):
             "data": message
         }
 
+# 增量同步请求：只包含客户端新增的消息
+class SessionDelta(BaseModel):
+    user_id: str = Field(..., description="用户ID")
+    ai_type: str = Field(..., description="ai类型")
+    base_version: Optional[str] = Field(default=None, description="客户端已知的会话版本，新建会话时为空")
+    base_count: int = Field(default=0, ge=0, description="客户端已同步的消息数量")
+    messages: List[ChatMessage] = Field(default_factory=list, description="新增的消息")
+    title: Optional[str] = Field(default=None, description="会话标题")
+    model: Optional[str] = Field(default=None, description="使用的模型")
+    total_tokens: Optional[int] = Field(default=None, description="总token数")
+    metadata: Optional[Dict[str, Any]] = Field(default=None, description="其他元数据")
+
+# 增量同步会话
+@router.post("/session/{session_id}/delta", response_model=ChatResponse)
+async def sync_session_delta(session_id: str, delta: SessionDelta):
+    """
+    只追加新消息并返回新的版本号；版本冲突时返回409，
+    data 中带有服务端当前版本和客户端缺少的消息，客户端合并后用新版本重试
+    """
+    try:
+        header = {
+            "user_id": delta.user_id,
+            "ai_type": delta.ai_type,
+            "title": delta.title,
+            "model": delta.model,
+            "total_tokens": delta.total_tokens,
+            "metadata": delta.metadata
+        }
+        result = await es_client.apply_session_delta(
+            session_id=session_id,
+            base_version=delta.base_version,
+            base_count=delta.base_count,
+            messages=[msg.dict() for msg in delta.messages],
+            header=header
+        )
+    except ValueError:
+        return JSONResponse(
+            status_code=400,
+            content=ChatResponse(success=False, message="Invalid base_version").dict()
+        )
+    except Exception as e:
+        print(e)
+        return ChatResponse(
+            success=False,
+            message="Session delta sync error"
+        )
+
+    conflict = result.pop("conflict")
+    if conflict:
+        return JSONResponse(
+            status_code=409,
+            content=jsonable_encoder(ChatResponse(
+                success=False,
+                message="Session version conflict",
+                data=result
+            ))
+        )
+    invalidate_session_stats(include_users=delta.base_version is None)
+    return ChatResponse(
+        success=True,
+        message="Session synced successfully",
+        data={"session_id": session_id, **result}
+    )
+
 # 获取会话详情
 @router.get("/session/{session_id}", response_model=ChatResponse)
 async def get_session(session_id: str):
     try:
-        session = es_client.get_chat_session(session_id)
+        session = await es_client.get_chat_session(session_id)
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
             
@@ -156,61 +239,29 @@ async def get_user_sessions(
     password: str = None,
     keyword: str = "",  # 添加keyword参数，默认为空字符串
     page: int = Query(1, ge=1),
-    page_size: int = Query(20, ge=1, le=100)
+    page_size: int = Query(20, ge=1, le=100),
+    view: str = Query("full", description="full：返回完整消息；summary：只返回标题、时间、消息数和最后一条消息预览"),
+    cursor: Optional[str] = Query(None, description="游标分页：首页传空字符串，之后传上一页返回的 next_cursor；不传时按 page 分页"),
+    pit: bool = Query(False, description="游标分页时是否固定在同一个 point-in-time 快照上")
 ):
     try:
         from_ = (page - 1) * page_size
+        summary = view == "summary"
         
-        query_bool_must = [
-            {
-                "term": {
-                    "user_id": user['username']
-                }
-            }
-        ]
-        
-        if password != SYS_PASSWORD:
-            query_bool_must.append({
-                "term": {
-                    "is_delete": False
-                }
-            })
-        
-        # 如果keyword不为空，添加title搜索条件
-        if keyword.strip():
-            query_bool_must.append({
-                "match": {
-                    "title": keyword
-                }
-            })
-        
-        # 构建查询体
-        query = {
-            "query": {
-                "bool": {
-                    "must": query_bool_must
-                }
-            },
-            "sort": [
-                {"timestamp": "desc"}
-            ],
-            "from": from_,
-            "size": page_size
-        }
-        
-        result = es_client.client.search(
-            index=CHAT_INDEX,
-            body=query
+        return await es_client.get_user_chat_sessions(
+            user['username'],
+            from_=from_,
+            size=page_size,
+            summary=summary,
+            # 游标分页：按 (timestamp, session_id) 排序做 search_after，深翻页的代价不变
+            cursor=cursor,
+            use_pit=pit,
+            keyword=keyword,
+            include_deleted=password == SYS_PASSWORD
         )
         
-        sessions = [hit["_source"] for hit in result["hits"]["hits"]]
-        total = result["hits"]["total"]["value"]
-        
-        return {
-            "total": total,
-            "sessions": sessions
-        }
-        
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(e)
         return {
@@ -224,16 +275,11 @@ async def get_user_sessions(
 @router.delete("/session/{session_id}", response_model=ChatResponse)
 async def delete_session(session_id: str):
     try:
-        # 使用update方法更新文档
-        result = es_client.client.update(
-            index=CHAT_INDEX,
-            id=session_id,
-            body={
-                "doc": {
-                    "is_delete": True
-                }
-            }
-        )
+        # 软删除，同时从创建日期的使用量汇总中减掉这个会话
+        if await es_client.soft_delete_chat_session(session_id):
+            # 会话可能是很早以前创建的，已经永久缓存的部门统计也要丢弃
+            analytics_cache.invalidate("users")
+            analytics_cache.invalidate("department_stats")
         
         return ChatResponse(
             success=True,
@@ -261,37 +307,41 @@ async def get_user_list(
         if password != SYS_PASSWORD:
             raise HTTPException(status_code=403, detail="Invalid system password")
 
-        # 构建聚合查询
-        query = {
-            "size": 0,  
-            "aggs": {
-                "unique_users": {
-                    "terms": {
-                        "field": "user_id",
-                        "size": size,
-                        "order": {"_count": "desc"}  # 按会话数量降序排序
+        async def load_users():
+            # 构建聚合查询
+            query = {
+                "size": 0,  
+                "aggs": {
+                    "unique_users": {
+                        "terms": {
+                            "field": "user_id",
+                            "size": size,
+                            "order": {"_count": "desc"}  # 按会话数量降序排序
+                        }
                     }
                 }
             }
-        }
 
-        # 执行查询
-        result = es_client.client.search(
-            index=CHAT_INDEX,
-            body=query
-        )
+            # 执行查询
+            result = await es_client.client.search(
+                index=CHAT_INDEX,
+                body=query
+            )
 
-        # 提取所有唯一的user_id
-        user_buckets = result.get("aggregations", {}).get("unique_users", {}).get("buckets", [])
-        
-        # 构造返回数据
-        users_data = [
-            {
-                "user_id": bucket["key"],
-                "session_count": bucket["doc_count"]
-            }
-            for bucket in user_buckets
-        ]
+            # 提取所有唯一的user_id
+            user_buckets = result.get("aggregations", {}).get("unique_users", {}).get("buckets", [])
+            
+            # 构造返回数据
+            return [
+                {
+                    "user_id": bucket["key"],
+                    "session_count": bucket["doc_count"]
+                }
+                for bucket in user_buckets
+            ]
+
+        # 会话每次保存都会更新时间，不能按天永久缓存，整体短时间缓存
+        users_data = await analytics_cache.get_open("users", size, load_users)
 
         return {
             "success": True,
@@ -321,57 +371,102 @@ async def get_user_list(
             }
         }
 
+# 日期范围明细接口返回的会话数上限
+DATE_RANGE_MAX_SESSIONS = 10000
+
+# 明细只返回这几个字段，查询时只取这些字段的 _source
+DATE_RANGE_SOURCE_FIELDS = ["user_id", "timestamp", "answer", "client_type"]
+
+def date_range_query(start: datetime, end: datetime, inclusive: bool) -> Dict[str, Any]:
+    # 聊天流记录中没有 is_delete 字段，这里只按时间过滤
+    return {
+        "range": {
+            "created_at": {
+                "gte": start,
+                "lte" if inclusive else "lt": end
+            }
+        }
+    }
+
+async def load_date_range_bucket(start: datetime, end: datetime, inclusive: bool) -> Dict[str, Any]:
+    """查询一个时间桶内的会话明细"""
+    indices = await es_client.chat_stream_indices(start, end)
+    if not indices:
+        return {"total": 0, "sessions": []}
+
+    query = {
+        "query": date_range_query(start, end, inclusive),
+        "sort": [
+            {"created_at": "desc"}
+        ],
+        "_source": DATE_RANGE_SOURCE_FIELDS,
+        "track_total_hits": True
+    }
+
+    result = await es_client.client.search(
+        index=",".join(indices),
+        body=query,
+        size=DATE_RANGE_MAX_SESSIONS
+    )
+
+    # 只提取需要的字段
+    sessions = []
+    
+    for hit in result["hits"]["hits"]:
+        sessions.append({
+            "user_id": hit["_source"].get("user_id"),
+            "timestamp": hit["_source"].get("timestamp"),
+            "user_question": hit["_source"].get("answer"),
+            "client_type": hit["_source"].get("client_type")
+        })
+    return {
+        "total": result["hits"]["total"]["value"],
+        "sessions": sessions
+    }
+
+async def count_date_range_bucket(start: datetime, end: datetime, inclusive: bool) -> Dict[str, Any]:
+    """只统计一个时间桶内的会话数，明细已经凑满上限时用于计算总数"""
+    indices = await es_client.chat_stream_indices(start, end)
+    if not indices:
+        return {"total": 0, "sessions": []}
+
+    result = await es_client.client.count(
+        index=",".join(indices),
+        body={"query": date_range_query(start, end, inclusive)}
+    )
+    return {
+        "total": result["count"],
+        "sessions": []
+    }
+
 # 获取日期范围内的会话明细
 @router.post("/sessions/date-range", response_model=ChatResponse)
 async def get_sessions_by_date_range(request: DateRangeRequest):
-    """获取指定日期范围内的所有会话"""
+    """
+    获取指定日期范围内的所有会话，按天分桶缓存，最多返回最新的 DATE_RANGE_MAX_SESSIONS 条
+    从最新的一天往前查，凑满上限之后更早的天只统计数量，不再加载明细
+    """
     try:
-        query = {
-            "query": {
-                "bool": {
-                    "must": [
-                        {
-                            "range": {
-                                "created_at": {
-                                    "gte": request.start_date,
-                                    "lte": request.end_date
-                                }
-                            }
-                        },
-                        {
-                            "term": {
-                                "is_delete": False
-                            }
-                        }
-                    ]
-                }
-            },
-            "sort": [
-                {"created_at": "desc"}
-            ]
-        }
-
-        result = es_client.client.search(
-            index=CHAT_STREAM_INDEX,
-            body=query,
-            size=10000  # 设置较大的size以获取更多结果
-        )
+        buckets = []
+        if request.end_date >= request.start_date:
+            buckets = list(reversed(split_days(request.start_date, request.end_date)))
 
-        # 只提取需要的字段
+        # 会话按时间降序返回
         sessions = []
-        
-        for hit in result["hits"]["hits"]:
-            # question = ""
-            # messages = hit["_source"].get("messages")
-            # if messages and len(messages) > 0:
-            #     question = messages[0]['content']
-            sessions.append({
-                "user_id": hit["_source"].get("user_id"),
-                "timestamp": hit["_source"].get("timestamp"),
-                "user_question": hit["_source"].get("answer"),
-                "client_type": hit["_source"].get("client_type")
-            })
-        total = result["hits"]["total"]["value"]
+        total = 0
+        for i in range(0, len(buckets), ANALYTICS_CACHE_CONCURRENCY):
+            if len(sessions) < DATE_RANGE_MAX_SESSIONS:
+                params, loader = None, load_date_range_bucket
+            else:
+                params, loader = "count", count_date_range_bucket
+            days = await asyncio.gather(*[
+                date_range_cache.get_bucket("date_range", params, bucket, loader)
+                for bucket in buckets[i:i + ANALYTICS_CACHE_CONCURRENCY]
+            ])
+            for day in days:
+                total += day["total"]
+                if len(sessions) < DATE_RANGE_MAX_SESSIONS:
+                    sessions.extend(day["sessions"][:DATE_RANGE_MAX_SESSIONS - len(sessions)])
 
         return ChatResponse(
             success=True,
@@ -391,10 +486,110 @@ async def get_sessions_by_date_range(request: DateRangeRequest):
         )
 
 
+# 默认导出的字段
+EXPORT_DEFAULT_FIELDS = [
+    "session_id",
+    "user_id",
+    "ai_type",
+    "question",
+    "answer",
+    "created_at",
+    "metadata.client_type"
+]
+
+# 导出日期范围内的聊天记录
+class DateRangeExportRequest(ProtectedDateRangeRequest):
+    format: str = Field(default="ndjson", description="导出格式：ndjson/csv")
+    fields: List[str] = Field(
+        default_factory=lambda: list(EXPORT_DEFAULT_FIELDS),
+        description="导出的字段，嵌套字段用.分隔，如 metadata.client_type"
+    )
+
+def get_field(source: Dict[str, Any], field: str) -> Any:
+    """按 a.b.c 的路径取嵌套字段"""
+    value = source
+    for key in field.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+def csv_line(values: List[Any]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow([
+        json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else ("" if value is None else value)
+        for value in values
+    ])
+    return buffer.getvalue()
+
+@router.post("/sessions/date-range/export")
+async def export_sessions_by_date_range(request: DateRangeExportRequest):
+    """
+    流式导出指定日期范围内的全部聊天记录（NDJSON 或 CSV）
+    用 point-in-time + search_after 分批遍历，内存占用与导出的总条数无关，不会截断
+    """
+    if request.password != SYS_PASSWORD:
+        raise HTTPException(status_code=403, detail="Invalid system password")
+    if request.format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {request.format}")
+    if not request.fields:
+        raise HTTPException(status_code=400, detail="fields must not be empty")
+
+    fields = request.fields
+    # 聊天流记录中没有 is_delete 字段，这里只按时间过滤
+    query = {
+        "range": {
+            "created_at": {
+                "gte": request.start_date,
+                "lte": request.end_date
+            }
+        }
+    }
+
+    # 只查询覆盖这个时间范围的滚动索引
+    indices = await es_client.chat_stream_indices(request.start_date, request.end_date)
+
+    async def stream_rows():
+        if request.format == "csv":
+            # 带BOM，方便Excel直接打开
+            yield ("\ufeff" + csv_line(fields)).encode("utf-8")
+        if not indices:
+            return
+        try:
+            async for hits in es_client.iter_search_pages(
+                ",".join(indices),
+                query,
+                [{"created_at": "asc"}],
+                source=fields
+            ):
+                sources = [hit["_source"] for hit in hits]
+                if "documents" in fields:
+                    # 记录中的 documents 只有 sid 引用，导出时按批一次补全元数据
+                    await es_client.hydrate_documents(sources)
+                for source in sources:
+                    values = [get_field(source, field) for field in fields]
+                    if request.format == "csv":
+                        yield csv_line(values).encode("utf-8")
+                    else:
+                        row = dict(zip(fields, values))
+                        yield (json.dumps(row, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+        except Exception as e:
+            # 响应头已经发出，只能记录错误并结束输出
+            print(f"Error exporting sessions: {str(e)}")
+            raise
+
+    media_type = "text/csv" if request.format == "csv" else "application/x-ndjson"
+    filename = f"sessions_{request.start_date:%Y%m%d}_{request.end_date:%Y%m%d}.{request.format}"
+    return StreamingResponse(
+        stream_rows(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 # 获取日期范围内的部门功能使用统计
 @router.post("/sessions/department-stats", response_model=ChatResponse)
-async def get_department_usage_stats(request: DateRangeRequest):
-    """获取指定日期范围内各部门各功能的使用统计"""
+async def get_department_usage_stats(request: ProtectedDateRangeRequest):
+    """获取指定日期范围内各部门各功能的使用统计（按创建日期统计的会话数），按天读取使用量汇总"""
     if request.password != SYS_PASSWORD:
         return ChatResponse(
             success=False,
@@ -403,66 +598,22 @@ async def get_department_usage_stats(request: DateRangeRequest):
         )
 
     try:
-        query = {
-            "size": 0,
-            "query": {
-                "bool": {
-                    "must": [
-                        {
-                            "range": {
-                                "timestamp": {
-                                    "gte": request.start_date,
-                                    "lte": request.end_date
-                                }
-                            }
-                        },
-                        {
-                            "term": {
-                                "is_delete": False
-                            }
-                        }
-                    ]
-                }
-            },
-            "aggs": {
-                "department_stats": {
-                    "terms": {
-                        "field": "user_id",
-                        "size": 1000
-                    },
-                    "aggs": {
-                        "ai_type_stats": {
-                            "terms": {
-                                "field": "ai_type",
-                                "size": 100
-                            }
-                        }
-                    }
-                }
-            }
-        }
-
-        result = es_client.client.search(
-            index=CHAT_INDEX,
-            body=query
+        # 汇总按天存储，每个桶只查桶所在的那一天；后台任务还在重算的最近几天不永久缓存
+        days = await analytics_cache.get_range(
+            "department_stats",
+            None,
+            request.start_date,
+            request.end_date,
+            lambda start, end, inclusive: usage_rollup.department_stats(start, start),
+            close_delay=USAGE_ROLLUP_RECENT_DAYS * 24 * 3600
         )
 
-        # 处理统计结果
         stats = {}
-        for dept_bucket in result["aggregations"]["department_stats"]["buckets"]:
-            user_id = dept_bucket["key"]
-            department = user_id.split("_")[0] if "_" in user_id else "unknown"
-            
-            if department not in stats:
-                stats[department] = {}
-            
-            for ai_type_bucket in dept_bucket["ai_type_stats"]["buckets"]:
-                ai_type = ai_type_bucket["key"]
-                count = ai_type_bucket["doc_count"]
-                
-                if ai_type not in stats[department]:
-                    stats[department][ai_type] = 0
-                stats[department][ai_type] += count
+        for day in days:
+            for department, ai_types in day.items():
+                department_stats = stats.setdefault(department, {})
+                for ai_type, count in ai_types.items():
+                    department_stats[ai_type] = department_stats.get(ai_type, 0) + count
 
         return ChatResponse(
             success=True,
@@ -495,7 +646,7 @@ async def get_user_settings(
         )
         
     try:
-        settings = es_client.get_user_settings(id)
+        settings = await es_client.get_user_settings(id)
         return ChatResponse(
             success=True,
             message="User settings retrieved successfully", 
@@ -531,8 +682,10 @@ async def update_user_settings(
         )
         
     try:
-        success = es_client.update_user_settings(request.id, request.json_data)
+        success = await es_client.update_user_settings(request.id, request.json_data)
         if success:
+            # 本进程缓存过的立即刷新，其它进程通过轮询更新
+            await settings_cache.refresh_if_cached(request.id)
             return ChatResponse(
                 success=True,
                 message="User settings updated successfully",
@@ -2,15 +2,36 @@ from fastapi import APIRouter
 import uuid
 from fastapi import APIRouter, HTTPException, Request, Header, Depends
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 import aiohttp
 import asyncio
 import json
-from typing import AsyncGenerator, Optional
-from config import CORS_ORIGINS, get_url
-from database.elasticsearch import es_client
+import time
+from typing import AsyncGenerator, List, Optional
+from pydantic import BaseModel, Field
+from config import (
+    CORS_ORIGINS,
+    CITATION_BATCH_CONCURRENCY,
+    CITATION_BATCH_MAX_ITEMS,
+    FRAGMENT_CACHE_MAX_BYTES,
+    FRAGMENT_CACHE_MAX_ITEMS,
+    FRAGMENT_CACHE_TTL,
+    get_url
+)
+from database.chat_log_writer import chat_log_writer
+from database.settings_cache import settings_cache
 from datetime import datetime
-import hashlib
 from auth import create_access_token, verify_token
+from http_client import http_client, iter_response, passthrough_length
+from cache import TTLCache
+from ndjson import NDJSONDecoder
+from degeneration import build_detector
+from pdf_cache import pdf_cache, cached_file_response
+from metrics import metrics
+from chat_streams import chat_streams, request_key, ChatStream, StreamGone
+from answer_cache import answer_cache, CachedAnswer
+from admission import admission, AdmissionRejected, AdmissionSlot
+from stream_pump import StreamPump, PumpedStreamingResponse
 
 router = APIRouter()
 
@@ -26,6 +47,158 @@ def is_subset(arr1, arr2):
     # 判断 set2 是否是 set1 的子集
     return set2.issubset(set1)
 
+async def run_chat_stream(
+    stream: ChatStream,
+    url: str,
+    data: dict,
+    slot: AdmissionSlot,
+    cache_key: Optional[str] = None
+):
+    """
+    读取上游的流式回答写入 stream，结束后为每个订阅者各记录一条聊天流日志
+    slot 为准入控制的名额，上游结束时释放；cache_key 不为空时，正常结束的回答写入回答缓存
+    """
+    # 回答按片段收集，存储时再拼接，避免长回答反复拼接字符串
+    answer_parts = []
+    result = {"documents": []}
+    detector = build_detector()
+
+    def collect_frame(content):
+        if not isinstance(content, dict):
+            return
+        if 'data' in content:
+            current_data = content['data']
+            answer_parts.append(current_data)
+            detector.feed(current_data)
+
+        if 'documents' in content:
+            result['documents'] = content['documents']
+
+    def store_chat_log():
+        # 不再接受新的订阅者，之后相同的请求会重新请求上游
+        chat_streams.release(stream)
+        answer = "".join(answer_parts)
+        for all_content in stream.log_entries:
+            chat_log_writer.store_chat_stream(**{**all_content, "answer": answer, "documents": result['documents']})
+
+    error = None
+    completed = False
+    try:
+        session = await http_client.session(url)
+        async with session.post(
+            url,
+            json=data,
+            headers={
+                "Accept": "text/event-stream",
+                "Content-Type": "application/json"
+            },
+            timeout=http_client.timeout("chat")
+        ) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                print(f"Error response: {error_text}")
+                error = f"Error forwarding request: {response.reason}"
+                stream.set_started(response.status, error)
+                # 上游返回错误的请求同样记录
+                store_chat_log()
+                return
+            stream.set_started()
+            upstream_began = time.monotonic()
+            decoder = NDJSONDecoder()
+            async for chunk in response.content.iter_any():
+                if chunk:
+                    stream.append(chunk)
+                    try:
+                        for content in decoder.feed(chunk):
+                            collect_frame(content)
+                    except Exception as e:
+                        # 其他未预期的异常
+                        print(f"Error processing content: {str(e)}")
+
+                    # 检测到输出退化（重复行）时中断连接
+                    if detector.tripped:
+                        print(f"Degenerate output detected: {detector.reason}")
+                        metrics.inc("chat_stream.degeneration_aborts")
+                        metrics.inc(f"chat_stream.degeneration_aborts.{detector.reason}")
+                        response.close()
+                        break
+            else:
+                for content in decoder.flush():
+                    collect_frame(content)
+            # 上游吞吐统计
+            upstream_seconds = max(time.monotonic() - upstream_began, 1e-6)
+            metrics.observe("chat_stream.upstream_bytes_per_second", stream.size / upstream_seconds)
+            metrics.observe("chat_stream.upstream_frames_per_second", decoder.frames / upstream_seconds)
+        store_chat_log()
+        completed = True
+
+    except aiohttp.ClientError as e:
+        print(f"Client error occurred: {str(e)}")
+        error = f"Service unavailable: {str(e)}"
+        stream.set_started(503, error)
+        store_chat_log()
+    except asyncio.CancelledError:
+        print("chat stream 被取消")
+        error = "cancelled"
+        store_chat_log()
+        raise
+    except asyncio.TimeoutError:
+        print("Request timed out")
+        error = "Request timed out"
+        stream.set_started(504, error)
+        store_chat_log()
+    except Exception as e:
+        print(f"Unexpected error occurred: {str(e)}")
+        error = f"Server error: {str(e)}"
+        stream.set_started(500, error)
+        store_chat_log()
+    finally:
+        slot.release()
+        chat_streams.release(stream)
+        stream.finish(error)
+
+    # 只缓存完整且没有退化的回答；日志已经记录过，这里失败只影响缓存
+    if completed and cache_key is not None and not detector.tripped and stream.size <= answer_cache.cache.max_bytes:
+        try:
+            body = await stream.read_all()
+        except StreamGone as e:
+            print(f"Answer not cached, stream {stream.stream_id} no longer buffered: {str(e)}")
+            return
+        answer_cache.put(cache_key, body, "".join(answer_parts), result['documents'])
+
+
+def stream_http_response(stream: ChatStream, offset: int) -> StreamingResponse:
+    """从 offset 开始把 stream 输出给客户端，客户端断开或读取太慢只结束本次输出，上游继续生成"""
+    return PumpedStreamingResponse(
+        StreamPump(stream, offset),
+        media_type="text/event-stream",
+        headers={
+            "X-Stream-Id": stream.stream_id,
+            "X-Stream-Offset": str(offset)
+        }
+    )
+
+def replay_cached_answer(cached: CachedAnswer, all_content: dict) -> StreamingResponse:
+    """重放缓存的回答，同样记录聊天流日志，也同样可以用 stream id 重连"""
+    chat_log_writer.store_chat_stream(**{
+        **all_content,
+        "answer": cached.answer,
+        "documents": cached.documents,
+        "metadata": {**all_content["metadata"], "answer_cache": True}
+    })
+    stream = chat_streams.create(all_content["user_id"])
+    stream.append(cached.body)
+    stream.finish()
+    return StreamingResponse(
+        answer_cache.replay(cached.body),
+        media_type="text/event-stream",
+        headers={
+            "X-Stream-Id": stream.stream_id,
+            "X-Stream-Offset": "0",
+            "X-Answer-Cache": "hit"
+        }
+    )
+
 @router.post("/chat_stream")
 async def forward_request(request: Request, user = Depends(verify_token)):
     try:
@@ -41,17 +214,12 @@ async def forward_request(request: Request, user = Depends(verify_token)):
                 raise HTTPException(status_code=400, detail=f"Missing required field: {field}")
         url = get_url(data['with_remote_context'], "CHAT_STREAM")
 
-        settings = es_client.get_user_settings('system_prompt')
-        
-        if settings:
-            try:
-                settings = json.loads(settings)
-                # 使用 dict.get() 方法代替直接访问,如果key不存在返回None
-                data['additional_prompt'] = settings.get('prompt')
-            except json.JSONDecodeError:
-                print("Failed to parse system_prompt settings JSON")
-            except Exception as e:
-                print(f"Error processing system_prompt settings: {str(e)}")
+        # system_prompt 设置缓存在进程内，不再每个请求都查询ES
+        settings, prompt_version = await settings_cache.system_prompt()
+
+        if isinstance(settings, dict):
+            # 使用 dict.get() 方法代替直接访问,如果key不存在返回None
+            data['additional_prompt'] = settings.get('prompt')
 
         if isinstance(user, str):
             # 按照_分割user
@@ -70,262 +238,412 @@ async def forward_request(request: Request, user = Depends(verify_token)):
         if 'client_type' not in data:
             data['client_type'] = "api"
 
+        # no_cache 只用于本服务，不转发给上游
+        no_cache = bool(data.pop('no_cache', False))
+
         mini_log("/chat_starem", url, "POST", data)
 
-        timeout = aiohttp.ClientTimeout(total=600, connect=60)
-        
-        async def stream_response() -> AsyncGenerator[bytes, None]:
-            user_id = user
-            # 如果user_id 不是字符串
-            if not isinstance(user, str):
-                user_id = user['username']
-
-            all_content = {
-                "session_id": str(uuid.uuid4()),
-                "user_id": user_id,
-                "ai_type": data['with_remote_context'],
-                "question": data['question'],
-                "answer": "",
-                "documents": [],
-                "model": "",
-                "metadata": data
-            }
+        user_id = user
+        # 如果user_id 不是字符串
+        if not isinstance(user, str):
+            user_id = user['username']
+
+        all_content = {
+            "session_id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "ai_type": data['with_remote_context'],
+            "question": data['question'],
+            "answer": "",
+            "documents": [],
+            "model": "",
+            # 记录本次使用的 system_prompt 版本
+            "metadata": {**data, "prompt_version": prompt_version}
+        }
+
+        key = request_key(data, prompt_version)
+
+        # 完全相同的问题直接重放缓存的回答
+        cache_key = None
+        if answer_cache.enabled:
+            if no_cache:
+                metrics.inc("answer_cache.bypass")
+            else:
+                cache_key = answer_cache.key(key)
+                cached = answer_cache.get(cache_key)
+                if cached is not None:
+                    return replay_cached_answer(cached, all_content)
+
+        # 相同的请求正在生成时直接加入，共用一次上游生成
+        stream = chat_streams.attach(key, user_id, all_content)
+        if stream is None:
+            # 需要新开上游连接时才占用准入名额（user_id 对API调用方即为token）
+            # 限额类型按认证方式决定：API token 为 api，登录用户（JWT）为 web，不信任请求中的 client_type
+            principal_type = "api" if isinstance(user, str) else "web"
             try:
-                async with aiohttp.ClientSession(timeout=timeout) as session:
-                    async with session.post(
-                        url,
-                        json=data,
-                        headers={
-                            "Accept": "text/event-stream",
-                            "Content-Type": "application/json"
-                        }
-                    ) as response:
-                        if response.status != 200:
-                            error_text = await response.text()
-                            print(f"Error response: {error_text}")
-                            raise HTTPException(
-                                status_code=response.status,
-                                detail=f"Error forwarding request: {response.reason}"
-                            )
-                        last_chunk = ""
-                        async for chunk in response.content.iter_any():
-                            if chunk:
-                                yield chunk
-                                try:
-                                    last_chunk += chunk.decode('utf-8', errors='ignore')
-                                    lines = last_chunk.splitlines()
-                                    for chunk_item in lines:
-                                        if chunk_item:
-                                            last_chunk = chunk_item
-                                            content = json.loads(chunk_item)
-                                            if 'data' in content:
-                                                current_data = content['data']
-                                                all_content['answer'] += current_data
-                                                            
-                                            if 'documents' in content:
-                                                all_content['documents'] = content['documents']
-                                    last_chunk = ""
-                                except json.JSONDecodeError:
-                                    # JSON 解析失败时的处理
-                                    print(f"Failed to parse content JSON: {last_chunk}")
-                                except Exception as e:
-                                        # 其他未预期的异常
-                                    print(f"Error processing content: {str(e)}")
-                                                
-                                # 当内容超过1000字时检查重复行
-                                if len(all_content['answer']) > 1000:
-                                    lines = all_content['answer'].split("\n")
-                                    last_line = lines[-1]
-                                    if len(last_line) >= 5:
-                                        repeat_count = 0
-                                        for line in lines[:-1]:
-                                            if line == last_line:
-                                                repeat_count += 1
-                                        if repeat_count >= 2:
-                                            # 中断连接
-                                            response.close()
-                                            break
-                        es_client.store_chat_stream(**all_content)
-            
-            except aiohttp.ClientError as e:
-                print(f"Client error occurred: {str(e)}")
-                es_client.store_chat_stream(**all_content)
-                raise HTTPException(status_code=503, detail=f"Service unavailable: {str(e)}")
-            except asyncio.CancelledError:
-                print("客户端断开连接")
-                es_client.store_chat_stream(**all_content)
-            except asyncio.TimeoutError:
-                print("Request timed out")
-                es_client.store_chat_stream(**all_content)
-                raise HTTPException(status_code=504, detail="Request timed out")
-            except Exception as e:
-                print(f"Unexpected error occurred: {str(e)}")
-                es_client.store_chat_stream(**all_content)
-                raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
-
-        return StreamingResponse(
-            stream_response(),
-            media_type="text/event-stream"
-        )
+                slot = await admission.acquire(user_id, principal_type)
+            except AdmissionRejected as e:
+                raise HTTPException(
+                    status_code=429,
+                    detail=f"Too many concurrent requests: {e.reason}",
+                    headers={"Retry-After": str(e.retry_after)}
+                )
+            # 排队期间相同的请求可能已经开始生成
+            stream = chat_streams.attach(key, user_id, all_content)
+            if stream is not None:
+                slot.release()
+            else:
+                # 上游读取在独立的任务中进行，客户端断开不会中断生成，可以用 stream id 重连续读
+                stream = chat_streams.create(user_id, key)
+                stream.log_entries.append(all_content)
+                stream.task = asyncio.create_task(run_chat_stream(stream, url, data, slot, cache_key))
+
+        status, detail = await stream.started
+        if status != 200:
+            raise HTTPException(status_code=status, detail=detail)
+
+        return stream_http_response(stream, 0)
     except HTTPException as e:
         raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
-@router.get("/para/{ai_type}/{para_id}")
-async def get_para_info(ai_type:str, para_id: str, user = Depends(verify_token)):
+@router.get("/chat_stream/{stream_id}")
+async def resume_chat_stream(
+    stream_id: str,
+    offset: Optional[int] = None,
+    last_event_id: Optional[str] = Header(default=None),
+    user = Depends(verify_token)
+):
+    """
+    断线重连：从已收到的字节数继续读取同一个回答，不会再次请求上游
+    偏移量用 offset 参数或 Last-Event-ID 请求头（字节数）传入
+    """
+    stream = chat_streams.get(stream_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail="Stream not found or expired")
+    user_id = user if isinstance(user, str) else user['username']
+    if user_id not in stream.owners:
+        raise HTTPException(status_code=403, detail="Stream belongs to another user")
+
+    if offset is None:
+        try:
+            offset = int(last_event_id) if last_event_id else 0
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    if offset < 0 or offset > stream.size:
+        raise HTTPException(status_code=416, detail=f"Offset out of range, stream size: {stream.size}")
+    try:
+        # 确认偏移量仍可读
+        await stream.read(offset, 0)
+    except StreamGone as e:
+        raise HTTPException(status_code=410, detail=str(e))
+
+    metrics.inc("chat_stream.resumed")
+    return stream_http_response(stream, offset)
+
+
+async def request_para_info(ai_type: str, para_id: str):
+    """从上游获取段落信息"""
     headers = {"Content-Type": "application/json"}
 
     url = f"{get_url(ai_type, 'PARA_INFO')}/{ai_type}/{para_id}"
     
     mini_log(f"/para/{ai_type}/{para_id}", url, "GET")
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status != 200:
-                raise HTTPException(
-                    status_code=response.status,
-                    detail=f"Target server returned {response.status}"
-                )
-            return await response.json()
+    session = await http_client.session(url)
+    async with session.get(url, headers=headers, timeout=http_client.timeout("fragment")) as response:
+        if response.status != 200:
+            raise HTTPException(
+                status_code=response.status,
+                detail=f"Target server returned {response.status}"
+            )
+        return await response.json()
 
-@router.get("/page_text/{ai_type}/{para_id}")
-async def get_text_para_info(ai_type:str, para_id: str, user = Depends(verify_token)):
+async def request_page_content(keywords: str, ai_type: str, para_id: str):
+    """从上游获取页面文本/html，keywords 为 PAGE_TEXT_INFO 或 PAGE_HTML_INFO"""
     headers = {"Content-Type": "text/plain"}
-    url = f"{get_url(ai_type, 'PAGE_TEXT_INFO')}/{ai_type}/{para_id}"
+    url = f"{get_url(ai_type, keywords)}/{ai_type}/{para_id}"
+
+    mini_log(f"/{keywords.lower().replace('_info', '')}/{ai_type}/{para_id}", url, "GET")
+    session = await http_client.session(url)
+    async with session.get(url, headers=headers, timeout=http_client.timeout("fragment")) as response:
+        if response.status != 200:
+            raise HTTPException(
+                status_code=response.status,
+                detail=f"Target server returned {response.status}"
+            )
+        text_content = await response.text()
+        # 根据需要对text_content进行处理
+        return text_content
 
-    mini_log(f"/page_text/{ai_type}/{para_id}", url, "GET")
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status != 200:
-                raise HTTPException(
-                    status_code=response.status,
-                    detail=f"Target server returned {response.status}"
-                )
-            text_content = await response.text()
-            # 根据需要对text_content进行处理
-            return text_content
+async def request_index_info(keywords: str, data: dict):
+    """从上游获取表格/图片信息，keywords 为 TABLE_INFO 或 FIGURE_INFO"""
+    headers = {"Content-Type": "application/json"}
+    url = get_url(data['index_name'], keywords)
+
+    mini_log(f"/{keywords.lower()}", url, "POST", data)
+    session = await http_client.session(url)
+    async with session.post(
+        url=url,
+        headers=headers,
+        json=data,
+        timeout=http_client.timeout("index")
+    ) as response:
+        if response.status != 200:
+            raise HTTPException(
+                status_code=response.status,
+                detail=f"Target server returned {response.status}"
+            )
+        return await response.json()
+
+# 段落/页面/表格/图片信息对同一个 (ai_type, id) 是不变的，缓存在进程内
+fragment_cache = TTLCache(
+    "fragment",
+    max_bytes=FRAGMENT_CACHE_MAX_BYTES,
+    max_items=FRAGMENT_CACHE_MAX_ITEMS,
+    ttl=FRAGMENT_CACHE_TTL
+)
+metrics.register("fragment_cache", fragment_cache.stats)
+
+async def fetch_para_info(ai_type: str, para_id: str):
+    return await fragment_cache.get_or_load(
+        ("PARA_INFO", ai_type, para_id),
+        lambda: request_para_info(ai_type, para_id)
+    )
+
+async def fetch_page_content(keywords: str, ai_type: str, para_id: str):
+    return await fragment_cache.get_or_load(
+        (keywords, ai_type, para_id),
+        lambda: request_page_content(keywords, ai_type, para_id)
+    )
+
+async def fetch_index_info(keywords: str, data: dict):
+    return await fragment_cache.get_or_load(
+        (keywords, json.dumps(data, sort_keys=True, ensure_ascii=False)),
+        lambda: request_index_info(keywords, data)
+    )
 
-@router.get("/page_html/{ai_type}/{para_id}")
-async def get_text_para_info(ai_type:str, para_id: str, user = Depends(verify_token)):
-    headers = {"Content-Type": "text/plain"}
-    url = f"{get_url(ai_type, 'PAGE_HTML_INFO')}/{ai_type}/{para_id}"
+@router.get("/para/{ai_type}/{para_id}")
+async def get_para_info(ai_type:str, para_id: str, user = Depends(verify_token)):
+    return await fetch_para_info(ai_type, para_id)
 
-    mini_log(f"/page_html/{ai_type}/{para_id}", url, "GET")
+@router.get("/page_text/{ai_type}/{para_id}")
+async def get_text_para_info(ai_type:str, para_id: str, user = Depends(verify_token)):
+    return await fetch_page_content('PAGE_TEXT_INFO', ai_type, para_id)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status != 200:
-                raise HTTPException(
-                    status_code=response.status,
-                    detail=f"Target server returned {response.status}"
-                )
-            text_content = await response.text()
-            # 根据需要对text_content进行处理
-            return text_content
+@router.get("/page_html/{ai_type}/{para_id}")
+async def get_html_para_info(ai_type:str, para_id: str, user = Depends(verify_token)):
+    return await fetch_page_content('PAGE_HTML_INFO', ai_type, para_id)
 
 @router.post("/table_info")
 async def get_table_info(request: Request, user = Depends(verify_token)):
     data = await request.json()
-    timeout = aiohttp.ClientTimeout(total=30)
-    headers = {"Content-Type": "application/json"}
-    
-    url = get_url(data['index_name'], "TABLE_INFO")
-
-    mini_log(f"/table_info", url, "POST", data)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.post(
-            url=url,
-            headers=headers,
-            json=data
-        ) as response:
-            if response.status != 200:
-                raise HTTPException(
-                    status_code=response.status,
-                    detail=f"Target server returned {response.status}"
-                )
-            return await response.json()
+    return await fetch_index_info("TABLE_INFO", data)
 
 @router.post("/figure_info")
 async def get_figure_info(request: Request, user = Depends(verify_token)):
     data = await request.json()
-    timeout = aiohttp.ClientTimeout(total=30)
-    headers = {"Content-Type": "application/json"}
-    url = get_url(data['index_name'], "FIGURE_INFO")
-    
-    mini_log(f"/figure_info", url, "POST", data)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.post(
-            url=url,
-            headers=headers,
-            json=data
-        ) as response:
-            if response.status != 200:
-                raise HTTPException(
-                    status_code=response.status,
-                    detail=f"Target server returned {response.status}"
-                )
-            return await response.json()
+    return await fetch_index_info("FIGURE_INFO", data)
+
+# 批量解析引用时单个条目的请求
+class CitationItem(BaseModel):
+    type: str = Field(..., description="引用类型：para/table/figure")
+    id: str = Field(..., description="段落/表格/图片ID")
+    index_name: str = Field(..., description="所属index")
+    key: Optional[str] = Field(default=None, description="客户端自定义的标识，原样返回")
+
+class BatchCitationRequest(BaseModel):
+    items: List[CitationItem] = Field(..., description="引用列表")
+
+async def resolve_citation(item: CitationItem):
+    """解析单个引用，直接返回上游的响应内容"""
+    if item.type == "para":
+        return await fetch_para_info(item.index_name, item.id)
+    if item.type in ("table", "figure"):
+        data = {
+            "index_name": item.index_name,
+            "collection_name": item.index_name,
+            "query": item.id
+        }
+        keywords = "TABLE_INFO" if item.type == "table" else "FIGURE_INFO"
+        return await fetch_index_info(keywords, data)
+    raise HTTPException(status_code=400, detail=f"Unknown citation type: {item.type}")
+
+async def resolve_citation_result(index: int, item: CitationItem, semaphore: asyncio.Semaphore) -> dict:
+    """在并发限制下解析引用，并把结果或错误包装成统一结构"""
+    result = {
+        "index": index,
+        "key": item.key,
+        "type": item.type,
+        "id": item.id,
+        "success": True,
+        "data": None,
+        "error": None
+    }
+    try:
+        async with semaphore:
+            result["data"] = await resolve_citation(item)
+    except HTTPException as e:
+        result["success"] = False
+        result["error"] = {"status_code": e.status_code, "detail": e.detail}
+    except asyncio.TimeoutError:
+        result["success"] = False
+        result["error"] = {"status_code": 504, "detail": "Request timed out"}
+    except Exception as e:
+        result["success"] = False
+        result["error"] = {"status_code": 502, "detail": str(e)}
+    return result
+
+def check_batch_size(batch: BatchCitationRequest):
+    if len(batch.items) > CITATION_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many items: {len(batch.items)} > {CITATION_BATCH_MAX_ITEMS}"
+        )
+
+@router.post("/citations")
+async def batch_citations(batch: BatchCitationRequest, user = Depends(verify_token)):
+    """批量解析段落/表格/图片引用，全部完成后一次性返回，结果顺序与请求一致"""
+    check_batch_size(batch)
+    semaphore = asyncio.Semaphore(CITATION_BATCH_CONCURRENCY)
+    results = await asyncio.gather(*[
+        resolve_citation_result(index, item, semaphore)
+        for index, item in enumerate(batch.items)
+    ])
+    return {
+        "total": len(results),
+        "failed": sum(1 for result in results if not result["success"]),
+        "items": results
+    }
+
+@router.post("/citations/stream")
+async def batch_citations_stream(batch: BatchCitationRequest, user = Depends(verify_token)):
+    """批量解析引用，每解析完一条就以NDJSON输出一行，按完成顺序返回"""
+    check_batch_size(batch)
+    semaphore = asyncio.Semaphore(CITATION_BATCH_CONCURRENCY)
+
+    async def stream_results() -> AsyncGenerator[bytes, None]:
+        tasks = [
+            asyncio.ensure_future(resolve_citation_result(index, item, semaphore))
+            for index, item in enumerate(batch.items)
+        ]
+        try:
+            for future in asyncio.as_completed(tasks):
+                result = await future
+                yield (json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8")
+        finally:
+            # 客户端断开时取消尚未完成的请求
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    return StreamingResponse(
+        stream_results(),
+        media_type="application/x-ndjson"
+    )
+
+async def open_file_stream(url: str) -> aiohttp.ClientResponse:
+    """请求上游文件，非200时释放连接并抛出异常"""
+    response = await http_client.open("GET", url, "file")
+    if response.status != 200:
+        response.release()
+        raise HTTPException(status_code=response.status, detail="无法获取文件")
+    return response
+
+def upstream_filename(response: aiohttp.ClientResponse, default: str) -> str:
+    content_disposition = response.headers.get('Content-Disposition')
+    return content_disposition.split('filename=')[-1].strip('"') if content_disposition else default
 
 @router.get("/table_figure/{ai_type}/{para_id}")
 async def table_figure(ai_type: str, para_id: str):
     url = f"{get_url(ai_type, 'TABLE_FILE')}/{ai_type}/{para_id}"
 
     mini_log(f"/table_figure/{ai_type}/{para_id}", url, "GET")
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status != 200:
-                raise HTTPException(status_code=response.status, detail="无法获取文件")
-            
-            content_type = response.headers.get('Content-Type', 'application/octet-stream')
-            content_disposition = response.headers.get('Content-Disposition')
-            filename = content_disposition.split('filename=')[-1].strip('"') if content_disposition else para_id
-            
-            file_content = await response.read()
-            
-            response = StreamingResponse(
-                iter([file_content]),
-                media_type=content_type
-            )
-            response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
-            
-            return response
+    response = await open_file_stream(url)
+
+    content_type = response.headers.get('Content-Type', 'application/octet-stream')
+    filename = upstream_filename(response, para_id)
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    content_length = passthrough_length(response)
+    if content_length:
+        headers["Content-Length"] = content_length
+
+    # 上游数据边读边转发，不在内存中缓存整个文件
+    return StreamingResponse(
+        iter_response(response),
+        media_type=content_type,
+        headers=headers,
+        background=BackgroundTask(response.release)
+    )
 
 @router.get("/pdf/page_pdf/{para_id}/{page_num}/{ai_type}")
-async def table_figure(para_id: str, page_num: str, ai_type: str):
+async def page_pdf(request: Request, para_id: str, page_num: str, ai_type: str):
+    cache_key = (ai_type, para_id, page_num)
+    headers = {
+        # 设置缓存控制头
+        "Cache-Control": "public, max-age=720000"
+    }
+
+    entry = pdf_cache.lookup(cache_key)
+    if entry is not None:
+        metrics.inc("pdf_cache.hits")
+        headers["Content-Disposition"] = f'inline; filename="{entry.filename}"'
+        return cached_file_response(request, entry, headers)
+
+    metrics.inc("pdf_cache.misses")
     url = f"{get_url(ai_type, 'PDF_FILE')}/{para_id}/{page_num}"
 
     mini_log(f"/pdf/page_pdf/{para_id}/{page_num}", url, "GET")
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status != 200:
-                raise HTTPException(status_code=response.status, detail="无法获取文件")
-            
-            content_type = response.headers.get('Content-Type', 'application/pdf')
-            content_disposition = response.headers.get('Content-Disposition')
-            filename = content_disposition.split('filename=')[-1].strip('"') if content_disposition else para_id
-            
-            file_content = await response.read()
+    response = await open_file_stream(url)
 
-            # 计算文件的哈希值作为 ETag
-            etag = hashlib.md5(file_content).hexdigest()
+    content_type = response.headers.get('Content-Type', 'application/pdf')
+    filename = upstream_filename(response, para_id)
+    headers["Content-Disposition"] = f'inline; filename="{filename}"'
+    content_length = passthrough_length(response)
+    if content_length:
+        headers["Content-Length"] = content_length
 
-            async def file_iterator(content):
-                chunk_size = 1024
-                for i in range(0, len(content), chunk_size):
-                    yield content[i:i + chunk_size]
-
-            stream_response = StreamingResponse(
-                file_iterator(file_content),
-                media_type=content_type
-            )
-            stream_response.headers["Content-Disposition"] = f'inline; filename="{filename}"'
-            # 设置缓存控制头
-            stream_response.headers["Cache-Control"] = "public, max-age=720000"
-            stream_response.headers["ETag"] = etag
-
-            return stream_response
+    # 缓存写不了（磁盘满、没有权限等）时只转发，不影响请求
+    try:
+        writer = await pdf_cache.writer(cache_key, content_type, filename)
+    except OSError as e:
+        print(f"PDF cache unavailable: {str(e)}")
+        writer = None
+
+    async def tee_to_cache() -> AsyncGenerator[bytes, None]:
+        """
+        未命中时边转发边写缓存（增量计算md5），第一个字节不用等整个文件下载完；
+        ETag（内容md5）在写完后才知道，之后的请求命中缓存时返回
+        """
+        cache_writer = writer
+        committed = False
+        try:
+            async for chunk in iter_response(response):
+                if cache_writer is not None:
+                    try:
+                        await cache_writer.write(chunk)
+                    except OSError as e:
+                        print(f"PDF cache write failed, streaming without cache: {str(e)}")
+                        cache_writer.abort()
+                        cache_writer = None
+                yield chunk
+            if cache_writer is not None:
+                try:
+                    await cache_writer.commit()
+                    committed = True
+                except OSError as e:
+                    print(f"PDF cache commit failed: {str(e)}")
+        finally:
+            if cache_writer is not None and not committed:
+                cache_writer.abort()
+
+    return StreamingResponse(
+        tee_to_cache(),
+        media_type=content_type,
+        headers=headers,
+        background=BackgroundTask(response.release)
+    )
 
 @router.post("/page")
 async def proxy_request(request: Request):
@@ -333,26 +651,26 @@ async def proxy_request(request: Request):
     url = get_url(body['index_name'], 'PAGE_INFO')
     
     mini_log(f"/page", url, "POST", body)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            url=url,
-            json=body
-        ) as response:
-            return await response.json()
+    session = await http_client.session(url)
+    async with session.post(
+        url=url,
+        json=body,
+        timeout=http_client.timeout("fragment")
+    ) as response:
+        return await response.json()
 
 @router.get("/bigdata/{content}/{ai_type}")
 async def big_data(content: str, ai_type: str):
     headers = {"Content-Type": "application/json"}
     url = f"{get_url(ai_type, 'BIGDATA_QUERY')}/{content}"
-    timeout = aiohttp.ClientTimeout(total=300)
 
     mini_log(f"/bigdata/{content}", url, "GET")
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status != 200:
-                raise HTTPException(
-                    status_code=response.status,
-                    detail=f"Target server returned {response.status}"
-                )
-            return await response.json()
+    session = await http_client.session(url)
+    async with session.get(url, headers=headers, timeout=http_client.timeout("bigdata")) as response:
+        if response.status != 200:
+            raise HTTPException(
+                status_code=response.status,
+                detail=f"Target server returned {response.status}"
+            )
+        return await response.json()
 
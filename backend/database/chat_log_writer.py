@@ -0,0 +1,266 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from config import (
+    CHAT_LOG_QUEUE_SIZE,
+    CHAT_LOG_BATCH_SIZE,
+    CHAT_LOG_FLUSH_INTERVAL,
+    CHAT_LOG_MAX_RETRIES,
+    CHAT_LOG_SPILL_PATH,
+)
+from database.elasticsearch import es_client, ESClient, CHAT_STREAM_ALIAS, collect_documents, document_refs
+from analytics_cache import date_range_cache
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ChatLogWriter:
+    """
+    聊天流记录的异步批量写入
+    请求协程只把文档放进有界队列就返回，后台任务按条数/时间攒批后用 _bulk 写入ES；
+    写入失败时指数退避重试，仍然失败或队列已满时落盘到本地文件，ES恢复后再补写
+    落盘和补写的文件读写都在线程中执行，不阻塞事件循环
+    """
+
+    def __init__(
+        self,
+        index: str,
+        queue_size: int,
+        batch_size: int,
+        flush_interval: float,
+        max_retries: int,
+        spill_path: str
+    ):
+        self.index = index
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.spill_path = spill_path
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # 已经从队列取出、还没交给 _flush 的记录，任务被取消时由 stop 写入
+        self._batch: List[Dict[str, Any]] = []
+        self._last_replay = 0.0
+        # 落盘文件的追加、改名都在线程中进行，用锁保证整行写入、改名时没有写到一半的记录
+        self._spill_lock = threading.Lock()
+
+    def store_chat_stream(self, **kwargs) -> bool:
+        """与 ESClient.store_chat_stream 参数相同，但只入队不等待写入"""
+        return self.submit(ESClient.build_chat_stream_doc(**kwargs))
+
+    def submit(self, doc: Dict[str, Any]) -> bool:
+        if self._queue is None:
+            # 后台任务还没启动时先落盘，启动后补写
+            self._write_spill([doc])
+            return False
+        try:
+            self._queue.put_nowait(doc)
+            metrics.inc("chat_log.submitted")
+            return True
+        except asyncio.QueueFull:
+            metrics.inc("chat_log.queue_full")
+            # 请求协程不等待落盘，交给线程池写入，失败时在 _write_spill 中计数和记录日志
+            asyncio.get_running_loop().run_in_executor(None, self._write_spill, [doc])
+            return False
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._task = asyncio.create_task(self._run())
+        metrics.register("chat_log", self.stats)
+
+    async def stop(self):
+        """应用关闭时调用，写完队列中剩余的记录"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        remaining = self._batch
+        self._batch = []
+        while not self._queue.empty():
+            remaining.append(self._queue.get_nowait())
+        for start in range(0, len(remaining), self.batch_size):
+            await self._flush(remaining[start:start + self.batch_size], max_retries=1)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "spilled_file_bytes": os.path.getsize(self.spill_path) if os.path.exists(self.spill_path) else 0
+        }
+
+    async def _run(self):
+        # ES就绪后先补写上次落盘的记录，未就绪期间提交的记录留在队列中（队列满时落盘）
+        await es_client.wait_ready()
+        await self._replay_spill()
+        while True:
+            await self._next_batch()
+            # _flush 被取消时自己会落盘，交出去之后不再由 stop 处理
+            batch = self._batch
+            self._batch = []
+            if batch:
+                written = await self._flush(batch, self.max_retries)
+                if written and time.monotonic() - self._last_replay > self.flush_interval * 30:
+                    await self._replay_spill()
+
+    async def _next_batch(self):
+        """等待第一条记录，然后在 flush_interval 内尽量攒满一批，放在 self._batch"""
+        batch = self._batch
+        batch.append(await self._queue.get())
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    async def _flush(self, batch: List[Dict[str, Any]], max_retries: int) -> bool:
+        """写入一批记录，返回是否全部写入成功"""
+        # 文档元数据先按 sid 批量写入，之后记录中只保存 sid 引用
+        pending = batch
+        documents = collect_documents(doc.get("documents") for doc in batch)
+        stored = None
+        delay = 0.5
+        for attempt in range(max_retries):
+            try:
+                if stored is None:
+                    stored = await es_client.save_documents(documents) if documents else set()
+                # 元数据没有保存成功的文档在记录中保留完整内容
+                pending = await es_client.bulk_index(
+                    self.index,
+                    [{**doc, "documents": document_refs(doc.get("documents"), stored)} for doc in pending]
+                )
+            except asyncio.CancelledError:
+                # 任务正在被取消，同步落盘，保证任务结束前写完
+                self._write_spill(pending)
+                raise
+            except Exception as e:
+                logger.error(f"Error flushing chat log (attempt {attempt + 1}): {str(e)}")
+            if not pending:
+                metrics.inc("chat_log.written", len(batch))
+                # 日期范围明细按聊天流记录统计，丢弃今天的缓存
+                date_range_cache.invalidate("date_range", open_only=True)
+                return True
+            metrics.inc("chat_log.retries")
+            if attempt + 1 < max_retries:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+        metrics.inc("chat_log.written", len(batch) - len(pending))
+        await asyncio.to_thread(self._write_spill, pending)
+        return False
+
+    def _write_spill(self, docs: List[Dict[str, Any]]):
+        """ES不可用时把记录追加到本地文件（同步，在线程中调用）"""
+        if not docs:
+            return
+        try:
+            lines = "".join(json.dumps(doc, ensure_ascii=False, default=str) + "\n" for doc in docs)
+            with self._spill_lock:
+                directory = os.path.dirname(self.spill_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.spill_path, "a", encoding="utf-8") as f:
+                    f.write(lines)
+            metrics.inc("chat_log.spilled", len(docs))
+        except Exception as e:
+            metrics.inc("chat_log.dropped", len(docs))
+            logger.error(f"Error spilling chat log, {len(docs)} records dropped: {str(e)}")
+
+    def _claim_spill(self, replay_path: str) -> bool:
+        """
+        把落盘文件改名为补写文件，之后的落盘写入新文件；返回是否有需要补写的文件
+        上次补写到一半进程退出留下的补写文件先补写，不覆盖
+        """
+        if os.path.exists(replay_path):
+            return True
+        with self._spill_lock:
+            try:
+                os.replace(self.spill_path, replay_path)
+            except OSError:
+                return False
+        return True
+
+    def _read_spill_batch(self, f: BinaryIO) -> Tuple[List[Dict[str, Any]], int]:
+        """从补写文件读取最多 batch_size 条记录，返回记录和读完后的文件位置"""
+        docs = []
+        while len(docs) < self.batch_size:
+            line = f.readline()
+            if not line:
+                break
+            line = line.strip()
+            if line:
+                try:
+                    docs.append(json.loads(line))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    metrics.inc("chat_log.dropped")
+        return docs, f.tell()
+
+    def _respill_from(self, replay_path: str, position: int):
+        """补写被中断时，把补写文件中 position 之后还没补写的部分放回落盘文件"""
+        try:
+            with self._spill_lock, open(replay_path, "rb") as src, open(self.spill_path, "ab") as dst:
+                src.seek(position)
+                shutil.copyfileobj(src, dst)
+        except OSError as e:
+            logger.error(f"Error restoring unreplayed chat log records from {replay_path}: {str(e)}")
+
+    async def _replay_spill(self):
+        """
+        把之前落盘的记录补写到ES，补写失败的会重新落盘
+        按 batch_size 逐批读取和补写，内存中只保留一批记录
+        """
+        self._last_replay = time.monotonic()
+        replay_path = f"{self.spill_path}.replay"
+        if not await asyncio.to_thread(self._claim_spill, replay_path):
+            return
+
+        f = await asyncio.to_thread(open, replay_path, "rb")
+        # 已经交给 _flush 的记录之后的文件位置
+        position = 0
+        replayed = 0
+        try:
+            while True:
+                docs, next_position = await asyncio.to_thread(self._read_spill_batch, f)
+                if not docs:
+                    break
+                position = next_position
+                await self._flush(docs, max_retries=1)
+                replayed += len(docs)
+        except asyncio.CancelledError:
+            # 当前批次已在 _flush 中落盘，这里只需放回还没开始补写的部分
+            self._respill_from(replay_path, position)
+            raise
+        finally:
+            f.close()
+            try:
+                os.remove(replay_path)
+            except OSError as e:
+                logger.error(f"Error removing chat log replay file {replay_path}: {str(e)}")
+        if replayed:
+            logger.info(f"Replayed {replayed} spilled chat log records")
+
+
+# 创建全局单例实例
+chat_log_writer = ChatLogWriter(
+    CHAT_STREAM_ALIAS,
+    queue_size=CHAT_LOG_QUEUE_SIZE,
+    batch_size=CHAT_LOG_BATCH_SIZE,
+    flush_interval=CHAT_LOG_FLUSH_INTERVAL,
+    max_retries=CHAT_LOG_MAX_RETRIES,
+    spill_path=CHAT_LOG_SPILL_PATH
+)
@@ -1,15 +1,60 @@
-from elasticsearch import Elasticsearch
-from config import ES_HOST
-from datetime import datetime
-from typing import Dict, Any, List
+import asyncio
+import base64
+import json
+from elasticsearch import AsyncElasticsearch, ConflictError, Elasticsearch, NotFoundError, helpers
+from elasticsearch.serializer import JsonSerializer
+from config import ES_HOST, ES_CONNECTIONS_PER_NODE, ES_REQUEST_TIMEOUT, ES_MAX_RETRIES, SESSION_PREVIEW_LENGTH
+from config import ES_STARTUP_TIMEOUT, ES_BOOTSTRAP_MAX_BACKOFF, READINESS_PING_TIMEOUT
+from config import DOCUMENT_CACHE_MAX_BYTES, DOCUMENT_CACHE_MAX_ITEMS, DOCUMENT_CACHE_TTL
+from cache import TTLCache
+from metrics import metrics
+from config import (
+    CHAT_LOG_ROLLOVER_MAX_AGE,
+    CHAT_LOG_ROLLOVER_MAX_SIZE,
+    CHAT_LOG_WARM_AFTER,
+    CHAT_LOG_DELETE_AFTER,
+    CHAT_LOG_ROUTING_SLACK,
+)
+from datetime import datetime, timedelta
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, Any, Iterable, List, Optional, Set, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
 
 # 定义索引名称和映射
 CHAT_INDEX = "new_llm_chat_records"
-CHAT_STREAM_INDEX = "new_llm_chat_log"
+CHAT_STREAM_INDEX = "new_llm_chat_log"                  # 滚动之前的单个索引，保留用于读取历史记录
+CHAT_STREAM_ALIAS = "new_llm_chat_log_write"            # 聊天流记录的写入别名，指向当前的滚动索引
+CHAT_STREAM_ROLLOVER_PATTERN = "new_llm_chat_log-*"     # 滚动索引 new_llm_chat_log-000001, -000002 ...
+CHAT_STREAM_TEMPLATE = "new_llm_chat_log_template"
+CHAT_STREAM_POLICY = "new_llm_chat_log_policy"
 USER_SETTINGS_INDEX = "new_user_settings"
+CHAT_MESSAGE_INDEX = "new_llm_chat_messages"
+USAGE_ROLLUP_INDEX = "new_llm_usage_daily"
+DOCUMENT_INDEX = "new_llm_documents"
+
+# 会话存储格式版本：1 为消息嵌套在会话文档的 messages 中，2 为会话头文档 + 每条消息一个文档
+SESSION_STORAGE_VERSION = 2
+# 会话列表的游标分页按 (timestamp, session_id) 排序，session_id 保证排序唯一
+SESSION_CURSOR_SORT = [
+    {"timestamp": {"order": "desc"}},
+    {"session_id": {"order": "desc"}}
+]
+# 游标分页使用 point-in-time 时的保持时间
+PIT_KEEP_ALIVE = "5m"
+
+# 单个会话读取消息的上限
+MAX_SESSION_MESSAGES = 10000
+# 按ID批量读取消息时每次 mget 的文档数
+MESSAGE_MGET_BATCH_SIZE = 1000
+# 会话头中在写入时维护的摘要字段
+SESSION_SUMMARY_FIELDS = ["message_count", "storage_version", "last_message_preview", "last_message_at"]
+# 会话列表摘要模式返回的字段
+SESSION_LIST_SUMMARY_SOURCE = [
+    "session_id", "title", "timestamp", "ai_type", "created_at",
+    "message_count", "last_message_preview", "last_message_at"
+]
 
 CHAT_MAPPING = {
     "mappings": {
@@ -54,7 +99,7 @@ CHAT_MAPPING = {
                             },
                             "发布机构": {"type": "keyword"},
                             "作者": {"type": "text"},
-                            "日期": {"type": "date"},
+                            "日期": {"type": "date", "ignore_malformed": True},
                             "类型": {
                                 "type": "keyword"
                             }
@@ -65,7 +110,56 @@ CHAT_MAPPING = {
             "model": {"type": "keyword"},               # 使用的模型
             "total_tokens": {"type": "integer"},        # 总token数量
             "metadata": {"type": "object"},             # 其他元数据
-            "created_at": {"type": "date"}              # 创建时间
+            "created_at": {"type": "date"},             # 创建时间
+            "message_count": {"type": "integer"},       # 消息数量
+            "storage_version": {"type": "integer"},     # 存储格式版本
+            "last_message_preview": {                   # 最后一条消息的预览，只用于展示
+                "type": "text",
+                "index": False
+            },
+            "last_message_at": {"type": "date"}         # 最后一条消息的时间
+        }
+    },
+    "settings": {
+        "number_of_shards": 1,
+        "number_of_replicas": 1
+    }
+}
+
+# 会话中的单条消息，文档ID为 {session_id}_{seq}
+CHAT_MESSAGE_MAPPING = {
+    "mappings": {
+        "properties": {
+            "session_id": {"type": "keyword"},          # 会话ID
+            "seq": {"type": "integer"},                 # 消息在会话中的序号，从0开始
+            "role": {"type": "keyword"},                # 角色(user/assistant)
+            "index_name": {"type": "keyword"},          # index值
+            "think": {"type": "text"},                  # 思考内容
+            "content": {"type": "text"},                # 对话内容
+            "timestamp": {"type": "date"},              # 消息时间戳
+            "documents": {                              # 文档数组
+                "type": "nested",
+                "properties": {
+                    "sid": {"type": "keyword"},
+                    "ID": {"type": "keyword"},
+                    "标题": {
+                        "type": "text",
+                        "fields": {
+                            "keyword": {
+                                "type": "keyword",
+                                "ignore_above": 256
+                            }
+                        }
+                    },
+                    "发布机构": {"type": "keyword"},
+                    "作者": {"type": "text"},
+                    "日期": {"type": "date", "ignore_malformed": True},
+                    "类型": {
+                        "type": "keyword"
+                    }
+                }
+            },
+            "short_id_mapping": {"type": "object", "enabled": False}
         }
     },
     "settings": {
@@ -100,7 +194,7 @@ CHAT_STREAM_MAPPING = {
                     },
                     "发布机构": {"type": "keyword"},
                     "作者": {"type": "text"},
-                    "日期": {"type": "date"},
+                    "日期": {"type": "date", "ignore_malformed": True},
                     "类型": {
                         "type": "keyword"
                     }
@@ -117,6 +211,104 @@ CHAT_STREAM_MAPPING = {
     }
 }
 
+# 按天汇总的部门/功能使用量，文档ID为 {day}_{department}_{ai_type}
+USAGE_ROLLUP_MAPPING = {
+    "mappings": {
+        "properties": {
+            "day": {"type": "date", "format": "yyyy-MM-dd"},   # 日期
+            "department": {"type": "keyword"},                 # 部门，user_id 中 _ 之前的部分
+            "ai_type": {"type": "keyword"},                    # 功能类型
+            "count": {"type": "long"},                         # 当天创建的会话数
+            "tokens": {"type": "long"},                        # token数
+            "updated_at": {"type": "date"}                     # 更新时间
+        }
+    },
+    "settings": {
+        "number_of_shards": 1,
+        "number_of_replicas": 1
+    }
+}
+
+# 滚动索引的模板：记录只追加、只按时间/用户/类型查询，
+# documents 和 metadata 只保存在 _source 中不建索引，减少写入和存储开销
+CHAT_STREAM_TEMPLATE_BODY = {
+    "index_patterns": [CHAT_STREAM_ROLLOVER_PATTERN],
+    "template": {
+        "settings": {
+            "number_of_shards": 1,
+            "number_of_replicas": 1,
+            "index.codec": "best_compression",
+            "index.lifecycle.name": CHAT_STREAM_POLICY,
+            "index.lifecycle.rollover_alias": CHAT_STREAM_ALIAS
+        },
+        "mappings": {
+            "properties": {
+                **CHAT_STREAM_MAPPING["mappings"]["properties"],
+                "documents": {"type": "object", "enabled": False},
+                "metadata": {"type": "object", "enabled": False}
+            }
+        }
+    }
+}
+
+# 聊天流记录的生命周期：按时间/大小滚动，过一段时间合并段并设为只读，最后删除
+CHAT_STREAM_POLICY_BODY = {
+    "phases": {
+        "hot": {
+            "actions": {
+                "rollover": {
+                    "max_age": CHAT_LOG_ROLLOVER_MAX_AGE,
+                    "max_primary_shard_size": CHAT_LOG_ROLLOVER_MAX_SIZE
+                }
+            }
+        },
+        "warm": {
+            "min_age": CHAT_LOG_WARM_AFTER,
+            "actions": {
+                "forcemerge": {"max_num_segments": 1},
+                "readonly": {}
+            }
+        },
+        "delete": {
+            "min_age": CHAT_LOG_DELETE_AFTER,
+            "actions": {
+                "delete": {}
+            }
+        }
+    }
+}
+
+# 按时间选择聊天流索引时，索引列表的缓存时间（秒）
+CHAT_STREAM_INDICES_TTL = 60
+
+# 研报文档元数据，文档ID为 sid；会话消息和聊天流记录的 documents 中只保存 {"sid": ...} 引用
+DOCUMENT_MAPPING = {
+    "mappings": {
+        "properties": {
+            "sid": {"type": "keyword"},
+            "ID": {"type": "keyword"},
+            "标题": {
+                "type": "text",
+                "fields": {
+                    "keyword": {
+                        "type": "keyword",
+                        "ignore_above": 256
+                    }
+                }
+            },
+            "发布机构": {"type": "keyword"},
+            "作者": {"type": "text"},
+            "日期": {"type": "date", "ignore_malformed": True},
+            "类型": {"type": "keyword"},
+            "updated_at": {"type": "date"}      # 更新时间
+        }
+    },
+    "settings": {
+        "number_of_shards": 1,
+        "number_of_replicas": 1
+    }
+}
+
 USER_SETTINGS_MAPPING = {
     "mappings": {
         "properties": {
@@ -130,40 +322,234 @@ USER_SETTINGS_MAPPING = {
     }
 }
 
-class ESClient:
-    _instance = None
-    _initialized = False
+def format_version(seq_no: int, primary_term: int) -> str:
+    """把 _seq_no/_primary_term 编码成客户端使用的版本号"""
+    return f"{seq_no}:{primary_term}"
+
+
+def parse_version(version: str):
+    """解析版本号，格式错误时抛 ValueError"""
+    seq_no, primary_term = version.split(":")
+    return int(seq_no), int(primary_term)
+
+
+def last_message_summary(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """由最后一条消息生成会话头中的预览字段，没有消息时返回空字典"""
+    if not messages:
+        return {}
+    last = messages[-1]
+    content = last.get("content") or ""
+    timestamp = last.get("timestamp")
+    return {
+        "last_message_preview": content[:SESSION_PREVIEW_LENGTH],
+        "last_message_at": timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp
+    }
+
+
+def encode_cursor(state: Dict[str, Any]) -> str:
+    """把分页状态编码为不透明的游标字符串"""
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    """解析游标，格式错误时抛 ValueError"""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(state, dict) or not isinstance(state.get("after"), list):
+        raise ValueError("Invalid cursor")
+    return state
+
+
+def department_of(user_id: str) -> str:
+    """user_id 的格式为 部门_用户名，没有 _ 时归为 unknown"""
+    return user_id.split("_")[0] if user_id and "_" in user_id else "unknown"
+
+
+def usage_rollup_id(day: str, department: str, ai_type: str) -> str:
+    return f"{day}_{department}_{ai_type}"
+
+
+def is_document_ref(document: Any) -> bool:
+    return isinstance(document, dict) and set(document) == {"sid"}
+
+
+def document_refs(documents: Any, stored: Optional[Set[str]] = None) -> Any:
+    """
+    把文档列表换成 sid 引用，没有 sid 的文档无法去重，原样保留
+    stored 不为空时只替换元数据已经写入的 sid，其余的原样保留
+    """
+    if not isinstance(documents, list):
+        return documents
+    return [
+        {"sid": document["sid"]}
+        if isinstance(document, dict) and document.get("sid") and (stored is None or document["sid"] in stored)
+        else document
+        for document in documents
+    ]
+
+
+def collect_documents(documents_lists: Iterable[Any]) -> Dict[str, Dict[str, Any]]:
+    """从多个文档列表中收集完整的文档元数据，按 sid 去重"""
+    collected = {}
+    for documents in documents_lists:
+        if not isinstance(documents, list):
+            continue
+        for document in documents:
+            if isinstance(document, dict) and document.get("sid") and not is_document_ref(document):
+                collected[document["sid"]] = document
+    return collected
+
+
+_json_serializer = JsonSerializer()
+
+
+def as_stored(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """按ES客户端的序列化方式（datetime 为 isoformat 等）转换，得到与读回的 _source 相同的结构"""
+    return json.loads(_json_serializer.dumps(doc))
+
+
+def with_timestamps(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """没有时间戳的消息补上当前时间"""
+    now = datetime.now().isoformat()
+    return [
+        {**msg, "timestamp": msg.get("timestamp") or now}
+        for msg in messages
+    ]
 
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(ESClient, cls).__new__(cls)
-        return cls._instance
+
+class ESClient:
+    """
+    基于 AsyncElasticsearch 的数据访问层，所有方法都需要 await
+    创建实例时不会访问ES；应用启动时调用 start，在超时时间内完成索引初始化，
+    超时或ES不可用时在后台重试，不阻塞启动
+    """
 
     def __init__(self):
-        if not ESClient._initialized:
-            self.client = Elasticsearch(ES_HOST, verify_certs=False)
-            self._init_chat_index()
-            self._init_user_settings_index()
-            self._init_chat_stream_index()
-            ESClient._initialized = True
-
-    def _init_chat_index(self):
+        self.client = AsyncElasticsearch(
+            ES_HOST,
+            verify_certs=False,
+            connections_per_node=ES_CONNECTIONS_PER_NODE,
+            request_timeout=ES_REQUEST_TIMEOUT,
+            max_retries=ES_MAX_RETRIES,
+            retry_on_timeout=True
+        )
+        # (过期时间, [(创建时间毫秒, 索引名)])
+        self._chat_stream_indices = None
+        self._ready: Optional[asyncio.Event] = None
+        self._bootstrap_task: Optional[asyncio.Task] = None
+        # sid -> 文档元数据
+        self.document_cache = TTLCache(
+            "document_cache",
+            max_bytes=DOCUMENT_CACHE_MAX_BYTES,
+            max_items=DOCUMENT_CACHE_MAX_ITEMS,
+            ttl=DOCUMENT_CACHE_TTL
+        )
+        metrics.register("document_cache", self.document_cache.stats)
+        self.last_error: Optional[str] = None
+
+    @property
+    def ready(self) -> bool:
+        """索引初始化是否已经完成"""
+        return self._ready is not None and self._ready.is_set()
+
+    async def start(self, timeout: float = ES_STARTUP_TIMEOUT):
+        """启动时调用：初始化在后台进行，最多等待 timeout 秒（0 不等待），未完成的在后台继续重试"""
+        self._ready = asyncio.Event()
+        self._bootstrap_task = asyncio.create_task(self._bootstrap())
+        if timeout <= 0:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._ready.wait()), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Elasticsearch not ready after {timeout}s, retrying in background")
+
+    async def wait_ready(self):
+        """等待索引初始化完成，供依赖ES的后台任务使用"""
+        await self._ready.wait()
+
+    async def _bootstrap(self):
+        delay = 1.0
+        while True:
+            try:
+                await self.client.info()
+                await self.init_indices()
+                self.last_error = None
+                self._ready.set()
+                logger.info("Elasticsearch ready")
+                return
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"Error connecting to Elasticsearch, retrying in {delay:.0f}s: {str(e)}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, ES_BOOTSTRAP_MAX_BACKOFF)
+
+    async def ping(self, timeout: float = READINESS_PING_TIMEOUT) -> bool:
+        """检查ES是否可以连通，不重试"""
+        try:
+            return await self.client.options(request_timeout=timeout, max_retries=0).ping()
+        except Exception as e:
+            self.last_error = str(e)
+            return False
+
+    async def init_indices(self):
+        """初始化所有索引"""
+        await self._init_chat_index()
+        await self._init_chat_message_index()
+        await self._init_user_settings_index()
+        await self._init_chat_stream_index()
+        await self._init_usage_rollup_index()
+        await self._init_document_index()
+
+    async def close(self):
+        if self._bootstrap_task is not None:
+            self._bootstrap_task.cancel()
+            try:
+                await self._bootstrap_task
+            except asyncio.CancelledError:
+                pass
+            self._bootstrap_task = None
+        await self.client.close()
+
+    async def _init_chat_index(self):
         """初始化聊天记录索引"""
         try:
-            if not self.client.indices.exists(index=CHAT_INDEX):
-                self.client.indices.create(
+            if not await self.client.indices.exists(index=CHAT_INDEX):
+                await self.client.indices.create(
                     index=CHAT_INDEX,
                     body=CHAT_MAPPING
                 )
                 logger.info(f"Created index: {CHAT_INDEX}")
+            else:
+                # 已有索引补充新增字段的映射
+                await self.client.indices.put_mapping(
+                    index=CHAT_INDEX,
+                    properties={
+                        field: CHAT_MAPPING["mappings"]["properties"][field]
+                        for field in SESSION_SUMMARY_FIELDS
+                    }
+                )
         except Exception as e:
             logger.error(f"Error creating index: {str(e)}")
 
-    def _init_user_settings_index(self):
+    async def _init_chat_message_index(self):
+        """初始化会话消息索引"""
+        try:
+            if not await self.client.indices.exists(index=CHAT_MESSAGE_INDEX):
+                await self.client.indices.create(
+                    index=CHAT_MESSAGE_INDEX,
+                    body=CHAT_MESSAGE_MAPPING
+                )
+                logger.info(f"Created index: {CHAT_MESSAGE_INDEX}")
+        except Exception as e:
+            logger.error(f"Error creating chat message index: {str(e)}")
+
+    async def _init_user_settings_index(self):
         """初始化用户设置索引"""
         try:
-            if not self.client.indices.exists(index=USER_SETTINGS_INDEX):
-                self.client.indices.create(
+            if not await self.client.indices.exists(index=USER_SETTINGS_INDEX):
+                await self.client.indices.create(
                     index=USER_SETTINGS_INDEX,
                     body=USER_SETTINGS_MAPPING
                 )
@@ -171,18 +557,293 @@ class ESClient:
         except Exception as e:
             logger.error(f"Error creating user settings index: {str(e)}")
 
-    def _init_chat_stream_index(self):
-        """初始化聊天记录流索引"""
+    async def _init_chat_stream_index(self):
+        """
+        初始化聊天记录流的滚动索引：生命周期策略、索引模板，没有写入别名时创建第一个滚动索引
+        已有的 new_llm_chat_log 单索引不再写入，只参与读取，由 CHAT_LOG_DELETE_AFTER 之后人工删除
+        """
         try:
-            self.client.indices.create(
-                index=CHAT_STREAM_INDEX,
-                body=CHAT_STREAM_MAPPING
-            )
-            logger.info(f"Created index: {CHAT_STREAM_INDEX}")
+            await self.client.ilm.put_lifecycle(name=CHAT_STREAM_POLICY, policy=CHAT_STREAM_POLICY_BODY)
+            await self.client.indices.put_index_template(name=CHAT_STREAM_TEMPLATE, **CHAT_STREAM_TEMPLATE_BODY)
+            if not await self.client.indices.exists_alias(name=CHAT_STREAM_ALIAS):
+                first_index = CHAT_STREAM_ROLLOVER_PATTERN.replace("*", "000001")
+                await self.client.indices.create(
+                    index=first_index,
+                    aliases={CHAT_STREAM_ALIAS: {"is_write_index": True}}
+                )
+                logger.info(f"Created index: {first_index}")
         except Exception as e:
             logger.error(f"Error creating chat stream index: {str(e)}")
 
-    def store_chat_session(
+    async def chat_stream_indices(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[str]:
+        """
+        返回可能包含 [start, end] 内记录的聊天流索引
+        每个索引的记录从它创建开始写入，到下一个滚动索引创建为止；
+        落盘补写的记录可能晚到，下界按 CHAT_LOG_ROUTING_SLACK 放宽
+        索引列表缓存 CHAT_STREAM_INDICES_TTL 秒；范围包含最新的索引时先确认写入别名没有滚动到新索引，
+        滚动后立即重新读取，刚滚动出来的索引不会漏查
+        """
+        indices = await self._load_chat_stream_indices()
+        end_ms = end.timestamp() * 1000 if end is not None else None
+        if not indices or end_ms is None or end_ms >= indices[-1][0] - CHAT_LOG_ROUTING_SLACK * 1000:
+            write_index = await self._chat_stream_write_index()
+            if write_index is not None and write_index not in {name for _, name in indices}:
+                indices = await self._load_chat_stream_indices(force=True)
+
+        start_ms = start.timestamp() * 1000 if start is not None else None
+        slack_ms = CHAT_LOG_ROUTING_SLACK * 1000
+        selected = []
+        for position, (created_ms, name) in enumerate(indices):
+            next_created_ms = indices[position + 1][0] if position + 1 < len(indices) else None
+            # 最早的索引可能有创建之前的记录（迁移或导入的数据），不限下界
+            lower_ms = created_ms - slack_ms if position > 0 else None
+            if start_ms is not None and next_created_ms is not None and start_ms >= next_created_ms:
+                continue
+            if end_ms is not None and lower_ms is not None and end_ms < lower_ms:
+                continue
+            selected.append(name)
+        return selected
+
+    async def _chat_stream_write_index(self) -> Optional[str]:
+        """写入别名当前指向的索引"""
+        try:
+            aliases = await self.client.indices.get_alias(name=CHAT_STREAM_ALIAS)
+        except NotFoundError:
+            return None
+        for name, value in aliases.items():
+            if value["aliases"].get(CHAT_STREAM_ALIAS, {}).get("is_write_index", len(aliases) == 1):
+                return name
+        return None
+
+    async def _load_chat_stream_indices(self, force: bool = False) -> List[Tuple[int, str]]:
+        """读取（并缓存）聊天流索引及其创建时间，按创建时间升序"""
+        now = time.monotonic()
+        if force or self._chat_stream_indices is None or self._chat_stream_indices[0] < now:
+            settings = await self.client.indices.get_settings(
+                index=f"{CHAT_STREAM_INDEX},{CHAT_STREAM_ROLLOVER_PATTERN}",
+                name="index.creation_date",
+                ignore_unavailable=True,
+                allow_no_indices=True
+            )
+            indices = sorted(
+                (int(value["settings"]["index"]["creation_date"]), name)
+                for name, value in settings.items()
+            )
+            self._chat_stream_indices = (now + CHAT_STREAM_INDICES_TTL, indices)
+        return self._chat_stream_indices[1]
+
+    async def _init_usage_rollup_index(self):
+        """初始化使用量日汇总索引"""
+        try:
+            if not await self.client.indices.exists(index=USAGE_ROLLUP_INDEX):
+                await self.client.indices.create(
+                    index=USAGE_ROLLUP_INDEX,
+                    body=USAGE_ROLLUP_MAPPING
+                )
+                logger.info(f"Created index: {USAGE_ROLLUP_INDEX}")
+        except Exception as e:
+            logger.error(f"Error creating usage rollup index: {str(e)}")
+
+    async def _init_document_index(self):
+        """初始化文档元数据索引"""
+        try:
+            if not await self.client.indices.exists(index=DOCUMENT_INDEX):
+                await self.client.indices.create(
+                    index=DOCUMENT_INDEX,
+                    body=DOCUMENT_MAPPING
+                )
+                logger.info(f"Created index: {DOCUMENT_INDEX}")
+        except Exception as e:
+            logger.error(f"Error creating document index: {str(e)}")
+
+    async def save_documents(self, documents: Dict[str, Dict[str, Any]]) -> Set[str]:
+        """
+        批量写入文档元数据（sid -> 文档），与缓存中内容相同的跳过，返回元数据已经保存的 sid
+        单个文档写入失败（字段格式不对等）只记录日志，调用方对这些文档保留完整内容而不是 sid 引用；
+        请求本身失败时抛出异常
+        """
+        stored = set()
+        changed = {}
+        for sid, document in documents.items():
+            found, cached = self.document_cache.get(sid)
+            if not found or cached != document:
+                changed[sid] = document
+            else:
+                stored.add(sid)
+        if not changed:
+            return stored
+        now = datetime.now().isoformat()
+        actions = [
+            {"_index": DOCUMENT_INDEX, "_id": sid, "_source": {**document, "updated_at": now}}
+            for sid, document in changed.items()
+        ]
+        _, errors = await helpers.async_bulk(self.client, actions, raise_on_error=False)
+        failed = set()
+        for error in errors:
+            item = next(iter(error.values()))
+            failed.add(item.get("_id"))
+            logger.error(f"Error saving document {item.get('_id')}: {item.get('error')}")
+        if failed:
+            metrics.inc("documents.failed", len(failed))
+        for sid, document in changed.items():
+            if sid not in failed:
+                self.document_cache.set(sid, document)
+                stored.add(sid)
+        metrics.inc("documents.saved", len(changed) - len(failed))
+        return stored
+
+    async def get_documents(self, sids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """按 sid 读取文档元数据，先查缓存，未命中的用一次 mget 读取"""
+        found_documents = {}
+        missing = []
+        for sid in set(sids):
+            found, document = self.document_cache.get(sid)
+            if found:
+                self.document_cache.hits += 1
+                found_documents[sid] = document
+            else:
+                self.document_cache.misses += 1
+                missing.append(sid)
+        if missing:
+            result = await self.client.mget(index=DOCUMENT_INDEX, ids=missing, source_excludes=["updated_at"])
+            for doc in result["docs"]:
+                if doc.get("found"):
+                    found_documents[doc["_id"]] = doc["_source"]
+                    self.document_cache.set(doc["_id"], doc["_source"])
+        return found_documents
+
+    async def hydrate_documents(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """把 items（消息或聊天流记录）中 documents 的 sid 引用换回完整的文档元数据"""
+        sids = [
+            document["sid"]
+            for item in items if isinstance(item.get("documents"), list)
+            for document in item["documents"] if is_document_ref(document)
+        ]
+        if not sids:
+            return items
+        documents = await self.get_documents(sids)
+        for item in items:
+            if isinstance(item.get("documents"), list):
+                item["documents"] = [
+                    documents.get(document["sid"], document) if is_document_ref(document) else document
+                    for document in item["documents"]
+                ]
+        return items
+
+    @staticmethod
+    def message_doc_id(session_id: str, seq: int) -> str:
+        return f"{session_id}_{seq}"
+
+    @staticmethod
+    def message_source(session_id: str, seq: int, msg: Dict[str, Any], stored: Optional[Set[str]] = None) -> Dict[str, Any]:
+        """消息文档的内容，元数据已经保存的文档只保存 sid 引用"""
+        return {
+            **msg,
+            "documents": document_refs(msg.get("documents"), stored),
+            "session_id": session_id,
+            "seq": seq
+        }
+
+    async def _index_messages(self, session_id: str, messages: List[Dict[str, Any]], start_seq: int = 0):
+        """批量写入消息文档，序号从 start_seq 开始；相同序号重复写入会覆盖，可以安全重试"""
+        await self._index_message_docs(
+            session_id,
+            [(start_seq + offset, msg) for offset, msg in enumerate(messages)]
+        )
+
+    async def _index_message_docs(self, session_id: str, items: List[Tuple[int, Dict[str, Any]]]):
+        """
+        按 (序号, 消息) 写入消息文档
+        读取消息都按确定的文档ID用 mget（实时），所以写入后不需要等待 refresh
+        """
+        if not items:
+            return
+        # 文档元数据单独按 sid 存储，消息中只保存引用
+        stored = await self.save_documents(collect_documents(msg.get("documents") for _, msg in items))
+        actions = [
+            {
+                "_index": CHAT_MESSAGE_INDEX,
+                "_id": self.message_doc_id(session_id, seq),
+                "_source": self.message_source(session_id, seq, msg, stored)
+            }
+            for seq, msg in items
+        ]
+        await helpers.async_bulk(self.client, actions)
+
+    async def _delete_messages(self, session_id: str, start_seq: int, end_seq: int):
+        """按文档ID删除序号在 [start_seq, end_seq) 的消息"""
+        actions = [
+            {"_op_type": "delete", "_index": CHAT_MESSAGE_INDEX, "_id": self.message_doc_id(session_id, seq)}
+            for seq in range(start_seq, end_seq)
+        ]
+        if actions:
+            await helpers.async_bulk(self.client, actions, raise_on_error=False)
+
+    async def _delete_messages_from(self, session_id: str, seq: int):
+        """按查询删除序号 >= seq 的消息"""
+        await self.client.delete_by_query(
+            index=CHAT_MESSAGE_INDEX,
+            query={
+                "bool": {
+                    "filter": [
+                        {"term": {"session_id": session_id}},
+                        {"range": {"seq": {"gte": seq}}}
+                    ]
+                }
+            },
+            conflicts="proceed"
+        )
+
+    async def _mget_messages(self, ranges: Dict[str, Tuple[int, int]]) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        按确定的文档ID读取每个会话序号在 [start, end) 的消息，返回 session_id -> 按序号排列的消息
+        mget 是实时的，刚写入的消息不需要 refresh 就能读到；不存在的序号跳过
+        """
+        ids = [
+            self.message_doc_id(session_id, seq)
+            for session_id, (start, end) in ranges.items()
+            for seq in range(max(start, 0), min(end, MAX_SESSION_MESSAGES))
+        ]
+        grouped = {session_id: [] for session_id in ranges}
+        for batch_start in range(0, len(ids), MESSAGE_MGET_BATCH_SIZE):
+            result = await self.client.mget(
+                index=CHAT_MESSAGE_INDEX,
+                ids=ids[batch_start:batch_start + MESSAGE_MGET_BATCH_SIZE],
+                source_excludes=["session_id"]
+            )
+            for doc in result["docs"]:
+                if doc.get("found"):
+                    grouped[doc["_id"].rsplit("_", 1)[0]].append(doc["_source"])
+        return grouped
+
+    async def _changed_messages(
+        self,
+        session_id: str,
+        messages_with_timestamp: List[Dict[str, Any]],
+        messages: List[Dict[str, Any]],
+        previous_count: int
+    ) -> List[Tuple[int, Dict[str, Any]]]:
+        """
+        完整保存会话时只返回需要写入的 (序号, 消息)：新增的和内容有变化的
+        客户端没有带时间戳的已有消息沿用原来的时间戳，不算变化
+        """
+        overlap = min(previous_count, len(messages))
+        stored = (await self._mget_messages({session_id: (0, overlap)}))[session_id] if overlap else []
+        stored_by_seq = {message.get("seq"): message for message in stored}
+        changed = []
+        for seq, msg in enumerate(messages_with_timestamp):
+            previous = stored_by_seq.get(seq)
+            if previous is not None:
+                if not messages[seq].get("timestamp") and previous.get("timestamp"):
+                    msg = {**msg, "timestamp": previous["timestamp"]}
+                candidate = self.message_source(session_id, seq, msg)
+                candidate.pop("session_id")
+                if as_stored(candidate) == previous:
+                    continue
+            changed.append((seq, msg))
+        return changed
+
+    async def store_chat_session(
         self,
         session_id: str,
         user_id: str,
@@ -193,13 +854,32 @@ class ESClient:
         total_tokens: int = None,
         metadata: Dict[str, Any] = None
     ) -> bool:
-        """存储完整的聊天会话"""
+        """存储完整的聊天会话：会话头文档 + 每条消息一个文档"""
         try:
-            # 为每条消息添加时间戳
-            messages_with_timestamp = [
-                {**msg, "timestamp": datetime.now().isoformat()}
-                for msg in messages
-            ]
+            # 没有时间戳的消息补上当前时间，已有的保留
+            messages_with_timestamp = with_timestamps(messages)
+
+            previous_count = 0
+            previous_tokens = 0
+            is_new_session = False
+            # 创建时间只在新建时写入，使用量汇总按创建日期统计
+            created_at = datetime.now().isoformat()
+            try:
+                previous = await self.client.get(
+                    index=CHAT_INDEX,
+                    id=session_id,
+                    source_includes=["message_count", "total_tokens", "created_at"]
+                )
+                previous_count = previous["_source"].get("message_count") or 0
+                previous_tokens = previous["_source"].get("total_tokens") or 0
+                created_at = previous["_source"].get("created_at") or created_at
+            except NotFoundError:
+                is_new_session = True
+
+            await self._index_message_docs(
+                session_id,
+                await self._changed_messages(session_id, messages_with_timestamp, messages, previous_count)
+            )
             
             doc = {
                 "session_id": session_id,
@@ -208,31 +888,44 @@ class ESClient:
                 "user_id": user_id,
                 "ai_type": ai_type,
                 "title": title,
-                "messages": messages_with_timestamp,
                 "model": model,
                 "total_tokens": total_tokens,
                 "metadata": metadata or {},
-                "created_at": datetime.now().isoformat()
+                "created_at": created_at,
+                "message_count": len(messages_with_timestamp),
+                "storage_version": SESSION_STORAGE_VERSION,
+                **last_message_summary(messages_with_timestamp)
             }
             
             # 使用session_id作为文档ID，这样可以实现更新操作
-            self.client.index(
+            await self.client.index(
                 index=CHAT_INDEX,
                 id=session_id,
                 document=doc
             )
+
+            # 新的消息列表比原来短时，删除多余的旧消息
+            if previous_count > len(messages_with_timestamp):
+                await self._delete_messages(session_id, len(messages_with_timestamp), previous_count)
+
+            tokens = (total_tokens or 0) - previous_tokens if total_tokens is not None else 0
+            if is_new_session or tokens:
+                await self.increment_usage_rollup(user_id, ai_type, int(is_new_session), tokens, created_at)
             return True
         except Exception as e:
             logger.error(f"Error storing chat session: {str(e)}")
             return False
 
-    def update_chat_session(
+    async def update_chat_session(
         self,
         session_id: str,
         new_message: Dict[str, Any],
         total_tokens: int = None
     ) -> bool:
-        """更新现有会话，添加新消息"""
+        """
+        更新现有会话，添加新消息：会话头的消息计数加一，分配到的序号写入新消息文档
+        消息文档写入失败时把计数减回去，会话头不会指向不存在的消息
+        """
         try:
             new_message_with_timestamp = {
                 **new_message,
@@ -242,29 +935,61 @@ class ESClient:
             update_body = {
                 "script": {
                     "source": """
-                        ctx._source.messages.add(params.new_message);
-                        if (params.total_tokens != null) {
-                            ctx._source.total_tokens = params.total_tokens;
+                        if (ctx._source.storage_version == null || ctx._source.storage_version < params.storage_version) {
+                            ctx.op = 'noop';
+                        } else {
+                            ctx._source.message_count += 1;
+                            ctx._source.last_message_preview = params.summary.last_message_preview;
+                            ctx._source.last_message_at = params.summary.last_message_at;
+                            if (params.total_tokens != null) {
+                                ctx._source.total_tokens = params.total_tokens;
+                            }
                         }
                     """,
                     "params": {
-                        "new_message": new_message_with_timestamp,
+                        "storage_version": SESSION_STORAGE_VERSION,
+                        "summary": last_message_summary([new_message_with_timestamp]),
                         "total_tokens": total_tokens
                     }
                 }
             }
-            
-            self.client.update(
-                index=CHAT_INDEX,
-                id=session_id,
-                body=update_body
-            )
+
+            for _ in range(2):
+                result = await self.client.update(
+                    index=CHAT_INDEX,
+                    id=session_id,
+                    body=update_body,
+                    source_includes=["message_count"],
+                    retry_on_conflict=5
+                )
+                if result["result"] != "noop":
+                    break
+                # 旧格式的会话先迁移再追加
+                await self.migrate_chat_session(session_id)
+            else:
+                raise RuntimeError(f"Session {session_id} could not be migrated")
+
+            seq = result["get"]["_source"]["message_count"] - 1
+            try:
+                await self._index_messages(session_id, [new_message_with_timestamp], start_seq=seq)
+            except Exception:
+                # 之后又有并发追加时（版本已变）不回滚，这个序号留空，读取时跳过
+                await self._rollback_header(
+                    session_id, result, lambda: self.client.update(
+                        index=CHAT_INDEX,
+                        id=session_id,
+                        doc={"message_count": seq},
+                        if_seq_no=result["_seq_no"],
+                        if_primary_term=result["_primary_term"]
+                    )
+                )
+                raise
             return True
         except Exception as e:
             logger.error(f"Error updating chat session: {str(e)}")
             return False
 
-    def update_chat_session_title(
+    async def update_chat_session_title(
         self,
         session_id: str,
         new_title: str
@@ -277,7 +1002,7 @@ class ESClient:
                 }
             }
             
-            self.client.update(
+            await self.client.update(
                 index=CHAT_INDEX,
                 id=session_id,
                 body=update_body
@@ -287,32 +1012,433 @@ class ESClient:
             logger.error(f"Error updating chat session title: {str(e)}")
             return False
 
-    def get_chat_session(self, session_id: str) -> Dict[str, Any]:
+    async def soft_delete_chat_session(self, session_id: str) -> bool:
+        """
+        标记会话为已删除，返回这次是否由未删除变为已删除
+        使用量汇总不统计已删除的会话，第一次标记删除时从创建日期的汇总中减掉，重复删除不再扣减
+        """
+        result = await self.client.update(
+            index=CHAT_INDEX,
+            id=session_id,
+            script={
+                "source": "if (ctx._source.is_delete == true) { ctx.op = 'noop'; } else { ctx._source.is_delete = true; }"
+            },
+            source_includes=["user_id", "ai_type", "total_tokens", "created_at"],
+            retry_on_conflict=5
+        )
+        if result["result"] == "noop":
+            return False
+        source = result["get"]["_source"]
+        await self.increment_usage_rollup(
+            source.get("user_id"),
+            source.get("ai_type"),
+            -1,
+            -(source.get("total_tokens") or 0),
+            source.get("created_at")
+        )
+        return True
+
+    async def get_session_messages(self, message_counts: Dict[str, int], start_seq: int = 0) -> Dict[str, List[Dict[str, Any]]]:
+        """按会话头中的消息数一次读取多个会话序号 >= start_seq 的消息，返回 session_id -> 消息列表"""
+        grouped = await self._mget_messages({
+            session_id: (start_seq, count) for session_id, count in message_counts.items()
+        })
+        await self.hydrate_documents([message for messages in grouped.values() for message in messages])
+        return grouped
+
+    async def hydrate_sessions(self, sessions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """为新格式的会话头补上 messages 字段，保持与旧格式相同的返回结构"""
+        pending = [
+            session for session in sessions
+            if (session.get("storage_version") or 1) >= SESSION_STORAGE_VERSION
+        ]
+        if pending:
+            grouped = await self.get_session_messages({
+                session["session_id"]: session.get("message_count") or 0 for session in pending
+            })
+            for session in pending:
+                session["messages"] = grouped.get(session["session_id"], [])
+        return sessions
+
+    async def get_chat_session(self, session_id: str) -> Dict[str, Any]:
         """获取指定会话的完整聊天记录"""
         try:
-            result = self.client.get(
+            result = await self.client.get(
                 index=CHAT_INDEX,
                 id=session_id
             )
-            return result["_source"]
+            session = result["_source"]
+            await self.hydrate_sessions([session])
+            # 返回版本号，客户端增量同步时带回
+            session["version"] = format_version(result["_seq_no"], result["_primary_term"])
+            return session
         except Exception as e:
             logger.error(f"Error retrieving chat session: {str(e)}")
             return {}
 
-    def get_user_chat_sessions(
+    async def apply_session_delta(
+        self,
+        session_id: str,
+        base_version: Optional[str],
+        base_count: int,
+        messages: List[Dict[str, Any]],
+        header: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """
+        增量同步会话：只追加新消息，用 if_seq_no/if_primary_term 做乐观并发控制
+        base_version 为空表示新建会话；版本不一致时返回 conflict，
+        并带上服务端当前的版本和客户端缺少的消息（序号 >= base_count），由客户端合并后重试
+        会话头更新成功后才写入消息文档（写在前面会被同一版本上并发的另一个客户端覆盖），
+        消息写入失败时把会话头恢复到更新前，使用量汇总在消息写入成功后才累加
+        """
+        messages = with_timestamps(messages)
+        now = datetime.now()
+        try:
+            if base_version is None:
+                doc = {
+                    **header,
+                    "session_id": session_id,
+                    "is_delete": False,
+                    "timestamp": now,
+                    "created_at": now.isoformat(),
+                    "message_count": len(messages),
+                    "storage_version": SESSION_STORAGE_VERSION,
+                    **last_message_summary(messages)
+                }
+                result = await self.client.index(
+                    index=CHAT_INDEX,
+                    id=session_id,
+                    document=doc,
+                    op_type="create"
+                )
+                base_count = 0
+                previous = None
+            else:
+                seq_no, primary_term = parse_version(base_version)
+                # 先读出更新前的会话头：消息写入失败时用来恢复，带 total_tokens 时把差值累加到创建日期的汇总
+                previous = await self.client.get(index=CHAT_INDEX, id=session_id)
+                # 消息数与客户端不一致、或是旧格式会话时不做修改（noop），按冲突处理
+                result = await self.client.update(
+                    index=CHAT_INDEX,
+                    id=session_id,
+                    script={
+                        "source": """
+                            if (ctx._source.storage_version == null
+                                    || ctx._source.storage_version < params.storage_version
+                                    || ctx._source.message_count != params.base_count) {
+                                ctx.op = 'noop';
+                            } else {
+                                for (entry in params.header.entrySet()) {
+                                    ctx._source[entry.getKey()] = entry.getValue();
+                                }
+                                ctx._source.message_count = params.base_count + params.added;
+                            }
+                        """,
+                        "params": {
+                            "storage_version": SESSION_STORAGE_VERSION,
+                            "base_count": base_count,
+                            "added": len(messages),
+                            "header": {
+                                **{key: value for key, value in header.items() if value is not None},
+                                **last_message_summary(messages),
+                                "timestamp": now.isoformat()
+                            }
+                        }
+                    },
+                    if_seq_no=seq_no,
+                    if_primary_term=primary_term
+                )
+                if result["result"] == "noop":
+                    return await self._session_delta_conflict(session_id, base_count)
+        except (ConflictError, NotFoundError):
+            return await self._session_delta_conflict(session_id, base_count)
+
+        try:
+            await self._index_messages(session_id, messages, start_seq=base_count)
+        except Exception:
+            if previous is None:
+                restore = lambda: self.client.delete(
+                    index=CHAT_INDEX,
+                    id=session_id,
+                    if_seq_no=result["_seq_no"],
+                    if_primary_term=result["_primary_term"]
+                )
+            else:
+                restore = lambda: self.client.index(
+                    index=CHAT_INDEX,
+                    id=session_id,
+                    document=previous["_source"],
+                    if_seq_no=result["_seq_no"],
+                    if_primary_term=result["_primary_term"]
+                )
+            await self._rollback_header(session_id, result, restore)
+            raise
+
+        if previous is None:
+            await self.increment_usage_rollup(
+                header.get("user_id"), header.get("ai_type"), 1, header.get("total_tokens") or 0, doc["created_at"]
+            )
+        elif header.get("total_tokens") is not None and previous["_seq_no"] == seq_no:
+            source = previous["_source"]
+            tokens = header["total_tokens"] - (source.get("total_tokens") or 0)
+            if tokens:
+                await self.increment_usage_rollup(
+                    header.get("user_id") or source.get("user_id"),
+                    header.get("ai_type") or source.get("ai_type"),
+                    0,
+                    tokens,
+                    source.get("created_at")
+                )
+        return {
+            "conflict": False,
+            "version": format_version(result["_seq_no"], result["_primary_term"]),
+            "message_count": base_count + len(messages)
+        }
+
+    async def _rollback_header(self, session_id: str, result: Dict[str, Any], restore: Callable[[], Awaitable[Any]]):
+        """
+        消息文档写入失败后恢复会话头，restore 带 if_seq_no 为 result 的版本，
+        会话头之后又被修改过时放弃恢复（版本冲突），只记录日志
+        """
+        try:
+            await restore()
+        except ConflictError:
+            logger.warning(f"Session {session_id} changed since seq_no {result['_seq_no']}, header not rolled back")
+        except Exception as e:
+            logger.error(f"Error rolling back session header {session_id}: {str(e)}")
+
+    async def _session_delta_conflict(self, session_id: str, base_count: int) -> Dict[str, Any]:
+        """版本冲突时返回服务端当前状态；旧格式的会话先迁移，迁移本身也会改变版本"""
+        await self.migrate_chat_session(session_id)
+        try:
+            current = await self.client.get(
+                index=CHAT_INDEX,
+                id=session_id,
+                source_includes=["message_count"]
+            )
+        except NotFoundError:
+            return {"conflict": True, "version": None, "message_count": 0, "messages": []}
+
+        message_count = current["_source"].get("message_count") or 0
+        grouped = await self.get_session_messages({session_id: message_count}, start_seq=base_count)
+        return {
+            "conflict": True,
+            "version": format_version(current["_seq_no"], current["_primary_term"]),
+            "message_count": message_count,
+            "messages": grouped[session_id]
+        }
+
+    async def migrate_chat_session(self, session_id: str) -> bool:
+        """
+        把旧格式（消息嵌套在 messages 中）的会话迁移为会话头 + 消息文档
+        消息文档ID固定，可重复执行；更新会话头时用 if_seq_no 防止覆盖并发写入，冲突时重读重试
+        返回是否做了迁移
+        """
+        for _ in range(5):
+            try:
+                result = await self.client.get(index=CHAT_INDEX, id=session_id)
+            except NotFoundError:
+                return False
+            source = result["_source"]
+            if (source.get("storage_version") or 1) >= SESSION_STORAGE_VERSION:
+                return False
+
+            messages = source.pop("messages", None) or []
+            await self._index_messages(session_id, messages)
+            source["message_count"] = len(messages)
+            source["storage_version"] = SESSION_STORAGE_VERSION
+            source.update(last_message_summary(messages))
+            try:
+                await self.client.index(
+                    index=CHAT_INDEX,
+                    id=session_id,
+                    document=source,
+                    if_seq_no=result["_seq_no"],
+                    if_primary_term=result["_primary_term"]
+                )
+                return True
+            except ConflictError:
+                continue
+        raise RuntimeError(f"Too many conflicts migrating session {session_id}")
+
+    async def search_after_page(
+        self,
+        index: str,
+        query: Dict[str, Any],
+        sort: List[Dict[str, Any]],
+        size: int,
+        cursor: Optional[str] = None,
+        use_pit: bool = False,
+        source: Any = None
+    ) -> Dict[str, Any]:
+        """
+        基于 search_after 的游标分页，每页的代价与页码无关，也不受 10000 条窗口的限制
+        use_pit 为 True 时首页打开 point-in-time，后续页都在同一个快照上查询，翻页期间的新写入不会造成重复或遗漏
+        总数只在首页统计；没有下一页时 next_cursor 为 None，并关闭 point-in-time
+        """
+        state = decode_cursor(cursor) if cursor else {}
+        pit_id = state.get("pit")
+        if use_pit and not pit_id and not state:
+            result = await self.client.open_point_in_time(index=index, keep_alive=PIT_KEEP_ALIVE)
+            pit_id = result["id"]
+
+        body = {
+            "query": query,
+            "sort": sort,
+            "size": size,
+            "track_total_hits": not state
+        }
+        if state:
+            body["search_after"] = state["after"]
+        if source is not None:
+            body["_source"] = source
+        if pit_id:
+            body["pit"] = {"id": pit_id, "keep_alive": PIT_KEEP_ALIVE}
+            result = await self.client.search(body=body)
+            pit_id = result.get("pit_id", pit_id)
+        else:
+            result = await self.client.search(index=index, body=body)
+
+        hits = result["hits"]["hits"]
+        next_cursor = None
+        if len(hits) == size:
+            next_cursor = encode_cursor({"after": hits[-1]["sort"], "pit": pit_id})
+        elif pit_id:
+            try:
+                await self.client.close_point_in_time(id=pit_id)
+            except Exception as e:
+                logger.error(f"Error closing point in time: {str(e)}")
+
+        return {
+            "total": result["hits"]["total"]["value"] if not state else None,
+            "hits": hits,
+            "next_cursor": next_cursor
+        }
+
+    async def iter_search_pages(
+        self,
+        index: str,
+        query: Dict[str, Any],
+        sort: List[Dict[str, Any]],
+        source: Any = None,
+        batch_size: int = 1000
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        用 point-in-time + search_after 遍历查询的全部结果，每次返回一批（最多 batch_size 条）
+        同一时间只在内存中保留一批结果，不受 10000 条窗口的限制；结束或中途退出时关闭 point-in-time
+        """
+        result = await self.client.open_point_in_time(index=index, keep_alive=PIT_KEEP_ALIVE)
+        pit_id = result["id"]
+        # _shard_doc 作为最后的排序字段，保证在同一个 point-in-time 中排序唯一
+        body = {
+            "query": query,
+            "sort": sort + [{"_shard_doc": "asc"}],
+            "size": batch_size,
+            "track_total_hits": False
+        }
+        if source is not None:
+            body["_source"] = source
+        try:
+            while True:
+                body["pit"] = {"id": pit_id, "keep_alive": PIT_KEEP_ALIVE}
+                result = await self.client.search(body=body)
+                pit_id = result.get("pit_id", pit_id)
+                hits = result["hits"]["hits"]
+                if hits:
+                    yield hits
+                if len(hits) < batch_size:
+                    break
+                body["search_after"] = hits[-1]["sort"]
+        finally:
+            try:
+                await self.client.close_point_in_time(id=pit_id)
+            except Exception as e:
+                logger.error(f"Error closing point in time: {str(e)}")
+
+    async def increment_usage_rollup(
+        self,
+        user_id: str,
+        ai_type: str,
+        count: int,
+        tokens: int = 0,
+        created_at: Optional[str] = None
+    ):
+        """
+        写入路径上实时累加会话创建日期的使用量汇总（与 UsageRollup.rebuild 一样按 created_at 分天）
+        汇总只用于统计，失败时只记录日志，后台定时重算会修正
+        """
+        if not user_id or not ai_type:
+            return
+        day = (created_at or datetime.now().isoformat())[:10]
+        department = department_of(user_id)
+        try:
+            await self.client.update(
+                index=USAGE_ROLLUP_INDEX,
+                id=usage_rollup_id(day, department, ai_type),
+                script={
+                    "source": "ctx._source.count += params.count; ctx._source.tokens += params.tokens; ctx._source.updated_at = params.now",
+                    "params": {"count": count, "tokens": tokens, "now": datetime.now().isoformat()}
+                },
+                upsert={
+                    "day": day,
+                    "department": department,
+                    "ai_type": ai_type,
+                    "count": count,
+                    "tokens": tokens,
+                    "updated_at": datetime.now().isoformat()
+                },
+                retry_on_conflict=5
+            )
+        except Exception as e:
+            logger.error(f"Error updating usage rollup: {str(e)}")
+
+    async def get_user_chat_sessions(
         self,
         user_id: str,
         from_: int = 0,
         size: int = 10,
         sort_by: str = "timestamp",
-        sort_order: str = "desc"
+        sort_order: str = "desc",
+        summary: bool = False,
+        cursor: Optional[str] = None,
+        use_pit: bool = False,
+        keyword: str = "",
+        include_deleted: bool = True
     ) -> Dict[str, Any]:
-        """获取用户的所有会话列表"""
+        """
+        获取用户的所有会话列表，summary 为 True 时只返回列表展示需要的字段，不读取消息
+        cursor 不为 None 时使用游标分页（首页传空字符串），忽略 from_ 和排序参数
+        keyword 不为空时按标题搜索；include_deleted 为 False 时不返回已删除的会话
+        """
+        must = [{"term": {"user_id": user_id}}]
+        if not include_deleted:
+            must.append({"term": {"is_delete": False}})
+        if keyword.strip():
+            must.append({"match": {"title": keyword}})
         try:
+            if cursor is not None:
+                page = await self.search_after_page(
+                    CHAT_INDEX,
+                    {"bool": {"must": must}},
+                    SESSION_CURSOR_SORT,
+                    size,
+                    cursor=cursor,
+                    use_pit=use_pit,
+                    source=SESSION_LIST_SUMMARY_SOURCE if summary else None
+                )
+                sessions = [hit["_source"] for hit in page["hits"]]
+                if not summary:
+                    sessions = await self.hydrate_sessions(sessions)
+                return {
+                    "total": page["total"],
+                    "sessions": sessions,
+                    "next_cursor": page["next_cursor"]
+                }
+
             query = {
                 "query": {
-                    "term": {
-                        "user_id": user_id
+                    "bool": {
+                        "must": must
                     }
                 },
                 "sort": [
@@ -321,36 +1447,55 @@ class ESClient:
                 "from": from_,
                 "size": size
             }
+            if summary:
+                # 只取列表展示需要的字段，不返回消息和文档
+                query["_source"] = SESSION_LIST_SUMMARY_SOURCE
             
-            result = self.client.search(
+            result = await self.client.search(
                 index=CHAT_INDEX,
                 body=query
             )
             
+            sessions = [hit["_source"] for hit in result["hits"]["hits"]]
+            if not summary:
+                # 新格式的会话需要从消息索引补全 messages
+                sessions = await self.hydrate_sessions(sessions)
             return {
                 "total": result["hits"]["total"]["value"],
-                "sessions": [hit["_source"] for hit in result["hits"]["hits"]]
+                "sessions": sessions
             }
+        except ValueError:
+            # 游标无效，由调用方返回400
+            raise
         except Exception as e:
             logger.error(f"Error retrieving user chat sessions: {str(e)}")
             return {"total": 0, "sessions": []}
 
-    def delete_chat_session(self, session_id: str) -> bool:
+    async def delete_chat_session(self, session_id: str) -> bool:
         """删除指定的会话"""
         try:
-            self.client.delete(
+            message_count = 0
+            try:
+                current = await self.client.get(index=CHAT_INDEX, id=session_id, source_includes=["message_count"])
+                message_count = current["_source"].get("message_count") or 0
+            except NotFoundError:
+                pass
+            await self.client.delete(
                 index=CHAT_INDEX,
                 id=session_id
             )
+            # 会话头记录的消息按ID删除（刚写入还没 refresh 的也能删掉），其余残留的按查询删除
+            await self._delete_messages(session_id, 0, message_count)
+            await self._delete_messages_from(session_id, message_count)
             return True
         except Exception as e:
             logger.error(f"Error deleting chat session: {str(e)}")
             return False
 
-    def get_user_settings(self, user_id: str) -> str:
+    async def get_user_settings(self, user_id: str) -> str:
         """获取用户设置"""
         try:
-            result = self.client.get(
+            result = await self.client.get(
                 index=USER_SETTINGS_INDEX,
                 id=user_id
             )
@@ -359,7 +1504,22 @@ class ESClient:
             logger.error(f"Error retrieving user settings: {str(e)}")
             return ""
 
-    def update_user_settings(self, user_id: str, json_data: str) -> bool:
+    async def get_user_settings_doc(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """获取用户设置及其版本号，不存在时返回None，其它错误直接抛出"""
+        try:
+            result = await self.client.get(
+                index=USER_SETTINGS_INDEX,
+                id=user_id
+            )
+        except NotFoundError:
+            return None
+        return {
+            "json_data": result["_source"].get("json_data", ""),
+            "updated_at": result["_source"].get("updated_at"),
+            "version": result["_version"]
+        }
+
+    async def update_user_settings(self, user_id: str, json_data: str) -> bool:
         """创建或更新用户设置"""
         try:
             doc = {
@@ -367,7 +1527,7 @@ class ESClient:
                 "updated_at": datetime.now().isoformat()
             }
             
-            self.client.index(
+            await self.client.index(
                 index=USER_SETTINGS_INDEX,
                 id=user_id,
                 document=doc
@@ -377,8 +1537,8 @@ class ESClient:
             logger.error(f"Error updating user settings: {str(e)}")
             return False
 
-    def store_chat_stream(
-        self,
+    @staticmethod
+    def build_chat_stream_doc(
         session_id: str,
         user_id: str,
         ai_type: str,
@@ -387,29 +1547,75 @@ class ESClient:
         documents: Any,
         metadata: Any = None,
         model: str = None
-    ) -> bool:
+    ) -> Dict[str, Any]:
+        """构造聊天流记录文档"""
+        return {
+            "session_id": session_id,
+            "user_id": user_id,
+            "ai_type": ai_type,
+            "question": question,
+            "answer": answer,
+            "documents": documents,
+            "model": model,
+            "metadata": metadata or {},
+            "created_at": datetime.now().isoformat()
+        }
+
+    async def store_chat_stream(self, **kwargs) -> bool:
         """存储聊天流记录"""
         try:
-            doc = {
-                "session_id": session_id,
-                "user_id": user_id,
-                "ai_type": ai_type,
-                "question": question,
-                "answer": answer,
-                "documents": documents,
-                "model": model,
-                "metadata": metadata or {},
-                "created_at": datetime.now().isoformat()
-            }
-            
-            self.client.index(
-                index=CHAT_STREAM_INDEX,
-                document=doc
+            doc = self.build_chat_stream_doc(**kwargs)
+            stored = await self.save_documents(collect_documents([doc.get("documents")]))
+            await self.client.index(
+                index=CHAT_STREAM_ALIAS,
+                document={**doc, "documents": document_refs(doc.get("documents"), stored)}
             )
             return True
         except Exception as e:
             logger.error(f"Error storing chat stream: {str(e)}")
             return False
 
+    async def bulk_index(self, index: str, docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """批量写入文档，返回写入失败的文档；请求本身失败时抛出异常"""
+        actions = [{"_index": index, "_source": doc} for doc in docs]
+        failed = []
+        position = 0
+        # bulk 响应中各条结果的顺序与请求一致
+        async for ok, item in helpers.async_streaming_bulk(
+            self.client,
+            actions,
+            chunk_size=max(len(actions), 1),
+            raise_on_error=False
+        ):
+            if not ok:
+                failed.append(docs[position])
+                logger.error(f"Error bulk indexing into {index}: {item}")
+            position += 1
+        return failed
+
+
+class SyncESClient:
+    """
+    供脚本使用的同步封装：在私有的事件循环上运行 ESClient 的异步方法，
+    client 属性是同步的 Elasticsearch 客户端，可直接调用原生接口
+    """
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._async_client = ESClient()
+        self.client = Elasticsearch(ES_HOST, verify_certs=False, request_timeout=ES_REQUEST_TIMEOUT)
+
+    def __getattr__(self, name):
+        attr = getattr(self._async_client, name)
+        if asyncio.iscoroutinefunction(attr):
+            return lambda *args, **kwargs: self._loop.run_until_complete(attr(*args, **kwargs))
+        return attr
+
+    def close(self):
+        self._loop.run_until_complete(self._async_client.close())
+        self._loop.close()
+        self.client.close()
+
+
 # 创建全局单例实例
 es_client = ESClient()
@@ -0,0 +1,69 @@
+"""
+把旧格式（消息嵌套在 messages 数组中）的会话迁移为 会话头文档 + 每条消息一个文档
+
+可以在服务运行时执行：消息文档ID固定，重复执行是安全的；
+会话头用 if_seq_no/if_primary_term 更新，迁移期间有新消息写入时会重读重试；
+迁移前服务端对旧格式会话的读写也都能正常处理
+
+用法：
+    python -m database.migrate_sessions            # 迁移全部
+    python -m database.migrate_sessions --dry-run  # 只统计需要迁移的会话数量
+"""
+import argparse
+import logging
+
+from elasticsearch import helpers
+
+from database.elasticsearch import CHAT_INDEX, SESSION_STORAGE_VERSION, SyncESClient
+
+logger = logging.getLogger(__name__)
+
+
+def iter_legacy_session_ids(es: SyncESClient, batch_size: int):
+    """遍历所有还没有迁移的会话ID"""
+    query = {
+        "query": {
+            "bool": {
+                "must_not": [
+                    {"range": {"storage_version": {"gte": SESSION_STORAGE_VERSION}}}
+                ]
+            }
+        },
+        "_source": False
+    }
+    for hit in helpers.scan(es.client, index=CHAT_INDEX, query=query, size=batch_size):
+        yield hit["_id"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="迁移聊天会话的存储格式")
+    parser.add_argument("--dry-run", action="store_true", help="只统计，不写入")
+    parser.add_argument("--batch-size", type=int, default=500, help="每次scroll读取的会话数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    es = SyncESClient()
+    migrated = skipped = failed = 0
+    try:
+        for session_id in iter_legacy_session_ids(es, args.batch_size):
+            if args.dry_run:
+                skipped += 1
+                continue
+            try:
+                if es.migrate_chat_session(session_id):
+                    migrated += 1
+                else:
+                    skipped += 1
+            except Exception as e:
+                failed += 1
+                logger.error(f"Error migrating session {session_id}: {str(e)}")
+            if (migrated + failed) % 1000 == 0 and migrated:
+                logger.info(f"Progress: migrated={migrated} failed={failed}")
+    finally:
+        es.close()
+
+    logger.info(f"Done: migrated={migrated} skipped={skipped} failed={failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from config import SETTINGS_POLL_INTERVAL, SETTINGS_CACHE_MAX_ITEMS, SETTINGS_CACHE_IDLE_SECONDS
+from database.elasticsearch import es_client
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SettingsEntry:
+    def __init__(self, json_data: str = "", version: int = 0):
+        self.json_data = json_data
+        self.version = version
+        # 最后一次读取的时间，长时间没有读取的不再轮询
+        self.last_read = time.monotonic()
+        self.data: Optional[Dict[str, Any]] = None
+        if json_data:
+            try:
+                self.data = json.loads(json_data)
+            except json.JSONDecodeError:
+                logger.error("Failed to parse settings JSON")
+
+
+class SettingsCache:
+    """
+    进程内的用户设置缓存（如 system_prompt）
+    启动时加载，/chat/prompt/save 写入后立即刷新本进程，
+    后台定时轮询ES，让其它worker进程也能在一个轮询周期内拿到新版本
+    只轮询 idle_seconds 内读取过的设置（启动时预加载的除外），更久没有读取的从缓存删除；
+    缓存的设置数超过 max_items 时淘汰最久没有读取的
+    """
+
+    def __init__(self, poll_interval: float, max_items: int, idle_seconds: float):
+        self.poll_interval = poll_interval
+        self.max_items = max_items
+        self.idle_seconds = idle_seconds
+        self._entries: Dict[str, SettingsEntry] = {}
+        # 启动时预加载的设置，一直保留并轮询
+        self._pinned: set = set()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, ids: Iterable[str] = ()):
+        """在后台等ES就绪后预先加载，不阻塞启动"""
+        self._pinned = set(ids)
+        self._task = asyncio.create_task(self._run(list(ids)))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def get(self, settings_id: str) -> SettingsEntry:
+        """获取设置，未加载过时从ES加载一次"""
+        entry = self._entries.get(settings_id)
+        if entry is not None:
+            metrics.inc("settings_cache.hits")
+            entry.last_read = time.monotonic()
+            return entry
+        metrics.inc("settings_cache.misses")
+        return await self.refresh(settings_id)
+
+    async def refresh_if_cached(self, settings_id: str):
+        """设置被修改后调用：本进程缓存过的立即刷新，没有缓存的等第一次读取时再加载"""
+        if settings_id in self._entries:
+            await self.refresh(settings_id)
+
+    async def refresh(self, settings_id: str) -> SettingsEntry:
+        """从ES重新加载，出错时保留已缓存的版本（出错的结果不缓存，下次再加载）"""
+        try:
+            doc = await es_client.get_user_settings_doc(settings_id)
+        except Exception as e:
+            logger.error(f"Error refreshing settings {settings_id}: {str(e)}")
+            return self._entries.get(settings_id) or SettingsEntry()
+
+        current = self._entries.get(settings_id)
+        if doc is None:
+            entry = SettingsEntry()
+        elif current is not None and current.version == doc["version"]:
+            return current
+        else:
+            entry = SettingsEntry(doc["json_data"], doc["version"])
+            logger.info(f"Loaded settings {settings_id} version {entry.version}")
+        if current is not None:
+            entry.last_read = current.last_read
+        self._entries[settings_id] = entry
+        self._evict()
+        return entry
+
+    def _evict(self):
+        """删除长时间没有读取的设置，超出数量上限时再淘汰最久没有读取的"""
+        deadline = time.monotonic() - self.idle_seconds
+        for settings_id, entry in list(self._entries.items()):
+            if settings_id not in self._pinned and entry.last_read < deadline:
+                del self._entries[settings_id]
+        if len(self._entries) > self.max_items:
+            candidates = sorted(
+                (entry.last_read, settings_id)
+                for settings_id, entry in self._entries.items()
+                if settings_id not in self._pinned
+            )
+            for _, settings_id in candidates[:len(self._entries) - self.max_items]:
+                del self._entries[settings_id]
+
+    async def _run(self, ids: List[str]):
+        await es_client.wait_ready()
+        for settings_id in ids:
+            await self.refresh(settings_id)
+        if self.poll_interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            self._evict()
+            for settings_id in list(self._entries):
+                await self.refresh(settings_id)
+
+    async def system_prompt(self) -> Tuple[Optional[Dict[str, Any]], int]:
+        """返回 (system_prompt 设置, 版本号)，没有设置时为 (None, 0)"""
+        entry = await self.get("system_prompt")
+        return entry.data, entry.version
+
+
+# 创建全局单例实例
+settings_cache = SettingsCache(
+    SETTINGS_POLL_INTERVAL,
+    max_items=SETTINGS_CACHE_MAX_ITEMS,
+    idle_seconds=SETTINGS_CACHE_IDLE_SECONDS
+)
@@ -0,0 +1,218 @@
+"""
+部门/功能使用量的日汇总
+
+会话按创建时间（created_at，写入后不再变化）归到某一天：
+新建会话时计数，之后 token 的变化也累加到创建那天（ESClient.increment_usage_rollup），
+后台任务定时用 composite 聚合按天重算最近几天创建的会话，按确定的文档id覆盖写入，修正实时累加的偏差；
+统计接口只读汇总索引，查询代价只与天数有关，与会话总量无关
+
+补算历史数据：
+    python -m database.usage_rollup --start 2024-01-01 --end 2024-12-31
+"""
+import argparse
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Optional
+
+from elasticsearch import helpers
+
+from config import USAGE_ROLLUP_INTERVAL, USAGE_ROLLUP_RECENT_DAYS
+from database.elasticsearch import (
+    es_client,
+    CHAT_INDEX,
+    USAGE_ROLLUP_INDEX,
+    department_of,
+    usage_rollup_id,
+)
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class UsageRollup:
+    def __init__(self, interval: float, recent_days: int):
+        self.interval = interval
+        self.recent_days = recent_days
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        await es_client.wait_ready()
+        while True:
+            today = date.today()
+            try:
+                await self.rebuild(today - timedelta(days=self.recent_days - 1), today)
+            except Exception as e:
+                logger.error(f"Error rebuilding usage rollup: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def rebuild(self, start_day: date, end_day: date) -> int:
+        """
+        从会话索引重算 [start_day, end_day] 每天创建的会话的汇总并覆盖写入，返回写入的汇总文档数
+        composite 聚合分页遍历所有 (天, 用户, 功能) 组合，不受用户数量限制
+        """
+        rebuilt_at = datetime.now().isoformat()
+        rollups: Dict[str, Dict[str, Any]] = {}
+        body = {
+            "size": 0,
+            "query": {
+                "bool": {
+                    "must": [
+                        {
+                            "range": {
+                                "created_at": {
+                                    "gte": start_day.isoformat(),
+                                    "lt": (end_day + timedelta(days=1)).isoformat()
+                                }
+                            }
+                        }
+                    ],
+                    "must_not": [
+                        {"term": {"is_delete": True}}
+                    ]
+                }
+            },
+            "aggs": {
+                "usage": {
+                    "composite": {
+                        "size": 1000,
+                        "sources": [
+                            {"day": {"date_histogram": {"field": "created_at", "calendar_interval": "1d", "format": "yyyy-MM-dd"}}},
+                            {"user_id": {"terms": {"field": "user_id"}}},
+                            {"ai_type": {"terms": {"field": "ai_type"}}}
+                        ]
+                    },
+                    "aggs": {
+                        "tokens": {"sum": {"field": "total_tokens"}}
+                    }
+                }
+            }
+        }
+        while True:
+            result = await es_client.client.search(index=CHAT_INDEX, body=body)
+            usage = result["aggregations"]["usage"]
+            for bucket in usage["buckets"]:
+                key = bucket["key"]
+                department = department_of(key["user_id"])
+                doc_id = usage_rollup_id(key["day"], department, key["ai_type"])
+                rollup = rollups.setdefault(doc_id, {
+                    "day": key["day"],
+                    "department": department,
+                    "ai_type": key["ai_type"],
+                    "count": 0,
+                    "tokens": 0
+                })
+                rollup["count"] += bucket["doc_count"]
+                rollup["tokens"] += int(bucket["tokens"]["value"] or 0)
+            if "after_key" not in usage or not usage["buckets"]:
+                break
+            body["aggs"]["usage"]["composite"]["after"] = usage["after_key"]
+
+        # 按确定的id覆盖写入，写入期间统计接口读到的始终是完整的汇总
+        actions = [
+            {"_index": USAGE_ROLLUP_INDEX, "_id": doc_id, "_source": {**rollup, "updated_at": rebuilt_at}}
+            for doc_id, rollup in rollups.items()
+        ]
+        if actions:
+            await helpers.async_bulk(es_client.client, actions, refresh="wait_for")
+        # 再删掉范围内这次没有覆盖到、重算开始后也没有再累加过的旧汇总（已经没有会话的组合）
+        await es_client.client.delete_by_query(
+            index=USAGE_ROLLUP_INDEX,
+            body={
+                "query": {
+                    "bool": {
+                        "filter": [
+                            {"range": {"day": {"gte": start_day.isoformat(), "lte": end_day.isoformat()}}},
+                            {"range": {"updated_at": {"lt": rebuilt_at}}}
+                        ]
+                    }
+                }
+            },
+            refresh=True,
+            conflicts="proceed"
+        )
+        metrics.inc("usage_rollup.rebuilds")
+        logger.info(f"Rebuilt usage rollup {start_day} ~ {end_day}: {len(actions)} docs")
+        return len(actions)
+
+    async def department_stats(self, start: datetime, end: datetime) -> Dict[str, Dict[str, int]]:
+        """按天读取汇总，返回 {部门: {功能: 会话数}}；汇总的粒度是天，start/end 只取日期部分"""
+        body = {
+            "size": 0,
+            "query": {
+                "range": {
+                    "day": {
+                        "gte": start.strftime("%Y-%m-%d"),
+                        "lte": end.strftime("%Y-%m-%d")
+                    }
+                }
+            },
+            "aggs": {
+                "departments": {
+                    "terms": {"field": "department", "size": 10000},
+                    "aggs": {
+                        "ai_types": {
+                            "terms": {"field": "ai_type", "size": 1000},
+                            "aggs": {
+                                "count": {"sum": {"field": "count"}}
+                            }
+                        }
+                    }
+                }
+            }
+        }
+        result = await es_client.client.search(index=USAGE_ROLLUP_INDEX, body=body)
+        stats = {}
+        for department_bucket in result["aggregations"]["departments"]["buckets"]:
+            stats[department_bucket["key"]] = {
+                ai_type_bucket["key"]: int(ai_type_bucket["count"]["value"])
+                for ai_type_bucket in department_bucket["ai_types"]["buckets"]
+            }
+        return stats
+
+
+# 创建全局单例实例
+usage_rollup = UsageRollup(USAGE_ROLLUP_INTERVAL, USAGE_ROLLUP_RECENT_DAYS)
+
+
+async def _rebuild(start_day: date, end_day: date):
+    await es_client.init_indices()
+    try:
+        day = start_day
+        total = 0
+        # 按月分段重算，单次聚合的数据量可控
+        while day <= end_day:
+            next_month = (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+            segment_end = min(next_month - timedelta(days=1), end_day)
+            total += await usage_rollup.rebuild(day, segment_end)
+            day = segment_end + timedelta(days=1)
+        logger.info(f"Done: {total} rollup docs written")
+    finally:
+        await es_client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重算部门使用量日汇总")
+    parser.add_argument("--start", required=True, type=date.fromisoformat, help="开始日期 YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, default=date.today(), help="结束日期 YYYY-MM-DD，默认今天")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_rebuild(args.start, args.end))
+
+
+if __name__ == "__main__":
+    main()
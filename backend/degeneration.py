@@ -0,0 +1,133 @@
+from collections import deque
+from typing import Dict, Optional
+
+from config import (
+    DEGENERATION_DETECTOR,
+    DEGENERATION_MIN_CHARS,
+    DEGENERATION_MIN_LINE_LENGTH,
+    DEGENERATION_MAX_LINE_REPEATS,
+    DEGENERATION_NGRAM_SIZE,
+    DEGENERATION_MAX_NGRAM_REPEATS,
+)
+
+
+class DegenerationDetector:
+    """
+    LLM输出退化（反复输出同样内容）检测器的基类
+    每收到一段回答调用一次 feed，返回 True 表示应当中断流，reason 说明原因
+    """
+
+    def __init__(self):
+        self.reason: Optional[str] = None
+
+    @property
+    def tripped(self) -> bool:
+        return self.reason is not None
+
+    def feed(self, text: str) -> bool:
+        return False
+
+
+class RepetitionDetector(DegenerationDetector):
+    """
+    按行统计重复次数：每行结束时只计算这一行的hash并累加计数，
+    不需要回头扫描之前的回答，每段输入的代价只与输入长度有关
+    可选按固定长度的字符窗口（n-gram）用滚动hash统计，用于发现不换行的重复
+    """
+
+    # 滚动hash的基数和模数
+    BASE = 1_000_003
+    MOD = (1 << 61) - 1
+
+    def __init__(
+        self,
+        min_chars: int = 1000,
+        min_line_length: int = 5,
+        max_line_repeats: int = 3,
+        ngram_size: int = 0,
+        max_ngram_repeats: int = 0
+    ):
+        super().__init__()
+        self.min_chars = min_chars
+        self.min_line_length = min_line_length
+        self.max_line_repeats = max_line_repeats
+        self.ngram_size = ngram_size
+        self.max_ngram_repeats = max_ngram_repeats
+
+        self.total_chars = 0
+        self._line_counts: Dict[int, int] = {}
+        self._line_parts = []
+        self._line_length = 0
+
+        self._ngram_counts: Dict[int, int] = {}
+        self._window = deque()
+        self._window_hash = 0
+        self._base_power = pow(self.BASE, max(ngram_size - 1, 0), self.MOD)
+
+    def feed(self, text: str) -> bool:
+        if self.tripped or not text:
+            return self.tripped
+        self.total_chars += len(text)
+
+        pieces = text.split("\n")
+        for index, piece in enumerate(pieces):
+            if index > 0:
+                self._complete_line()
+            if piece:
+                self._line_parts.append(piece)
+                self._line_length += len(piece)
+
+        if self.ngram_size > 0 and self.max_ngram_repeats > 0:
+            self._feed_ngrams(text)
+        return self.tripped
+
+    def _complete_line(self):
+        line_length = self._line_length
+        line = "".join(self._line_parts)
+        self._line_parts = []
+        self._line_length = 0
+        # 太短的行（空行、分隔符等）重复是正常的，不统计
+        if line_length < self.min_line_length:
+            return
+        key = hash(line)
+        count = self._line_counts.get(key, 0) + 1
+        self._line_counts[key] = count
+        if count >= self.max_line_repeats and self.total_chars > self.min_chars:
+            self.reason = "line_repeat"
+
+    def _feed_ngrams(self, text: str):
+        for char in text:
+            code = ord(char)
+            if len(self._window) == self.ngram_size:
+                oldest = self._window.popleft()
+                self._window_hash = (self._window_hash - oldest * self._base_power) % self.MOD
+            self._window.append(code)
+            self._window_hash = (self._window_hash * self.BASE + code) % self.MOD
+            if len(self._window) < self.ngram_size:
+                continue
+            count = self._ngram_counts.get(self._window_hash, 0) + 1
+            self._ngram_counts[self._window_hash] = count
+            if count >= self.max_ngram_repeats and self.total_chars > self.min_chars:
+                self.reason = "ngram_repeat"
+                return
+
+
+# 可用的检测器，通过 DEGENERATION_DETECTOR 配置选择
+DETECTORS = {
+    "none": DegenerationDetector,
+    "repetition": RepetitionDetector,
+}
+
+
+def build_detector() -> DegenerationDetector:
+    """按配置创建一个新的检测器，每个流使用独立的实例"""
+    detector_class = DETECTORS.get(DEGENERATION_DETECTOR, RepetitionDetector)
+    if detector_class is RepetitionDetector:
+        return RepetitionDetector(
+            min_chars=DEGENERATION_MIN_CHARS,
+            min_line_length=DEGENERATION_MIN_LINE_LENGTH,
+            max_line_repeats=DEGENERATION_MAX_LINE_REPEATS,
+            ngram_size=DEGENERATION_NGRAM_SIZE,
+            max_ngram_repeats=DEGENERATION_MAX_NGRAM_REPEATS
+        )
+    return detector_class()
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from config import (
+    UPSTREAM_POOL_LIMIT,
+    UPSTREAM_POOL_LIMIT_PER_HOST,
+    UPSTREAM_DNS_CACHE_TTL,
+    UPSTREAM_KEEPALIVE_TIMEOUT,
+    UPSTREAM_TIMEOUTS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _origin(url: str) -> str:
+    """取url的 scheme://host:port 部分，作为连接池的key"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class UpstreamClientManager:
+    """
+    上游HTTP客户端管理器
+    每个上游base url（CHAT_BASE / OTHER_BASE）共用一个应用级的 ClientSession，
+    复用TCP连接、缓存DNS，避免每个请求都重新握手
+    """
+
+    def __init__(self):
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._lock: Optional[asyncio.Lock] = None
+        self.started = False
+        self.timeouts: Dict[str, aiohttp.ClientTimeout] = {
+            name: aiohttp.ClientTimeout(**profile)
+            for name, profile in UPSTREAM_TIMEOUTS.items()
+        }
+
+    def timeout(self, profile: str = "default") -> aiohttp.ClientTimeout:
+        """按名称获取超时配置，未配置的名称使用 default"""
+        return self.timeouts.get(profile, self.timeouts["default"])
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=UPSTREAM_POOL_LIMIT,
+            limit_per_host=UPSTREAM_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=UPSTREAM_DNS_CACHE_TTL,
+            keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=self.timeout("default"),
+        )
+
+    async def start(self, base_urls=()):
+        """应用启动时调用，预先为已知的上游创建连接池"""
+        self._lock = asyncio.Lock()
+        for base_url in base_urls:
+            if base_url:
+                await self.session(base_url)
+        self.started = True
+
+    async def session(self, url: str) -> aiohttp.ClientSession:
+        """获取url所属上游的共享 ClientSession，不存在时创建"""
+        key = _origin(url)
+        session = self._sessions.get(key)
+        if session is not None and not session.closed:
+            return session
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            session = self._sessions.get(key)
+            if session is None or session.closed:
+                session = self._create_session()
+                self._sessions[key] = session
+                logger.info(f"Created upstream session: {key}")
+            return session
+
+    async def open(self, method: str, url: str, profile: str = "default", **kwargs) -> aiohttp.ClientResponse:
+        """
+        发起请求并返回未读取的响应，用于流式转发
+        调用方负责在读完或出错时调用 response.release()
+        """
+        session = await self.session(url)
+        return await session.request(method, url, timeout=self.timeout(profile), **kwargs)
+
+    async def close(self):
+        """应用关闭时调用，关闭所有连接池"""
+        self.started = False
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+        # 给底层连接留出关闭的时间，避免 Unclosed connection 警告
+        await asyncio.sleep(0.25)
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+async def iter_response(response: aiohttp.ClientResponse, chunk_size: int = STREAM_CHUNK_SIZE):
+    """
+    逐块读取上游响应，读完或中途退出时释放连接
+    下游每发送完一块才会读取下一块，上游读缓冲区有上限，所以内存占用是有界的
+    """
+    try:
+        async for chunk in response.content.iter_chunked(chunk_size):
+            yield chunk
+    finally:
+        response.release()
+
+
+def passthrough_length(response: aiohttp.ClientResponse) -> Optional[str]:
+    """
+    上游返回 Content-Length 时透传；
+    带 Content-Encoding 时 aiohttp 会自动解压，长度与实际发送的不一致，不透传
+    """
+    if response.headers.get("Content-Encoding"):
+        return None
+    return response.headers.get("Content-Length")
+
+
+# 创建全局单例实例
+http_client = UpstreamClientManager()
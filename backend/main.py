@@ -4,17 +4,52 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import StreamingResponse, FileResponse, JSONResponse
 import os
-from config import CORS_ORIGINS, get_url
+from config import CORS_ORIGINS, BASE_URLS, get_url
+from http_client import http_client
+from metrics import metrics
+from database.elasticsearch import es_client
+from database.chat_log_writer import chat_log_writer
+from database.settings_cache import settings_cache
+from database.usage_rollup import usage_rollup
+from chat_streams import chat_streams
 from controller import ChatController, ReportController, UserController
 
 app = FastAPI()
 
+@app.on_event("startup")
+async def startup():
+    # 初始化ES索引，最多等待 ES_STARTUP_TIMEOUT 秒，之后在后台重试
+    await es_client.start()
+    # 为上游服务创建共享的HTTP连接池
+    await http_client.start(BASE_URLS.values())
+    # 聊天流记录的后台批量写入
+    await chat_log_writer.start()
+    # 预先加载 system_prompt 设置
+    await settings_cache.start(["system_prompt"])
+    # 定时重算最近几天的部门使用量汇总
+    await usage_rollup.start()
+    # chat_stream 输出缓冲的定期清理
+    await chat_streams.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    # 先停止聊天流并等待上游任务结束，它们的聊天记录还要经 chat_log_writer 写入，
+    # 所以 chat_log_writer 在后面停止；HTTP 连接池和ES客户端最后关闭
+    await chat_streams.stop()
+    await usage_rollup.stop()
+    await settings_cache.stop()
+    await chat_log_writer.stop()
+    await http_client.close()
+    await es_client.close()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=CORS_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 断线重连需要读取的响应头
+    expose_headers=["X-Stream-Id", "X-Stream-Offset", "X-Answer-Cache"],
 )
 
 # 挂载静态文件目录
@@ -26,6 +61,37 @@ app.include_router(ReportController.router, prefix="/api/report")
 # 研报相关
 app.include_router(UserController.router, prefix="/api/user")
 
+# 进程内指标（缓存命中率等）
+@app.get("/api/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+# 存活检查：进程能处理请求即可
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+# 就绪检查：依赖的服务都可用时返回200，否则返回503
+@app.get("/readyz")
+async def readyz():
+    es_reachable = await es_client.ping()
+    checks = {
+        "elasticsearch": {
+            "initialized": es_client.ready,
+            "reachable": es_reachable,
+            "error": None if es_reachable else es_client.last_error
+        },
+        "upstream_http": {
+            "started": http_client.started
+        },
+        "chat_log": chat_log_writer.stats()
+    }
+    ready = es_client.ready and es_reachable and http_client.started
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "not_ready", "checks": checks}
+    )
+
 # 处理根路径请求，返回index.html
 @app.get("/")
 async def read_index():
@@ -0,0 +1,60 @@
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict
+
+
+class Metrics:
+    """
+    进程内的简单指标收集
+    counter 只增不减；observe 记录次数/总和/最大值；
+    register 可以注册一个返回 dict 的函数，在 snapshot 时一起输出（如缓存命中率）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._observations: Dict[str, Dict[str, float]] = {}
+        self._collectors: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self._started_at = time.time()
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            item = self._observations.get(name)
+            if item is None:
+                item = {"count": 0, "sum": 0.0, "max": 0.0}
+                self._observations[name] = item
+            item["count"] += 1
+            item["sum"] += value
+            item["max"] = max(item["max"], value)
+
+    def register(self, name: str, collector: Callable[[], Dict[str, Any]]):
+        self._collectors[name] = collector
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            observations = {
+                name: {**item, "avg": item["sum"] / item["count"] if item["count"] else 0.0}
+                for name, item in self._observations.items()
+            }
+        collected = {}
+        for name, collector in self._collectors.items():
+            try:
+                collected[name] = collector()
+            except Exception as e:
+                collected[name] = {"error": str(e)}
+        return {
+            "uptime": time.time() - self._started_at,
+            "counters": counters,
+            "observations": observations,
+            **collected
+        }
+
+
+# 创建全局单例实例
+metrics = Metrics()
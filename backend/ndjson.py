@@ -0,0 +1,64 @@
+import json
+import logging
+from typing import Any, List
+
+logger = logging.getLogger(__name__)
+
+
+class NDJSONDecoder:
+    """
+    增量的按行JSON解码器
+    上游的一个chunk可能包含多行，也可能只有半行；
+    未结束的半行留在字节缓冲区里，等下一个chunk到来后再解析，
+    每次只扫描新到的字节，处理一个chunk的代价与chunk大小成正比
+    """
+
+    def __init__(self, max_line_bytes: int = 16 * 1024 * 1024):
+        self.max_line_bytes = max_line_bytes
+        self._buffer = bytearray()
+        # 缓冲区中已经确认没有换行符的长度，下次从这里开始查找
+        self._scanned = 0
+        self.frames = 0
+        self.errors = 0
+
+    def feed(self, chunk: bytes) -> List[Any]:
+        """输入一个chunk，返回其中所有完整行解析出的对象"""
+        self._buffer += chunk
+        frames = []
+        start = 0
+        while True:
+            end = self._buffer.find(b"\n", max(start, self._scanned))
+            if end == -1:
+                break
+            self._decode_line(self._buffer[start:end], frames)
+            start = end + 1
+        if start:
+            del self._buffer[:start]
+        self._scanned = len(self._buffer)
+
+        if len(self._buffer) > self.max_line_bytes:
+            logger.error(f"NDJSON line exceeds {self.max_line_bytes} bytes, dropped")
+            self.errors += 1
+            self._buffer.clear()
+            self._scanned = 0
+        return frames
+
+    def flush(self) -> List[Any]:
+        """流结束时解析缓冲区中剩余的最后一行（没有以换行结尾）"""
+        frames = []
+        if self._buffer:
+            self._decode_line(self._buffer, frames)
+            self._buffer.clear()
+            self._scanned = 0
+        return frames
+
+    def _decode_line(self, line: bytearray, frames: List[Any]):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            frames.append(json.loads(line.decode("utf-8", errors="ignore")))
+            self.frames += 1
+        except json.JSONDecodeError:
+            self.errors += 1
+            logger.error(f"Failed to parse content JSON: {bytes(line[:200])!r}")
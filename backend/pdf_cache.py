@@ -0,0 +1,351 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from typing import AsyncIterator, BinaryIO, Dict, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+from config import PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+RANGE_CHUNK_SIZE = 64 * 1024
+# 超过这个时间还没有 commit/abort 的临时文件视为残留（进程异常退出等），淘汰时删除
+TMP_MAX_AGE = 3600
+
+
+class PdfCacheEntry:
+    def __init__(
+        self,
+        path: str,
+        etag: str,
+        size: int,
+        content_type: str,
+        filename: str,
+        file: Optional[BinaryIO] = None
+    ):
+        self.path = path
+        self.etag = etag
+        self.size = size
+        self.content_type = content_type
+        self.filename = filename
+        # lookup 命中时已打开的blob，之后blob被淘汰（unlink）也不影响读取
+        self.file = file
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class PdfPageCache:
+    """
+    PDF单页的本地磁盘缓存
+    blobs/ 下按内容md5存文件（内容寻址，相同内容只存一份），
+    keys/ 下按请求key存一个小json，记录对应的md5、content_type和文件名；
+    总大小超过上限时按文件修改时间淘汰最久未使用的blob
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.blob_dir = os.path.join(root, "blobs")
+        self.key_dir = os.path.join(root, "keys")
+        self.tmp_dir = os.path.join(root, "tmp")
+        self._total_bytes: Optional[int] = None
+        self._evicting = False
+
+    def _ensure_dirs(self):
+        for path in (self.blob_dir, self.key_dir, self.tmp_dir):
+            os.makedirs(path, exist_ok=True)
+
+    def _key_path(self, key: Tuple[str, ...]) -> str:
+        digest = hashlib.sha1("\x00".join(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.key_dir, f"{digest}.json")
+
+    def _blob_path(self, etag: str) -> str:
+        return os.path.join(self.blob_dir, f"{etag}.pdf")
+
+    def lookup(self, key: Tuple[str, ...]) -> Optional[PdfCacheEntry]:
+        """
+        查找缓存，blob 已被淘汰时视为未命中并删除对应的key文件
+        命中时直接打开blob，返回的 entry 持有文件句柄，调用方负责关闭（cached_file_response 会关闭）
+        """
+        key_path = self._key_path(key)
+        try:
+            with open(key_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            path = self._blob_path(meta["etag"])
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            self._remove_key_file(key_path)
+            return None
+        except OSError:
+            return None
+        try:
+            size = os.fstat(file.fileno()).st_size
+            # 更新修改时间，作为LRU淘汰的依据
+            os.utime(path, None)
+        except OSError:
+            file.close()
+            return None
+        return PdfCacheEntry(path, meta["etag"], size, meta["content_type"], meta["filename"], file)
+
+    def _remove_key_file(self, key_path: str):
+        try:
+            os.remove(key_path)
+        except OSError:
+            pass
+
+    async def writer(self, key: Tuple[str, ...], content_type: str, filename: str) -> "PdfCacheWriter":
+        """创建一个边下载边写入的writer，用于一边转发给客户端一边写缓存"""
+        await asyncio.to_thread(self._ensure_dirs)
+        return PdfCacheWriter(self, key, content_type, filename)
+
+    def _commit(self, key, tmp_path, etag, size, content_type, filename) -> PdfCacheEntry:
+        path = self._blob_path(etag)
+        try:
+            if os.path.exists(path):
+                # 相同内容已经存在（并发未命中同一页，或其他key的相同内容），丢弃这次写入的临时文件
+                os.utime(path, None)
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+                if self._total_bytes is not None:
+                    self._total_bytes += size
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        key_path = self._key_path(key)
+        tmp_key_path = f"{key_path}.{uuid.uuid4().hex}"
+        with open(tmp_key_path, "w", encoding="utf-8") as f:
+            json.dump({"etag": etag, "content_type": content_type, "filename": filename}, f)
+        os.replace(tmp_key_path, key_path)
+
+        if self._total_bytes is None or self._total_bytes > self.max_bytes:
+            self._evict()
+        return PdfCacheEntry(path, etag, size, content_type, filename)
+
+    def _evict(self):
+        """统计blob总大小，超过上限时从最久未使用的开始删除"""
+        if self._evicting:
+            return
+        self._evicting = True
+        try:
+            blobs = []
+            total = 0
+            for entry in os.scandir(self.blob_dir):
+                if entry.is_file():
+                    stat = entry.stat()
+                    blobs.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            if total > self.max_bytes:
+                blobs.sort()
+                for _, size, path in blobs:
+                    if total <= self.max_bytes * 0.9:
+                        break
+                    try:
+                        os.remove(path)
+                        total -= size
+                        metrics.inc("pdf_cache.evictions")
+                    except OSError:
+                        pass
+            self._total_bytes = total
+            self._remove_orphan_keys()
+            self._remove_stale_tmp()
+        except OSError as e:
+            logger.error(f"Error evicting pdf cache: {str(e)}")
+        finally:
+            self._evicting = False
+
+    def _remove_orphan_keys(self):
+        """删除blob已经不存在的key文件，否则 keys/ 会随着不同的请求key无限增长"""
+        blobs = {entry.name for entry in os.scandir(self.blob_dir)}
+        for entry in os.scandir(self.key_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path, "r", encoding="utf-8") as f:
+                    etag = json.load(f)["etag"]
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError, KeyError, TypeError):
+                # 内容损坏的key文件同样无法命中，一并删除
+                etag = None
+            if etag is None or f"{etag}.pdf" not in blobs:
+                self._remove_key_file(entry.path)
+
+    def _remove_stale_tmp(self):
+        deadline = time.time() - TMP_MAX_AGE
+        for entry in os.scandir(self.tmp_dir):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+
+class PdfCacheWriter:
+    """写入临时文件并增量计算md5，commit 后移动到 blobs/；未 commit 的临时文件在 abort 时删除"""
+
+    def __init__(self, cache: PdfPageCache, key: Tuple[str, ...], content_type: str, filename: str):
+        self.cache = cache
+        self.key = key
+        self.content_type = content_type
+        self.filename = filename
+        self.tmp_path = os.path.join(cache.tmp_dir, uuid.uuid4().hex)
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self._file = open(self.tmp_path, "wb")
+
+    async def write(self, chunk: bytes):
+        self.md5.update(chunk)
+        self.size += len(chunk)
+        await asyncio.to_thread(self._file.write, chunk)
+
+    async def commit(self) -> PdfCacheEntry:
+        self._file.close()
+        return await asyncio.to_thread(
+            self.cache._commit,
+            self.key,
+            self.tmp_path,
+            self.md5.hexdigest(),
+            self.size,
+            self.content_type,
+            self.filename
+        )
+
+    def abort(self):
+        try:
+            if not self._file.closed:
+                self._file.close()
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+        except OSError as e:
+            logger.error(f"Error removing pdf cache temp file {self.tmp_path}: {str(e)}")
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """判断 If-None-Match 是否包含当前ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag.strip('"') == etag:
+            return True
+    return False
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析单段 Range 头，返回 [start, end] 闭区间
+    不支持的格式（多段等）返回 None，按完整文件返回；区间不合法时抛 ValueError
+    """
+    if not range_header:
+        return None
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header)
+    if not match:
+        return None
+    start, end = match.groups()
+    if start == "" and end == "":
+        return None
+    if start == "":
+        # bytes=-500 表示最后500字节
+        length = int(end)
+        if length == 0:
+            raise ValueError("empty suffix range")
+        start = max(size - length, 0)
+        end = size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+
+async def iter_file_range(entry: PdfCacheEntry, start: int, length: int) -> AsyncIterator[bytes]:
+    """从 entry 已打开的文件读取 [start, start + length)，读完或中断时关闭文件"""
+    f = entry.file
+    try:
+        await asyncio.to_thread(f.seek, start)
+        remaining = length
+        while remaining > 0:
+            chunk = await asyncio.to_thread(f.read, min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        entry.close()
+
+
+def cached_file_response(request: Request, entry: PdfCacheEntry, headers: Dict[str, str]) -> Response:
+    """
+    根据 If-None-Match / Range 返回 304、206 或完整文件
+    文件内容从 lookup 时打开的句柄读取，响应期间blob被淘汰也能完整返回
+    """
+    etag = f'"{entry.etag}"'
+    headers = {
+        **headers,
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+    }
+
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        metrics.inc("pdf_cache.not_modified")
+        entry.close()
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # If-Range 不匹配时忽略 Range，返回完整文件
+    if range_header and (not if_range or etag_matches(if_range, entry.etag)):
+        try:
+            byte_range = parse_range(range_header, entry.size)
+        except ValueError:
+            entry.close()
+            return Response(
+                status_code=416,
+                headers={**headers, "Content-Range": f"bytes */{entry.size}"}
+            )
+        if byte_range is not None:
+            start, end = byte_range
+            length = end - start + 1
+            metrics.inc("pdf_cache.partial")
+            return StreamingResponse(
+                iter_file_range(entry, start, length),
+                status_code=206,
+                media_type=entry.content_type,
+                headers={
+                    **headers,
+                    "Content-Range": f"bytes {start}-{end}/{entry.size}",
+                    "Content-Length": str(length),
+                }
+            )
+
+    return StreamingResponse(
+        iter_file_range(entry, 0, entry.size),
+        media_type=entry.content_type,
+        headers={**headers, "Content-Length": str(entry.size)}
+    )
+
+
+# 创建全局单例实例
+pdf_cache = PdfPageCache(PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES)
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import logging
+import time
+from typing import AsyncIterator
+
+from starlette.responses import StreamingResponse
+from starlette.types import Send
+
+from chat_streams import ChatStream, StreamFailed, StreamGone
+from config import (
+    CHAT_STREAM_HIGH_WATER,
+    CHAT_STREAM_SLOW_CLIENT_TIMEOUT,
+    CHAT_STREAM_SLOW_CLIENT_POLICY,
+    CHAT_STREAM_ABANDON_SECONDS,
+    CHAT_STREAM_READ_SIZE,
+)
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 上游帧之间的分隔符
+FRAME_SEPARATOR = b"\n\n"
+# 断开慢客户端时发送 resume 帧和响应结束标记的超时（秒），客户端完全不读取时放弃，由服务器直接断开连接
+CLOSE_TIMEOUT = 1
+
+
+def control_frame(event: str, stream_id: str, offset: int, **fields) -> bytes:
+    """
+    本服务插入的控制帧，格式与上游帧相同（JSON + 分隔符），用 event 字段区分
+    控制帧不属于流的内容，客户端重连时的偏移量不计入控制帧的字节，使用帧中的 offset
+    """
+    frame = {"event": event, "stream_id": stream_id, "offset": offset, **fields}
+    return json.dumps(frame, ensure_ascii=False).encode("utf-8") + FRAME_SEPARATOR
+
+
+class SlowClient(Exception):
+    """客户端读取太慢，按策略断开"""
+
+
+class StreamPump:
+    """
+    把 ChatStream 输出给一个客户端
+    上游读取任务只往 ChatStream 写（内存有上限，超出落盘），从不等待客户端；
+    这里按客户端的速度读取：落后上游超过 high_water 字节持续 slow_timeout 秒，
+    或单次发送阻塞超过 slow_timeout 秒，视为慢客户端，按 policy 断开或只记录
+    结束时记录这个客户端的吞吐统计（字节/秒、帧/秒、发送阻塞时间、最大落后字节数）
+    """
+
+    def __init__(
+        self,
+        stream: ChatStream,
+        offset: int = 0,
+        high_water: int = CHAT_STREAM_HIGH_WATER,
+        slow_timeout: float = CHAT_STREAM_SLOW_CLIENT_TIMEOUT,
+        policy: str = CHAT_STREAM_SLOW_CLIENT_POLICY,
+        abandon_seconds: float = CHAT_STREAM_ABANDON_SECONDS,
+        read_size: int = CHAT_STREAM_READ_SIZE
+    ):
+        self.stream = stream
+        self.offset = offset
+        self.high_water = high_water
+        self.slow_timeout = slow_timeout
+        self.policy = policy
+        self.abandon_seconds = abandon_seconds
+        self.read_size = read_size
+
+        self.bytes = 0
+        self.frames = 0
+        self.stall_seconds = 0.0
+        self.max_lag = 0
+        self._lagging_since = None
+
+    @property
+    def send_timeout(self):
+        """单次发送的超时，ignore 策略不限制"""
+        return self.slow_timeout if self.policy == "disconnect" else None
+
+    def check_lag(self):
+        """每发送一块之前检查落后上游的字节数"""
+        lag = self.stream.size - self.offset
+        self.max_lag = max(self.max_lag, lag)
+        if lag <= self.high_water:
+            self._lagging_since = None
+            return
+        now = time.monotonic()
+        if self._lagging_since is None:
+            self._lagging_since = now
+        elif now - self._lagging_since > self.slow_timeout:
+            self._lagging_since = None
+            metrics.inc("chat_stream.slow_clients")
+            if self.policy == "disconnect":
+                raise SlowClient(f"client lagging {lag} bytes behind")
+
+    def sent(self, chunk: bytes, seconds: float):
+        self.offset += len(chunk)
+        self.bytes += len(chunk)
+        self.frames += chunk.count(FRAME_SEPARATOR)
+        self.stall_seconds += seconds
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        try:
+            async for chunk in self.stream.iter_from(self.offset, self.read_size):
+                yield chunk
+        except asyncio.CancelledError:
+            print(f"客户端断开连接, stream id: {self.stream.stream_id}")
+            raise
+        except StreamGone as e:
+            print(f"Stream {self.stream.stream_id} no longer available: {str(e)}")
+            yield control_frame("error", self.stream.stream_id, self.stream.size, error="stream_gone")
+        except StreamFailed as e:
+            # 上游中途失败，用 error 帧告诉客户端回答不完整，不让客户端把它当成正常结束
+            print(f"Stream {self.stream.stream_id} failed: {str(e)}")
+            yield control_frame("error", self.stream.stream_id, self.stream.size, error=str(e))
+
+    def attach(self):
+        self.stream.readers += 1
+
+    def detach(self):
+        self.stream.readers -= 1
+        if self.stream.readers <= 0 and not self.stream.finished and self.abandon_seconds > 0:
+            asyncio.get_running_loop().call_later(self.abandon_seconds, self._abandon_if_idle)
+
+    def _abandon_if_idle(self):
+        stream = self.stream
+        if stream.readers <= 0 and not stream.finished and stream.task is not None:
+            print(f"No client reading stream {stream.stream_id}, cancelling upstream")
+            metrics.inc("chat_stream.abandoned")
+            stream.task.cancel()
+
+    def record(self, seconds: float):
+        seconds = max(seconds, 1e-6)
+        metrics.observe("chat_stream.client_bytes", self.bytes)
+        metrics.observe("chat_stream.client_bytes_per_second", self.bytes / seconds)
+        metrics.observe("chat_stream.client_frames_per_second", self.frames / seconds)
+        metrics.observe("chat_stream.client_stall_seconds", self.stall_seconds)
+        metrics.observe("chat_stream.client_max_lag_bytes", self.max_lag)
+
+
+class PumpedStreamingResponse(StreamingResponse):
+    """
+    由 StreamPump 驱动的流式响应
+    每次发送都计时并受 send_timeout 限制，客户端不读取时不会无限期占用连接
+    """
+
+    def __init__(self, pump: StreamPump, **kwargs):
+        super().__init__(pump.chunks(), **kwargs)
+        self.pump = pump
+
+    async def stream_response(self, send: Send) -> None:
+        pump = self.pump
+        began = time.monotonic()
+        pump.attach()
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers
+            })
+            async for chunk in self.body_iterator:
+                pump.check_lag()
+                send_began = time.monotonic()
+                try:
+                    await asyncio.wait_for(
+                        send({"type": "http.response.body", "body": chunk, "more_body": True}),
+                        pump.send_timeout
+                    )
+                except asyncio.TimeoutError:
+                    metrics.inc("chat_stream.slow_clients")
+                    raise SlowClient(f"send blocked for more than {pump.slow_timeout}s")
+                pump.sent(chunk, time.monotonic() - send_began)
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        except SlowClient as e:
+            # 只结束这个客户端的响应，不向ASGI应用抛出异常，上游继续生成；
+            # 先发一个 resume 帧告诉客户端从哪个偏移重连，再正常结束。
+            # 客户端已经完全不读取、resume 帧也发不出去时不发送结束标记，由服务器直接断开连接，
+            # 客户端看到的是不完整的响应，按已收到的字节数（X-Stream-Offset + 收到的长度）重连
+            logger.warning(f"Slow client on stream {pump.stream.stream_id} at offset {pump.offset}: {str(e)}")
+            metrics.inc("chat_stream.slow_client_disconnects")
+            await self.body_iterator.aclose()
+            frame = control_frame("resume", pump.stream.stream_id, pump.offset, reason="slow_client")
+            try:
+                await asyncio.wait_for(
+                    send({"type": "http.response.body", "body": frame, "more_body": True}),
+                    CLOSE_TIMEOUT
+                )
+                await asyncio.wait_for(
+                    send({"type": "http.response.body", "body": b"", "more_body": False}),
+                    CLOSE_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                metrics.inc("chat_stream.slow_client_aborts")
+        finally:
+            pump.detach()
+            pump.record(time.monotonic() - began)
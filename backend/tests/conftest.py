@@ -0,0 +1,83 @@
+import json
+import os
+import sys
+
+# 测试不连接ES，只需要一个合法的地址让客户端可以创建
+os.environ.setdefault("ES_HOST", "http://localhost:9200")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from elasticsearch import NotFoundError
+from elasticsearch.serializer import JsonSerializer
+
+from database import elasticsearch as es_module
+
+_serializer = JsonSerializer()
+
+
+class FakeES:
+    """内存中的ES替身：按 (index, id) 保存经过JSON序列化的 _source，记录每个写入的文档"""
+
+    def __init__(self):
+        self.docs = {}
+        self.seq_no = 0
+        self.writes = []
+
+    def _store(self, index, doc_id, source):
+        self.seq_no += 1
+        self.docs[(index, doc_id)] = (json.loads(_serializer.dumps(source)), self.seq_no)
+        self.writes.append((index, doc_id))
+        return {"_id": doc_id, "_seq_no": self.seq_no, "_primary_term": 1, "result": "updated"}
+
+    @staticmethod
+    def _project(source, includes=None, excludes=None):
+        if includes:
+            source = {key: value for key, value in source.items() if key in includes}
+        if excludes:
+            source = {key: value for key, value in source.items() if key not in excludes}
+        return source
+
+    async def get(self, index, id, source_includes=None, **kwargs):
+        if (index, id) not in self.docs:
+            raise NotFoundError("not found", None, {})
+        source, seq_no = self.docs[(index, id)]
+        return {"_id": id, "_source": self._project(source, source_includes), "_seq_no": seq_no, "_primary_term": 1}
+
+    async def mget(self, index, ids, source_excludes=None, **kwargs):
+        docs = []
+        for doc_id in ids:
+            if (index, doc_id) in self.docs:
+                source, _ = self.docs[(index, doc_id)]
+                docs.append({"_id": doc_id, "found": True, "_source": self._project(source, excludes=source_excludes)})
+            else:
+                docs.append({"_id": doc_id, "found": False})
+        return {"docs": docs}
+
+    async def index(self, index, id=None, document=None, **kwargs):
+        return self._store(index, id, document)
+
+    async def update(self, index, id, **kwargs):
+        return {"_id": id, "result": "noop"}
+
+    async def delete(self, index, id, **kwargs):
+        self.docs.pop((index, id), None)
+
+    def index_writes(self, index):
+        return [doc_id for written_index, doc_id in self.writes if written_index == index]
+
+
+@pytest.fixture
+def fake_es(monkeypatch):
+    fake = FakeES()
+
+    async def async_bulk(client, actions, **kwargs):
+        for action in actions:
+            if action.get("_op_type") == "delete":
+                fake.docs.pop((action["_index"], action["_id"]), None)
+            else:
+                fake._store(action["_index"], action["_id"], action["_source"])
+        return len(actions), []
+
+    monkeypatch.setattr(es_module.es_client, "client", fake)
+    monkeypatch.setattr(es_module.helpers, "async_bulk", async_bulk)
+    return fake
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from cache import TTLCache
+
+
+def test_concurrent_misses_share_one_load():
+    cache = TTLCache("test", max_bytes=1024, max_items=10, ttl=60)
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        await asyncio.sleep(0.01)
+        return "value"
+
+    async def run():
+        return await asyncio.gather(*[cache.get_or_load("key", loader) for _ in range(5)])
+
+    assert asyncio.run(run()) == ["value"] * 5
+    assert len(loads) == 1
+    assert cache.misses == 1 and cache.coalesced == 4
+    assert cache.get("key") == (True, "value")
+
+
+def test_failed_load_is_not_cached():
+    cache = TTLCache("test", max_bytes=1024, max_items=10, ttl=60)
+
+    async def loader():
+        raise RuntimeError("boom")
+
+    async def run():
+        return await asyncio.gather(
+            cache.get_or_load("key", loader),
+            cache.get_or_load("key", loader),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert cache.get("key") == (False, None)
+
+
+def test_evicts_least_recently_used_by_items_and_bytes():
+    cache = TTLCache("test", max_bytes=10, max_items=2, ttl=60)
+    cache.set("a", b"1")
+    cache.set("b", b"2")
+    cache.get("a")
+    cache.set("c", b"3")
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, b"1")
+
+    cache.set("d", b"1234567890")
+    assert len(cache) == 1 and cache.current_bytes == 10
+    # 单个值超过总容量时不缓存
+    cache.set("e", b"x" * 11)
+    assert cache.get("e") == (False, None)
+    assert cache.evictions == 3
+
+
+def test_expired_entry_is_a_miss(monkeypatch):
+    cache = TTLCache("test", max_bytes=1024, max_items=10, ttl=60)
+    now = [1000.0]
+    monkeypatch.setattr("cache.time.monotonic", lambda: now[0])
+    cache.set("key", "value", ttl=5)
+    now[0] += 6
+    assert cache.get("key") == (False, None)
+    assert cache.expirations == 1 and cache.current_bytes == 0
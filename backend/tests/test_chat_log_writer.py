@@ -0,0 +1,68 @@
+import asyncio
+import json
+import os
+
+from database.chat_log_writer import ChatLogWriter
+
+
+def make_writer(tmp_path, batch_size=2):
+    return ChatLogWriter(
+        "chat_stream",
+        queue_size=10,
+        batch_size=batch_size,
+        flush_interval=0.01,
+        max_retries=1,
+        spill_path=str(tmp_path / "spill.ndjson")
+    )
+
+
+def write_spill(writer, count):
+    with open(writer.spill_path, "w", encoding="utf-8") as f:
+        for i in range(count):
+            f.write(json.dumps({"n": i}) + "\n")
+
+
+def read_spill(writer):
+    with open(writer.spill_path, "r", encoding="utf-8") as f:
+        return [json.loads(line)["n"] for line in f]
+
+
+def test_replay_flushes_spill_in_batches(tmp_path, monkeypatch):
+    writer = make_writer(tmp_path)
+    write_spill(writer, 5)
+    batches = []
+
+    async def flush(batch, max_retries):
+        batches.append([doc["n"] for doc in batch])
+        return True
+
+    monkeypatch.setattr(writer, "_flush", flush)
+    asyncio.run(writer._replay_spill())
+
+    assert batches == [[0, 1], [2, 3], [4]]
+    assert not os.path.exists(writer.spill_path)
+    assert not os.path.exists(f"{writer.spill_path}.replay")
+
+
+def test_cancelled_replay_puts_unreplayed_records_back(tmp_path, monkeypatch):
+    writer = make_writer(tmp_path)
+    write_spill(writer, 6)
+
+    async def flush(batch, max_retries):
+        if batch[0]["n"] == 2:
+            # 与 _flush 一样，被取消时当前批次自己落盘
+            writer._write_spill(batch)
+            raise asyncio.CancelledError()
+        return True
+
+    monkeypatch.setattr(writer, "_flush", flush)
+
+    async def run():
+        try:
+            await writer._replay_spill()
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+    assert sorted(read_spill(writer)) == [2, 3, 4, 5]
+    assert not os.path.exists(f"{writer.spill_path}.replay")
@@ -0,0 +1,38 @@
+from degeneration import RepetitionDetector
+
+
+def test_repeated_lines_trip_after_min_chars():
+    detector = RepetitionDetector(min_chars=20, min_line_length=5, max_line_repeats=3)
+    assert not detector.feed("重复的一行内容\n")
+    assert not detector.feed("重复的一行内容\n")
+    assert detector.feed("重复的一行内容\n")
+    assert detector.reason == "line_repeat"
+
+
+def test_line_split_across_chunks_counts_as_one_line():
+    detector = RepetitionDetector(min_chars=0, min_line_length=5, max_line_repeats=2)
+    assert not detector.feed("abc")
+    assert not detector.feed("defg\nabc")
+    assert detector.feed("defg\n")
+
+
+def test_short_lines_and_short_answers_are_ignored():
+    detector = RepetitionDetector(min_chars=1000, min_line_length=5, max_line_repeats=2)
+    for _ in range(10):
+        assert not detector.feed("---\n")
+    for _ in range(3):
+        assert not detector.feed("同一行但回答还很短\n")
+    assert not detector.tripped
+
+
+def test_ngram_repeat_without_newlines():
+    detector = RepetitionDetector(min_chars=0, max_line_repeats=100, ngram_size=4, max_ngram_repeats=3)
+    assert detector.feed("abcd" * 3)
+    assert detector.reason == "ngram_repeat"
+
+
+def test_distinct_text_does_not_trip():
+    detector = RepetitionDetector(min_chars=0, max_line_repeats=2, ngram_size=8, max_ngram_repeats=2)
+    for i in range(50):
+        detector.feed(f"{i * 7919:08d}\n")
+    assert not detector.tripped
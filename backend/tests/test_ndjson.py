@@ -0,0 +1,31 @@
+from ndjson import NDJSONDecoder
+
+
+def test_lines_split_across_chunks():
+    decoder = NDJSONDecoder()
+    assert decoder.feed(b'{"a": 1}\n{"b"') == [{"a": 1}]
+    assert decoder.feed(b': 2}\n\n{"c": 3}') == [{"b": 2}]
+    assert decoder.flush() == [{"c": 3}]
+    assert decoder.frames == 3
+    assert decoder.flush() == []
+
+
+def test_multibyte_character_split_across_chunks():
+    decoder = NDJSONDecoder()
+    encoded = '{"text": "研报"}\n'.encode("utf-8")
+    assert decoder.feed(encoded[:12]) == []
+    assert decoder.feed(encoded[12:]) == [{"text": "研报"}]
+
+
+def test_invalid_line_is_counted_and_skipped():
+    decoder = NDJSONDecoder()
+    assert decoder.feed(b'not json\n{"ok": true}\n') == [{"ok": True}]
+    assert decoder.errors == 1
+
+
+def test_oversized_line_is_dropped():
+    decoder = NDJSONDecoder(max_line_bytes=8)
+    assert decoder.feed(b'{"a": "0123456789"') == []
+    assert decoder.errors == 1
+    # 丢弃后从下一行重新开始
+    assert decoder.feed(b'\n{"b": 1}\n') == [{"b": 1}]
@@ -0,0 +1,106 @@
+import asyncio
+import os
+
+import pytest
+from starlette.requests import Request
+
+from pdf_cache import PdfPageCache, cached_file_response, etag_matches, parse_range
+
+CONTENT = b"%PDF-0123456789"
+
+
+def make_request(**headers):
+    return Request({
+        "type": "http",
+        "headers": [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()]
+    })
+
+
+def store(cache, key=("report", "p1", "1"), content=CONTENT):
+    async def run():
+        writer = await cache.writer(key, "application/pdf", "p1.pdf")
+        await writer.write(content)
+        return await writer.commit()
+    return asyncio.run(run())
+
+
+def body(response):
+    async def run():
+        return b"".join([chunk async for chunk in response.body_iterator])
+    return asyncio.run(run())
+
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=95-200", 100) == (95, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=-500", 100) == (0, 99)
+    # 多段等不支持的格式按完整文件返回
+    assert parse_range("bytes=0-1,5-6", 100) is None
+    assert parse_range("items=0-1", 100) is None
+    for header in ("bytes=100-", "bytes=10-5", "bytes=-0"):
+        with pytest.raises(ValueError):
+            parse_range(header, 100)
+
+
+def test_etag_matches():
+    assert etag_matches('"abc"', "abc")
+    assert etag_matches('W/"abc"', "abc")
+    assert etag_matches('"x", "abc"', "abc")
+    assert etag_matches("*", "abc")
+    assert not etag_matches('"x"', "abc")
+    assert not etag_matches(None, "abc")
+
+
+def test_full_partial_not_modified_and_unsatisfiable(tmp_path):
+    cache = PdfPageCache(str(tmp_path), 1024 * 1024)
+    etag = store(cache).etag
+    key = ("report", "p1", "1")
+
+    response = cached_file_response(make_request(), cache.lookup(key), {})
+    assert response.status_code == 200
+    assert response.headers["etag"] == f'"{etag}"'
+    assert response.headers["content-length"] == str(len(CONTENT))
+    assert body(response) == CONTENT
+
+    response = cached_file_response(make_request(range="bytes=5-8"), cache.lookup(key), {})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 5-8/{len(CONTENT)}"
+    assert body(response) == CONTENT[5:9]
+
+    response = cached_file_response(make_request(if_none_match=f'"{etag}"'), cache.lookup(key), {})
+    assert response.status_code == 304
+
+    response = cached_file_response(make_request(range="bytes=999-"), cache.lookup(key), {})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(CONTENT)}"
+
+    # If-Range 与当前ETag不一致时忽略 Range
+    response = cached_file_response(make_request(range="bytes=0-3", if_range='"old"'), cache.lookup(key), {})
+    assert response.status_code == 200
+    assert body(response) == CONTENT
+
+
+def test_blob_evicted_after_lookup_is_still_served(tmp_path):
+    cache = PdfPageCache(str(tmp_path), 1024 * 1024)
+    store(cache)
+    entry = cache.lookup(("report", "p1", "1"))
+    os.remove(entry.path)
+    assert body(cached_file_response(make_request(), entry, {})) == CONTENT
+    # 之后的查找视为未命中，并删除对应的key文件
+    assert cache.lookup(("report", "p1", "1")) is None
+    assert os.listdir(cache.key_dir) == []
+
+
+def test_eviction_removes_orphaned_keys(tmp_path):
+    cache = PdfPageCache(str(tmp_path), 20)
+    entry = store(cache, ("report", "p1", "1"), b"a" * 15)
+    os.utime(entry.path, (0, 0))
+    store(cache, ("report", "p2", "1"), b"b" * 15)
+    assert cache.lookup(("report", "p1", "1")) is None
+    entry = cache.lookup(("report", "p2", "1"))
+    assert entry is not None
+    entry.close()
+    assert len(os.listdir(cache.key_dir)) == 1
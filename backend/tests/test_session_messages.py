@@ -0,0 +1,106 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from database import elasticsearch as es_module
+from database.elasticsearch import es_client, CHAT_INDEX, CHAT_MESSAGE_INDEX
+
+
+def session_messages():
+    # 与 ChatMessage.dict() 相同，timestamp 是 datetime
+    return [
+        {"role": "user", "content": "问题", "timestamp": datetime(2025, 1, 2, 3, 4, 5, 123000), "documents": None},
+        {"role": "assistant", "content": "回答", "timestamp": datetime(2025, 1, 2, 3, 4, 6), "documents": None},
+    ]
+
+
+def store(messages):
+    return asyncio.run(es_client.store_chat_session(
+        session_id="s1",
+        user_id="dept_user",
+        ai_type="report",
+        messages=messages,
+        title="标题"
+    ))
+
+
+def test_saving_same_session_twice_writes_no_messages(fake_es):
+    assert store(session_messages())
+    assert len(fake_es.index_writes(CHAT_MESSAGE_INDEX)) == 2
+
+    fake_es.writes.clear()
+    assert store(session_messages())
+    assert fake_es.index_writes(CHAT_MESSAGE_INDEX) == []
+
+
+def test_only_new_and_changed_messages_are_written(fake_es):
+    store(session_messages())
+    fake_es.writes.clear()
+
+    messages = session_messages()
+    messages[1]["content"] = "修改后的回答"
+    messages.append({"role": "user", "content": "追问", "timestamp": datetime(2025, 1, 2, 3, 5), "documents": None})
+    store(messages)
+    assert sorted(fake_es.index_writes(CHAT_MESSAGE_INDEX)) == ["s1_1", "s1_2"]
+
+
+def test_messages_without_timestamp_keep_the_stored_one(fake_es):
+    store(session_messages())
+    fake_es.writes.clear()
+
+    messages = session_messages()
+    for message in messages:
+        message["timestamp"] = None
+    store(messages)
+    assert fake_es.index_writes(CHAT_MESSAGE_INDEX) == []
+
+
+def test_trimmed_messages_are_deleted(fake_es):
+    store(session_messages())
+    store(session_messages()[:1])
+    assert (CHAT_MESSAGE_INDEX, "s1_1") not in fake_es.docs
+    assert (CHAT_MESSAGE_INDEX, "s1_0") in fake_es.docs
+
+
+def test_failed_message_write_rolls_back_new_session(fake_es, monkeypatch):
+    rollups = []
+
+    async def increment_usage_rollup(*args, **kwargs):
+        rollups.append(args)
+
+    async def failing_bulk(client, actions, **kwargs):
+        raise ConnectionError("bulk failed")
+
+    monkeypatch.setattr(es_client, "increment_usage_rollup", increment_usage_rollup)
+    monkeypatch.setattr(es_module.helpers, "async_bulk", failing_bulk)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(es_client.apply_session_delta(
+            "s1", None, 0, session_messages(), {"user_id": "dept_user", "ai_type": "report", "title": "标题"}
+        ))
+    # 会话头不会指向没有写入的消息，使用量汇总也没有累加
+    assert (CHAT_INDEX, "s1") not in fake_es.docs
+    assert rollups == []
+
+
+def test_soft_delete_decrements_creation_day_rollup_once(fake_es, monkeypatch):
+    rollups = []
+    deleted = set()
+
+    async def update(index, id, **kwargs):
+        if id in deleted:
+            return {"_id": id, "result": "noop"}
+        deleted.add(id)
+        source = {"user_id": "dept_user", "ai_type": "report", "total_tokens": 30, "created_at": "2025-01-02T03:04:05"}
+        return {"_id": id, "result": "updated", "get": {"_source": source}}
+
+    async def increment_usage_rollup(*args, **kwargs):
+        rollups.append(args)
+
+    monkeypatch.setattr(fake_es, "update", update)
+    monkeypatch.setattr(es_client, "increment_usage_rollup", increment_usage_rollup)
+
+    assert asyncio.run(es_client.soft_delete_chat_session("s1"))
+    assert not asyncio.run(es_client.soft_delete_chat_session("s1"))
+    assert rollups == [("dept_user", "report", -1, -30, "2025-01-02T03:04:05")]
@@ -0,0 +1,111 @@
+import asyncio
+import json
+
+from chat_streams import ChatStream, ChatStreamRegistry
+from stream_pump import StreamPump, PumpedStreamingResponse, FRAME_SEPARATOR
+
+
+def make_stream():
+    stream = ChatStream("sid", "owner", memory_limit=1024 * 1024, spill_dir="")
+    stream.set_started()
+    return stream
+
+
+def test_blocked_client_is_aborted_without_terminating_chunk():
+    async def run():
+        stream = make_stream()
+        stream.append(b'{"data": "a"}\n\n')
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+            if message["type"] == "http.response.body":
+                # 客户端不再读取，发送一直阻塞
+                await asyncio.sleep(3600)
+
+        pump = StreamPump(stream, slow_timeout=0.05, policy="disconnect")
+        await PumpedStreamingResponse(pump).stream_response(send)
+        return stream, sent
+
+    stream, sent = asyncio.run(run())
+    assert not any(m.get("more_body") is False for m in sent)
+    assert stream.readers == 0
+
+
+def test_lagging_client_gets_resume_frame_with_offset():
+    async def run():
+        stream = make_stream()
+        first = b'{"data": "a"}\n\n'
+        stream.append(first)
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+            if message["type"] == "http.response.body" and message["body"] == first:
+                # 客户端读得慢的时候上游又产生了大量数据
+                stream.append(b'{"data": "' + b"x" * 2048 + b'"}\n\n')
+                stream.finish()
+                # 已经落后超过 high_water 很久
+                pump._lagging_since = 0
+
+        pump = StreamPump(stream, high_water=100, slow_timeout=0.5, policy="disconnect", read_size=len(first))
+        await PumpedStreamingResponse(pump).stream_response(send)
+        return sent, len(first)
+
+    sent, offset = asyncio.run(run())
+    bodies = [m for m in sent if m["type"] == "http.response.body"]
+    assert bodies[-1] == {"type": "http.response.body", "body": b"", "more_body": False}
+    frame = json.loads(bodies[-2]["body"][:-len(FRAME_SEPARATOR)])
+    assert frame == {"event": "resume", "stream_id": "sid", "offset": offset, "reason": "slow_client"}
+
+
+def test_upstream_failure_ends_with_error_frame():
+    async def run():
+        stream = make_stream()
+        stream.append(b'{"data": "a"}\n\n')
+        stream.finish("Request timed out")
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        await PumpedStreamingResponse(StreamPump(stream)).stream_response(send)
+        return sent
+
+    bodies = [m["body"] for m in asyncio.run(run()) if m["type"] == "http.response.body" and m["body"]]
+    assert bodies[0] == b'{"data": "a"}\n\n'
+    frame = json.loads(bodies[-1][:-len(FRAME_SEPARATOR)])
+    assert frame["event"] == "error" and frame["error"] == "Request timed out"
+
+
+def test_completed_stream_has_no_control_frames():
+    async def run():
+        stream = make_stream()
+        stream.append(b'{"data": "a"}\n\n')
+        stream.finish()
+        return [chunk async for chunk in StreamPump(stream).chunks()]
+
+    assert asyncio.run(run()) == [b'{"data": "a"}\n\n']
+
+
+def test_registry_stop_waits_for_cancelled_upstream_tasks():
+    async def run():
+        registry = ChatStreamRegistry(retain_seconds=60, memory_limit=1024, spill_dir="")
+        stream = registry.create("owner")
+        logged = []
+
+        async def upstream():
+            try:
+                await asyncio.sleep(3600)
+            finally:
+                # 取消后还要写聊天记录
+                await asyncio.sleep(0.01)
+                logged.append(stream.stream_id)
+
+        stream.task = asyncio.create_task(upstream())
+        await asyncio.sleep(0)
+        await registry.stop()
+        return stream, logged
+
+    stream, logged = asyncio.run(run())
+    assert logged == [stream.stream_id]